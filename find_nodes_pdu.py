@@ -1,78 +1,199 @@
 """
 Module use to find all pdu link to nodes
+
+Crawl the reference API, one request by cluster, and write a node -> PDU
+index. The index has the format of the sensors metadata cache
+(script/node_metadata.py), so they load it instead of querying the API.
 """
-import urllib.request
+import argparse
+import concurrent.futures
 import json
-import sys
+import os
+import tempfile
+import threading
+import time
+import requests
 
 NODES = {
-    "grenoble": ("dahu", 32),
-    "lyon": ("nova", 23),
-    "lille": ("chetemi", 15),
-    "nantes": ("ecotype", 48),
-    "nancy": ("grisou", 51),
-    "rennes": ("paravance", 72)
+    "grenoble": ["dahu"],
+    "lyon": ["nova"],
+    "lille": ["chetemi"],
+    "nantes": ["ecotype"],
+    "nancy": ["grisou"],
+    "rennes": ["paravance"]
 }
 
-if len(sys.argv) != 2:
-    print("Need to specify password")
-    exit(1)
-
-def setup():
-    # create a password manager
-    password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+DEFAULT_INDEX_FILE = os.path.join(os.path.expanduser("~"), ".cache", "g5k-energy", "nodes.json")
 
-    # Add the username and password.
-    # If we knew the realm, we could use it instead of None.
-    top_level_url = "https://api.grid5000.fr/"
-    password_mgr.add_password(None, top_level_url, "jbouchoucha", sys.argv[1])
 
-    handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
-
-    # create "opener" (OpenerDirector instance)
-    opener = urllib.request.build_opener(handler)
+class RateLimiter:
+    """
+    Allow at most `rate` request starts by second, over all the threads
+    """
 
-    # use the opener to fetch a URL
-    opener.open("https://api.grid5000.fr")
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
 
-    # Install the opener.
-    # Now all calls to urllib.request.urlopen use our opener.
-    urllib.request.install_opener(opener)
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
 
-def find_key(key, search_dict):
-    res = None
-    for n_key, n_values in search_dict.items():
-        if n_key == key:
-            return n_values
 
-        if isinstance(n_values, dict):
-            res = find_key(key, n_values)
+def get_cluster_url(city, cluster):
+    """
+    Return the url for the information of all the nodes of a cluster.
 
-        if res is not None:
-            return res
-    return None
+    :param str city: City name
+    :param str cluster: Cluster name
+    :return str: Url
+    """
+    return "https://api.grid5000.fr/stable/sites/%s/clusters/%s/nodes.json" % (city, cluster)
 
 
-def get_node_url(city, cluster, node):
+def get_kwapi_url(city):
     """
-    Return the url for node information.
+    Return the url of the Kwapi information of a site.
 
     :param str city: City name
-    :param str cluster: Cluster name
-    :param str node: Node name
     :return str: Url
     """
-    return "https://api.grid5000.fr/stable/sites/%s/clusters/%s/nodes/%s.json" % (city, cluster, node)
+    return "https://api.grid5000.fr/stable/sites/%s/metrics/power/" % city
 
 
-setup()
+def get_json(session, limiter, url):
+    """
+    GET an url of the API, respecting the rate limit.
 
-for city in NODES:
-    node_name = NODES[city][0]
-    node_size = NODES[city][1]
+    :param requests.Session session: Authenticated session
+    :param RateLimiter limiter: Rate limit
+    :param str url: Url
+    :return: JSON answer, None if the url does not exist
+    """
+    limiter.wait()
+    request = session.get(url)
+    if request.status_code == 404:
+        return None
+    request.raise_for_status()
+    return request.json()
+
+
+def get_backends(pdus, kwapi_nodes, node):
+    """
+    Return the sensors able to monitor a node.
+
+    :param list pdus: sensors.power.via.pdu of the node, or None
+    :param set kwapi_nodes: Nodes of the site in Kwapi available_on
+    :param str node: Node name
+    :return list: Sensor names
+    """
+    backends = []
+    wattmetres = [pdu for pdu in pdus or [] if 'wattmetre' in pdu['uid']]
+    if wattmetres:
+        backends.append("omegawatt")
+    if node in kwapi_nodes:
+        backends.append("kwapi")
+    if pdus and not wattmetres:
+        backends.append("snmp")
+    return backends
+
+
+def crawl(session, limiter, clusters, workers):
+    """
+    Fetch the nodes of the clusters and the Kwapi nodes of their sites concurrently.
+
+    :param requests.Session session: Authenticated session
+    :param RateLimiter limiter: Rate limit
+    :param dict clusters: City -> list of cluster names
+    :param int workers: Number of concurrent requests
+    :return dict: Node name -> index entry
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        kwapi = {city: executor.submit(get_json, session, limiter, get_kwapi_url(city))
+                 for city in clusters}
+        nodes = {(city, cluster): executor.submit(get_json, session, limiter, get_cluster_url(city, cluster))
+                 for city in clusters for cluster in clusters[city]}
+
+        index = {}
+        now = time.time()
+        for (city, cluster), future in nodes.items():
+            data = future.result()
+            if data is None:
+                print("Unknown cluster %s in %s" % (cluster, city))
+                continue
+            kwapi_data = kwapi[city].result() or {}
+            kwapi_nodes = {node.split('.')[0] for node in kwapi_data.get('available_on', [])}
+            for node in data['items']:
+                pdus = node.get('sensors', {}).get('power', {}).get('via', {}).get('pdu')
+                index[node['uid']] = {
+                    "time": now,
+                    "site": city,
+                    "cluster": cluster,
+                    "pdu": pdus,
+                    "backends": get_backends(pdus, kwapi_nodes, node['uid'])
+                }
+        return index
+
+
+def write_index(path, index):
+    """
+    Write the index, keeping the other entries of an existing file.
 
-    for node_id in range(1, node_size+1):
-        node_url = get_node_url(city, node_name, node_name+"-"+str(node_id))
-        with urllib.request.urlopen(node_url) as url:
-            data = json.loads(url.read().decode())
-            print("%s %s-%s: %s" % (city, node_name, node_id, find_key("pdu", data)))
+    :param str path: JSON file
+    :param dict index: Node name -> index entry
+    """
+    data = {"nodes": {}, "hosts": {}}
+    try:
+        with open(path) as index_file:
+            data.update(json.load(index_file))
+    except (FileNotFoundError, ValueError):
+        pass
+    data["nodes"].update(index)
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(handle, 'w') as index_file:
+        json.dump(data, index_file, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the node -> PDU index of the G5K clusters.")
+    parser.add_argument("g5k_login", help="G5K login")
+    parser.add_argument("g5k_pass", help="G5K password")
+    parser.add_argument("--output", default=DEFAULT_INDEX_FILE, help="JSON index file")
+    parser.add_argument("--cluster", action="append",
+                        help="city:cluster to crawl, all the clusters of NODES by default")
+    parser.add_argument("--workers", type=int, default=8, help="Number of concurrent requests")
+    parser.add_argument("--rate", type=float, default=10, help="Maximum number of requests by second")
+    args = parser.parse_args()
+
+    clusters = NODES
+    if args.cluster:
+        clusters = {}
+        for city_cluster in args.cluster:
+            city, cluster = city_cluster.split(':')
+            clusters.setdefault(city, []).append(cluster)
+
+    session = requests.Session()
+    session.auth = (args.g5k_login, args.g5k_pass)
+    session.verify = False
+
+    begin = time.time()
+    index = crawl(session, RateLimiter(args.rate), clusters, args.workers)
+    write_index(args.output, index)
+
+    for node in sorted(index):
+        entry = index[node]
+        print("%s %s: %s %s" % (entry["site"], node, entry["pdu"], entry["backends"]))
+    print("%d nodes indexed in %s in %.1f s" % (len(index), args.output, time.time() - begin))
+
+
+if __name__ == "__main__":
+    main()
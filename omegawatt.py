@@ -3,7 +3,12 @@ Specific module for Lyon/Grenoble G5K wattmetter (OmegaWatt)
 Source from: https://gitlab.inria.fr/delamare/wattmetre-read/raw/master/tools/getwatt.py
 """
 
-def getwatt(node, from_ts, to_ts):
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+def getwatt(node, from_ts, to_ts, workers=4):
     """
     Get power values from Grid'5000 Lyon Wattmetre (requires Execo)
 
@@ -13,6 +18,8 @@ def getwatt(node, from_ts, to_ts):
 
     :param from_ts: Time until which metric is collected, as an integer Unix timestamp
 
+    :param workers: Number of hourly files downloaded concurrently
+
     :return: A list of (timestamp, value) tuples.
     """
 
@@ -20,15 +27,42 @@ def getwatt(node, from_ts, to_ts):
     import requests
     import gzip
     import time
+    import collections
+    from concurrent.futures import ThreadPoolExecutor
     from execo_g5k import get_host_attributes
 
     watt = []
     node_wattmetre = get_host_attributes(node)['sensors']['power']['via']['pdu'][0]
+    suffixes = []
     for ts in range(int(from_ts), int(to_ts)+3600, 3600):
         suffix = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%dT%H')
         if suffix != datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%dT%H'):
             suffix += ".gz"
-        data=requests.get("http://wattmetre.lyon.grid5000.fr/data/"+node_wattmetre['uid']+"-log/power.csv."+suffix).content
+        suffixes.append(suffix)
+        if not suffix.endswith(".gz"):
+            break
+
+    def download(suffix):
+        return requests.get("http://wattmetre.lyon.grid5000.fr/data/"+node_wattmetre['uid']+"-log/power.csv."+suffix)
+
+    def downloads():
+        # At most `workers` files are downloaded or waiting, given back in order
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            for suffix in suffixes:
+                pending.append((suffix, executor.submit(download, suffix)))
+                if len(pending) >= workers:
+                    suffix, future = pending.popleft()
+                    yield suffix, future.result()
+            while pending:
+                suffix, future = pending.popleft()
+                yield suffix, future.result()
+
+    for suffix, req in downloads():
+        if req.status_code == 404:
+            LOGGER.warning("No wattmetre file for " + suffix)
+            continue
+        data = req.content
         if suffix.endswith(".gz"):
             data = gzip.decompress(data)
         for l in str(data).split('\\n')[1:-1]:
@@ -37,8 +71,6 @@ def getwatt(node, from_ts, to_ts):
                 ts, value = (float(l[2]), float(l[4+node_wattmetre['port']]))
                 if from_ts <= ts and ts <= to_ts:
                     watt.append((ts, value))
-        if not suffix.endswith(".gz"):
-            break
     return watt
 
 
@@ -0,0 +1,190 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Archive-cache, local copy of the closed wattmetre hourly logs
+
+Only .gz logs are cached: they never change once the hour is over.
+The least recently used files are removed when the cache is too big.
+The size of the cache is counted at each write, the directory is only
+walked at the start and when the cache is too big.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+# Part of max_size kept by an eviction, so the next one waits for a tenth of it
+EVICT_RATIO = 0.9
+
+
+class ArchiveCache:
+    """
+    Files cached in directory/<city>/<wattmetre uid>/
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param directory: Directory of the cache, created if needed
+        :param max_size: Maximum number of bytes kept in the cache
+        """
+        self.directory = directory
+        self.max_size = max_size
+        # Bytes of the cached files, written by the threads of the downloads
+        self.size = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.evict()
+
+    def _path(self, city_name, wattmetre_uid, name):
+        return os.path.join(self.directory, city_name, wattmetre_uid, name)
+
+    def _read(self, path, reader):
+        try:
+            with open(path, 'rb') as cached:
+                data = reader(cached)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # The modification time is the last use of the file
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def _write(self, path, writer):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial file
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as cached:
+                writer(cached)
+            size = os.path.getsize(tmp_path)
+            try:
+                size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with self._lock:
+            self.size += size
+            full = self.size > self.max_size
+        if full:
+            self.evict()
+
+    def get(self, city_name, wattmetre_uid, suffix):
+        """
+        :param city_name: City name
+        :param wattmetre_uid: Wattmetre uid
+        :param suffix: Suffix of the log file
+        :return: Content of the log file, None if it is not cached
+        """
+        if not suffix.endswith(".gz"):
+            return None
+        return self._read(self._path(city_name, wattmetre_uid, "power.csv." + suffix),
+                          lambda cached: cached.read())
+
+    def put(self, city_name, wattmetre_uid, suffix, content):
+        """
+        Cache the content of a log file, unless the hour is not over
+        :param city_name: City name
+        :param wattmetre_uid: Wattmetre uid
+        :param suffix: Suffix of the log file
+        :param content: Content of the log file
+        """
+        if not suffix.endswith(".gz"):
+            return
+        self._write(self._path(city_name, wattmetre_uid, "power.csv." + suffix),
+                    lambda cached: cached.write(content))
+
+    def get_arrays(self, city_name, wattmetre_uid, suffix, port):
+        """
+        :param city_name: City name
+        :param wattmetre_uid: Wattmetre uid
+        :param suffix: Suffix of the log file
+        :param port: Wattmetre port
+        :return: Parsed (timestamps, values) of the port, None if not cached
+        """
+        if not suffix.endswith(".gz"):
+            return None
+
+        def reader(cached):
+            arrays = np.load(cached)
+            return arrays['timestamps'], arrays['values']
+
+        return self._read(self._path(city_name, wattmetre_uid, "%s.port%d.npz" % (suffix[:-3], port)),
+                          reader)
+
+    def has_arrays(self, city_name, wattmetre_uid, suffix, port):
+        """
+        :param city_name: City name
+        :param wattmetre_uid: Wattmetre uid
+        :param suffix: Suffix of the log file
+        :param port: Wattmetre port
+        :return: True if the parsed samples of the port are cached
+        """
+        return (suffix.endswith(".gz") and
+                os.path.exists(self._path(city_name, wattmetre_uid, "%s.port%d.npz" % (suffix[:-3], port))))
+
+    def put_arrays(self, city_name, wattmetre_uid, suffix, port, timestamps, values):
+        """
+        Cache the parsed samples of a port, unless the hour is not over
+        :param city_name: City name
+        :param wattmetre_uid: Wattmetre uid
+        :param suffix: Suffix of the log file
+        :param port: Wattmetre port
+        :param timestamps: float64 timestamps
+        :param values: float64 values
+        """
+        if not suffix.endswith(".gz"):
+            return
+        self._write(self._path(city_name, wattmetre_uid, "%s.port%d.npz" % (suffix[:-3], port)),
+                    lambda cached: np.savez(cached, timestamps=timestamps, values=values))
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache fits in EVICT_RATIO * max_size
+        """
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.max_size * EVICT_RATIO:
+                break
+            try:
+                os.remove(path)
+                LOGGER.info("Evict %s from the cache.", path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        with self._lock:
+            self.size = size
@@ -0,0 +1,527 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Backfill, the Kwapi and Omegawatt backfills of many nodes in parallel
+
+The nodes come from a list, an OAR node file or an OAR job. The work is
+planned by backend and source: one task by site for Kwapi, by wattmetre for
+Omegawatt, and by slice of the window. The tasks run in a process pool,
+with at most a given number of them on the same remote host, and their
+progress is reported by backend. The checkpoints are only read and written
+by the main process, once a task is written.
+
+    python backfill.py --oar-job 1234567 --city lyon mongodb_uri mongodb_db
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+import kwapi
+import metrics
+import wattmetre
+from archive_cache import ArchiveCache, DEFAULT_MAX_SIZE
+from bulk_writer import create_output, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_BUCKET_SIZE, LAYOUTS
+from checkpoint import Checkpoints, get_output_id, split_ranges, DEFAULT_CHECKPOINT_FILE
+from node_metadata import NodeMetadata, DEFAULT_CACHE_FILE, DEFAULT_TTL
+
+LOGGER = logging.getLogger()
+LOGGER.addHandler(logging.StreamHandler())
+
+BACKENDS = ('kwapi', 'omegawatt')
+DEFAULT_HOST_LIMIT = 4
+# Tasks are split at the checkpoint granularity of the sensors
+DEFAULT_SLICE_SIZE = 24 * 3600
+DEFAULT_REPORT_INTERVAL = 10
+
+# State of a worker process, from init_worker
+_WORKER = {}
+
+##############################################################################
+# Useful functions
+##############################################################################
+
+
+def split_node_name(name, city_name=None):
+    """
+    :param name: Node name or FQDN (e.g. nova-1.lyon.grid5000.fr)
+    :param city_name: City of the names without site
+    :return: (city name, node name)
+    """
+    parts = name.strip().split('.')
+    if len(parts) > 1:
+        return parts[1], parts[0]
+    if city_name is None:
+        raise ValueError("No city for the node " + name + ", give --city or a FQDN")
+    return city_name, parts[0]
+
+
+def read_nodefile(path):
+    """
+    :param path: OAR node file, one line by core
+    :return: List of host names, without duplicate
+    """
+    with open(path) as nodefile:
+        return list(collections.OrderedDict.fromkeys(line.strip() for line in nodefile if line.strip()))
+
+
+def get_oar_job(session, city_name, job_id):
+    """
+    Return the nodes and dates of an OAR job, from the G5K API
+    :param session: Session from kwapi.create_session
+    :param city_name: Site of the job
+    :param job_id: OAR job id
+    :return: (list of FQDN, start timestamp, stop timestamp or None if it runs)
+    """
+    request = session.get(kwapi.API_URL + "/sites/" + city_name + "/jobs/" + str(job_id))
+    request.raise_for_status()
+    job = request.json()
+    return job['assigned_nodes'], job.get('started_at'), job.get('stopped_at')
+
+
+def get_host(backend, city_name):
+    """
+    :param backend: One of BACKENDS
+    :param city_name: City name
+    :return: Remote host queried by the tasks of a backend in a city
+    """
+    if backend == 'kwapi':
+        return urllib.parse.urlparse(kwapi.API_URL).netloc
+    return urllib.parse.urlparse(wattmetre.WATTMETRE_URL % city_name).netloc
+
+
+def get_available_nodes(backend, city_name, nodes, session=None):
+    """
+    :param backend: One of BACKENDS
+    :param city_name: City name
+    :param nodes: List of node names
+    :param session: Session from kwapi.create_session, for kwapi
+    :return: List of the nodes the backend monitors
+    """
+    if backend == 'kwapi':
+        missing = kwapi.get_unavailable_nodes(session, city_name, nodes)
+    else:
+        missing = wattmetre.get_unavailable_nodes(city_name, nodes)
+    if missing:
+        LOGGER.error("%s not available in %s for %d nodes: %s", backend, city_name, len(missing),
+                     ",".join(missing))
+    return [node_name for node_name in nodes if node_name not in missing]
+
+
+def plan(backend, city_name, nodes, timestamp_start, timestamp_stop, slice_size=DEFAULT_SLICE_SIZE,
+         metadata=None, checkpoints=None):
+    """
+    Split the backfill of some nodes of a city in tasks
+    :param backend: One of BACKENDS
+    :param city_name: City name
+    :param nodes: List of node names
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param slice_size: Seconds of a task, aligned on multiples of it
+    :param metadata: NodeMetadata, to group the nodes by wattmetre for omegawatt
+    :param checkpoints: Checkpoints of the output of the backend, to plan only the missing ranges
+    :return: List of Dict tasks {backend, city, source, host, nodes, sensor, start, stop}
+    """
+    if backend == 'kwapi':
+        # One request fetches all the nodes of a site
+        sources = {city_name: nodes}
+        sensor = kwapi.SENSOR_NAME
+    else:
+        # The log of a wattmetre is parsed once for all its nodes
+        sources = {wattmetre_uid: [node_name for node_name, _ in wattmetre_nodes]
+                   for wattmetre_uid, wattmetre_nodes in wattmetre.get_wattmetres(metadata, nodes).items()}
+        sensor = wattmetre.SENSOR_NAME
+
+    tasks = []
+    for source, source_nodes in sources.items():
+        ranges = [(int(timestamp_start), int(timestamp_stop), source_nodes)]
+        if checkpoints is not None:
+            # A task only holds the nodes missing its range
+            ranges = checkpoints.plan(sensor, source_nodes, *ranges[0][:2])
+        for start, stop, task_nodes in split_ranges(ranges, slice_size):
+            tasks.append({"backend": backend, "city": city_name, "source": source,
+                          "host": get_host(backend, city_name), "nodes": task_nodes,
+                          "sensor": sensor, "start": start, "stop": stop})
+    return tasks
+
+
+def init_worker(options, metadata_data):
+    """
+    Prepare a worker process: its node metadata, Kwapi session, archive cache
+    and MongoDB client are kept for all its tasks
+    :param options: Dict of the script arguments
+    :param metadata_data: Data of the NodeMetadata of the main process
+    """
+    # SIGINT and SIGTERM end the main process, which waits for the running tasks
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    metadata = NodeMetadata(None, options['metadata_ttl'])
+    metadata.data = metadata_data
+    session = None
+    if 'kwapi' in options['backends']:
+        auth = (options['g5k_login'], options['g5k_pass']) if options['g5k_login'] else None
+        session = kwapi.create_session(auth, 1)
+    cache = None
+    if options['cache_dir'] is not None:
+        cache = ArchiveCache(options['cache_dir'], options['cache_size'] * 1024 * 1024)
+    _WORKER.update(options=options, metadata=metadata, session=session, cache=cache)
+
+
+def run_task(task):
+    """
+    Collect a task in a worker process, with one request at a time
+    :param task: Dict task from plan
+    :return: Dict with the documents written and rejected, bytes fetched and seconds spent
+    """
+    options = _WORKER['options']
+    begin = time.monotonic()
+    fetched = metrics.REGISTRY.total("fetch_bytes_total")
+    # The output is closed by the task, so the files of file_sink are complete
+    output = create_output(options['mongodb_uri'], options['mongodb_db'],
+                           options[task['backend'] + '_collection'],
+                           options['layout'],
+                           options['bucket_size'],
+                           options['batch_size'],
+                           options['flush_interval'],
+                           options['rollups'])
+    try:
+        if task['backend'] == 'kwapi':
+            kwapi.collect(_WORKER['session'], output, task['city'], task['nodes'], task['start'], task['stop'],
+                          options['chunk_size'], 1, stream_json=options['stream_json'])
+        else:
+            wattmetre.collect(output, _WORKER['metadata'], task['city'], task['nodes'],
+                              task['start'], task['stop'],
+                              functools.partial(wattmetre.create_collector, raw=options['raw'],
+                                                window=options['window'], aggregator=options['aggregator']),
+                              1, _WORKER['cache'], options['cache_arrays'])
+    finally:
+        # Written before the main process marks the checkpoints
+        output.close()
+    return {"documents": output.written,
+            "rejected": output.rejected,
+            "bytes": metrics.REGISTRY.total("fetch_bytes_total") - fetched,
+            "seconds": time.monotonic() - begin}
+
+
+class Progress:
+    """
+    Tasks, node-seconds, documents and bytes done by backend
+    """
+
+    def __init__(self, tasks):
+        """
+        :param tasks: List of Dict tasks from plan
+        """
+        self.start = time.monotonic()
+        self.backends = collections.OrderedDict()
+        for task in tasks:
+            backend = self.backends.setdefault(task['backend'], {
+                "tasks": 0, "done": 0, "failed": 0, "node_seconds": 0, "node_seconds_done": 0,
+                "documents": 0, "bytes": 0})
+            backend["tasks"] += 1
+            backend["node_seconds"] += len(task['nodes']) * (task['stop'] - task['start'])
+
+    def add(self, task, result=None):
+        """
+        :param task: Dict task from plan
+        :param result: Dict from run_task, None if the task failed
+        """
+        backend = self.backends[task['backend']]
+        labels = {"backend": task['backend']}
+        if result is None:
+            backend["failed"] += 1
+            metrics.inc("backfill_tasks_failed_total", 1, labels)
+            return
+        backend["done"] += 1
+        backend["node_seconds_done"] += len(task['nodes']) * (task['stop'] - task['start'])
+        backend["documents"] += result["documents"]
+        backend["bytes"] += result["bytes"]
+        metrics.inc("backfill_tasks_done_total", 1, labels)
+        metrics.inc("documents_written_total", result["documents"], labels)
+        metrics.inc("fetch_bytes_total", result["bytes"], labels)
+        metrics.observe("backfill_task_seconds", result["seconds"], labels)
+        metrics.gauge("backfill_progress_ratio", self.get_ratio(backend), labels)
+
+    @staticmethod
+    def get_ratio(backend):
+        return backend["node_seconds_done"] / backend["node_seconds"] if backend["node_seconds"] else 1.0
+
+    def report(self, running=0):
+        """
+        Log the progress, throughput and remaining time of every backend
+        :param running: Number of running tasks
+        """
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        for name, backend in self.backends.items():
+            ratio = self.get_ratio(backend)
+            remaining = elapsed * (1 - ratio) / ratio if ratio > 0 else None
+            LOGGER.warning("%-10s %d/%d tasks (%d failed) %5.1f%% of the node-hours  %d docs  %.1f docs/s  "
+                           "%.2f MB/s  remaining %s",
+                           name, backend["done"], backend["tasks"], backend["failed"], 100 * ratio,
+                           backend["documents"], backend["documents"] / elapsed,
+                           backend["bytes"] / elapsed / 1e6,
+                           "%d s" % remaining if remaining is not None else "-")
+        LOGGER.warning("%d running tasks, %.0f s elapsed", running, elapsed)
+
+
+def run(tasks, processes, host_limit=DEFAULT_HOST_LIMIT, initargs=(), checkpoints=None, stop=None,
+        report_interval=DEFAULT_REPORT_INTERVAL):
+    """
+    Run the tasks in a process pool, in order, at most host_limit at a time on a host
+    :param tasks: List of Dict tasks from plan
+    :param processes: Number of worker processes
+    :param host_limit: Maximum number of running tasks on the same remote host
+    :param initargs: Arguments of init_worker
+    :param checkpoints: Dict backend -> Checkpoints, marked when a task is written without rejected document
+    :param stop: threading.Event, no task is started once set and the running ones are waited for
+    :param report_interval: Seconds between two progress reports
+    :return: Progress
+    """
+    progress = Progress(tasks)
+    pending = list(tasks)
+    running = {}
+    hosts = collections.Counter()
+    last_report = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                                initargs=initargs) as executor:
+        while running or (pending and not (stop is not None and stop.is_set())):
+            # The first pending tasks whose host has room
+            waiting = []
+            for task in pending:
+                if (len(running) < processes and hosts[task['host']] < host_limit and
+                        not (stop is not None and stop.is_set())):
+                    running[executor.submit(run_task, task)] = task
+                    hosts[task['host']] += 1
+                else:
+                    waiting.append(task)
+            pending = waiting
+
+            done, _ = concurrent.futures.wait(running, timeout=report_interval,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                hosts[task['host']] -= 1
+                try:
+                    result = future.result()
+                except Exception:
+                    LOGGER.exception("Task %s %s %d-%d failed.", task['backend'], task['source'],
+                                     task['start'], task['stop'])
+                    result = None
+                if result is not None and result["rejected"]:
+                    LOGGER.error("Task %s %s %d-%d not marked, %d documents rejected.", task['backend'],
+                                 task['source'], task['start'], task['stop'], result["rejected"])
+                elif result is not None and checkpoints is not None:
+                    checkpoints[task['backend']].add(task['sensor'], task['nodes'], task['start'], task['stop'])
+                progress.add(task, result)
+            if time.monotonic() - last_report >= report_interval:
+                progress.report(len(running))
+                last_report = time.monotonic()
+    if pending:
+        LOGGER.warning("%d tasks not started.", len(pending))
+    progress.report()
+    return progress
+
+##############################################################################
+# Parser
+##############################################################################
+
+
+def arg_parser_init():
+    """
+    Initialize argument parser
+    """
+    parser = argparse.ArgumentParser(
+        description="Backfill the Kwapi and Omegawatt series of many nodes in parallel.")
+
+    # MongoDB output
+    parser.add_argument("mongodb_uri", help="MongoDB output uri, or parquet:// or arrow:// and a directory")
+    parser.add_argument("mongodb_db", help="MongoDB output database, or sub-directory")
+    parser.add_argument("--kwapi-collection", default="kwapi", help="Output collection of Kwapi")
+    parser.add_argument("--omegawatt-collection", default="omegawatt", help="Output collection of Omegawatt")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of documents written in one insert_many")
+    parser.add_argument("--flush-interval", type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help="Maximum number of seconds a document stays buffered")
+    parser.add_argument("--layout", choices=LAYOUTS, default='document',
+                        help="One document by sample, by bucket of samples, or a time-series collection")
+    parser.add_argument("--bucket-size", type=int, default=DEFAULT_BUCKET_SIZE,
+                        help="Seconds covered by one bucket document")
+    parser.add_argument("--rollups", action="store_true",
+                        help="Also update the 10 s, 1 min and 1 h rollups of the MongoDB collections")
+
+    # Nodes and window
+    nodes = parser.add_mutually_exclusive_group(required=True)
+    nodes.add_argument("--nodes", help="Comma separated list of nodes, names or FQDN")
+    nodes.add_argument("--nodefile", help="OAR node file (e.g. $OAR_NODEFILE)")
+    nodes.add_argument("--oar-job", type=int, help="OAR job id, its nodes and dates are read from the G5K API")
+    parser.add_argument("--city", help="City of the OAR job and of the node names without site")
+    parser.add_argument("timestamp_start", nargs="?", type=int,
+                        help="Timestamp where begin the series, the start of the OAR job by default")
+    parser.add_argument("timestamp_stop", nargs="?", type=int,
+                        help="Timestamp where end the series, the end of the OAR job or now by default")
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        help="Comma separated backends among " + ", ".join(BACKENDS))
+
+    # Pool
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes")
+    parser.add_argument("--host-limit", type=int, default=DEFAULT_HOST_LIMIT,
+                        help="Maximum number of tasks running on the same remote host")
+    parser.add_argument("--slice-size", type=int, default=DEFAULT_SLICE_SIZE,
+                        help="Seconds of the window collected by one task")
+    parser.add_argument("--report-interval", type=float, default=DEFAULT_REPORT_INTERVAL,
+                        help="Seconds between two progress reports")
+
+    # Kwapi
+    parser.add_argument("--g5k-login", help="G5K login, for Kwapi and the OAR job")
+    parser.add_argument("--g5k-pass", help="G5K password")
+    parser.add_argument("--chunk-size", type=int, default=kwapi.DEFAULT_CHUNK_SIZE,
+                        help="Number of seconds fetched by one Kwapi request")
+    parser.add_argument("--stream-json", action="store_true",
+                        help="Decode the Kwapi answers while they are received, in typed arrays")
+
+    # Omegawatt
+    resolution = parser.add_mutually_exclusive_group()
+    resolution.add_argument("--raw", action="store_true",
+                            help="Keep every Omegawatt sample with its original timestamp")
+    resolution.add_argument("--window", type=float,
+                            help="Resample Omegawatt on bins of WINDOW seconds (e.g. 0.02, 0.1, 1)")
+    parser.add_argument("--aggregator", choices=wattmetre.AGGREGATORS, default='mean',
+                        help="Aggregation of the samples of a bin, with --window")
+    parser.add_argument("--cache-dir", help="Directory where the closed hourly logs are cached")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help="Maximum size of the cache, in MB")
+    parser.add_argument("--cache-arrays", action="store_true", help="Also cache the parsed samples")
+
+    # Cache of the node metadata
+    parser.add_argument("--metadata-cache", default=DEFAULT_CACHE_FILE,
+                        help="JSON file caching the PDU of the nodes")
+    parser.add_argument("--metadata-ttl", type=float, default=DEFAULT_TTL,
+                        help="Seconds before the metadata of a node is fetched again")
+
+    # Checkpoints of the ranges already written
+    parser.add_argument("--checkpoints", default=DEFAULT_CHECKPOINT_FILE,
+                        help="JSON file of the ranges already written, only the missing ones are fetched")
+    parser.add_argument("--no-checkpoints", action="store_true",
+                        help="Fetch the whole window, without reading nor writing the checkpoints")
+
+    # Instrumentation
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="JSON file of the metrics summary written at the end, logged by default")
+
+    return parser
+
+##############################################################################
+# Main
+##############################################################################
+
+
+def main():
+    """
+    Main function of the Backfill
+    """
+    parser = arg_parser_init()
+    args = parser.parse_args()
+    LOGGER.warning("/!\\ Make sure you are in the G5K network /!\\")
+
+    backends = [backend for backend in args.backends.split(',') if backend]
+    if not backends or any(backend not in BACKENDS for backend in backends):
+        parser.error("--backends must be among " + ", ".join(BACKENDS))
+    if args.processes < 1 or args.host_limit < 1:
+        parser.error("--processes and --host-limit must be at least 1")
+    if args.mongodb_uri.startswith("npy://") and args.processes > 1:
+        parser.error("npy outputs are appended by one process, use --processes 1")
+
+    auth = (args.g5k_login, args.g5k_pass) if args.g5k_login else None
+    session = kwapi.create_session(auth, 1)
+
+    # Nodes by city, and window
+    timestamp_start, timestamp_stop = args.timestamp_start, args.timestamp_stop
+    try:
+        if args.oar_job is not None:
+            if args.city is None:
+                parser.error("--oar-job needs the --city of the job")
+            names, job_start, job_stop = get_oar_job(session, args.city, args.oar_job)
+            timestamp_start = job_start if timestamp_start is None else timestamp_start
+            timestamp_stop = job_stop if timestamp_stop is None else timestamp_stop
+        elif args.nodefile is not None:
+            names = read_nodefile(args.nodefile)
+        else:
+            names = [name for name in args.nodes.split(',') if name]
+        cities = collections.OrderedDict()
+        for name in names:
+            city_name, node_name = split_node_name(name, args.city)
+            if node_name not in cities.setdefault(city_name, []):
+                cities[city_name].append(node_name)
+    except (OSError, ValueError) as error:
+        LOGGER.error(str(error))
+        sys.exit(-1)
+    if timestamp_start is None:
+        parser.error("timestamp_start is required without --oar-job")
+    if timestamp_stop is None:
+        timestamp_stop = int(time.time())
+
+    # The metadata are fetched once here, and given to the workers
+    metadata = NodeMetadata(args.metadata_cache, args.metadata_ttl)
+    checkpoints = None
+    if not args.no_checkpoints:
+        checkpoints = {backend: Checkpoints(get_output_id(args.mongodb_uri, args.mongodb_db,
+                                                          getattr(args, backend + '_collection')),
+                                            args.checkpoints)
+                       for backend in backends}
+    tasks = []
+    for backend in backends:
+        for city_name, nodes in cities.items():
+            nodes = get_available_nodes(backend, city_name, nodes, session)
+            if nodes:
+                tasks.extend(plan(backend, city_name, nodes, timestamp_start, timestamp_stop, args.slice_size,
+                                  metadata, checkpoints[backend] if checkpoints is not None else None))
+    metadata.save()
+    # Every source moves forward together, instead of one after the other
+    tasks.sort(key=lambda task: (task['start'], task['backend'], task['source']))
+    LOGGER.warning("%d tasks for %d nodes from %d to %d.", len(tasks),
+                   sum(len(nodes) for nodes in cities.values()), timestamp_start, timestamp_stop)
+
+    # Signal handling: the running tasks are waited for, and marked in the checkpoints
+    stop = threading.Event()
+
+    def term_handler(_, __):
+        LOGGER.warning("Ended by user, waiting for the running tasks.")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, term_handler)
+    signal.signal(signal.SIGINT, term_handler)
+
+    try:
+        options = dict(vars(args), backends=backends)
+        progress = run(tasks, args.processes, args.host_limit, (options, metadata.data), checkpoints, stop,
+                       args.report_interval)
+    finally:
+        metrics.write_summary(args.metrics)
+    if any(backend["failed"] for backend in progress.backends.values()) or stop.is_set():
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
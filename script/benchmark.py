@@ -0,0 +1,553 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Benchmark, the sensor pipelines against local stand-ins of G5K
+
+Three stand-ins run in this process: an HTTP server answering the Kwapi
+available_on and timeseries urls with synthetic series, an HTTP server of
+wattmetre hourly logs, and an SNMP agent answering the APC outlet and
+clock OIDs. Every case (backend, number of nodes, hours) runs the
+collection of the sensor in a new process, writing to a counting mock
+collection or to --output, and reports its throughput, request latency
+and peak RSS.
+
+    python benchmark.py [--backends kwapi,omegawatt,snmp] [--nodes 1,8] [--hours 1,6]
+                        [--json FILE] [--baseline FILE]
+"""
+
+import argparse
+import asyncio
+import gzip
+import http.server
+import json
+import logging
+import multiprocessing
+import resource
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+import numpy as np
+
+LOGGER = logging.getLogger()
+LOGGER.addHandler(logging.StreamHandler())
+
+CITY = "lyon"
+CLUSTER = "nova"
+BACKENDS = ('kwapi', 'omegawatt', 'snmp')
+# Outlets of a stand-in wattmetre or PDU
+PORTS = 8
+
+##############################################################################
+# Stand-ins
+##############################################################################
+
+
+def get_node_names(count):
+    """
+    :param count: Number of nodes
+    :return: List of node names
+    """
+    return [CLUSTER + "-" + str(index + 1) for index in range(count)]
+
+
+def get_power(node_index, timestamps):
+    """
+    Synthetic power of a node
+    :param node_index: Index of the node
+    :param timestamps: float64 timestamps
+    :return: float64 values in W
+    """
+    return 100.0 + 10 * node_index + 50 * np.sin(timestamps / 60.0 + node_index)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    HTTP server answering every request in its own thread
+    """
+    daemon_threads = True
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answer GET with server.answer(path, query) -> bytes or None for 404
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        body = self.server.answer(url.path, urllib.parse.parse_qs(url.query))
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+def answer_kwapi(path, query):
+    """
+    Synthetic answers of the Kwapi API, for any node of the site
+    :param path: Url path
+    :param query: Parsed query string
+    :return: JSON bytes, None for 404
+    """
+    if path.endswith("/metrics/power/"):
+        return json.dumps({"available_on": [node + "." + CITY + ".grid5000.fr"
+                                            for node in get_node_names(1024)]}).encode()
+    if path.endswith("/metrics/power/timeseries"):
+        timestamp_start, timestamp_stop = int(query["from"][0]), int(query["to"][0])
+        timestamps = np.arange(timestamp_start, timestamp_stop, dtype=np.float64)
+        items = []
+        for node in query["only"][0].split(","):
+            items.append({
+                "uid": node,
+                "from": timestamp_start,
+                "to": timestamp_stop,
+                "timestamps": timestamps.tolist(),
+                "values": get_power(int(node.split("-")[-1]), timestamps).round(1).tolist()
+            })
+        return json.dumps({"items": items}).encode()
+    return None
+
+
+def create_hour_log(timestamp, rate):
+    """
+    Synthetic hourly log of a wattmetre, every port filled
+    :param timestamp: First timestamp of the hour
+    :param rate: Samples by second
+    :return: gzip bytes
+    """
+    timestamps = timestamp + np.arange(int(3600 * rate)) / float(rate)
+    columns = [np.char.mod("%.2f", get_power(port, timestamps)) for port in range(PORTS)]
+    lines = ["date,device,timestamp,status," + ",".join("port" + str(port) for port in range(PORTS))]
+    for index, ts in enumerate(timestamps.tolist()):
+        lines.append("d,w,%.3f,OK,%s" % (ts, ",".join(column[index] for column in columns)))
+    return gzip.compress(("\n".join(lines) + "\n").encode(), compresslevel=1)
+
+
+def create_wattmetre_files(timestamp_start, timestamp_stop, nodes, rate):
+    """
+    Files of the stand-in wattmetre server
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop
+    :param nodes: Number of nodes, PORTS by wattmetre
+    :param rate: Samples by second
+    :return: Dict url path -> bytes
+    """
+    import wattmetre
+
+    uids = ["wattmetre" + str(index + 1) for index in range((nodes + PORTS - 1) // PORTS)]
+    files = {"/GetWatts-json.php": json.dumps({node: {} for node in get_node_names(nodes)}).encode()}
+    for suffix in wattmetre.get_hour_suffixes(timestamp_start, timestamp_stop):
+        hour = time.mktime(time.strptime(suffix[:13], "%Y-%m-%dT%H"))
+        log = create_hour_log(hour, rate)
+        for uid in uids:
+            files["/data/" + uid + "-log/power.csv." + suffix] = log
+    return files
+
+
+def get_file_answer(files):
+    """
+    :param files: Dict url path -> bytes
+    :return: Function answering the files, the city being the first part of the path
+    """
+    def answer(path, _):
+        return files.get("/" + path.split("/", 2)[-1])
+    return answer
+
+
+def start_http_server(answer):
+    """
+    :param answer: Function (path, query) -> bytes or None
+    :return: HTTP server running in a thread
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.answer = answer
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SnmpAgent(asyncio.DatagramProtocol):
+    """
+    SNMP agent answering the outlet power (10 W by port number) and the clock
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.requests = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        from pyasn1.codec.ber import decoder, encoder
+        from pysnmp.proto import api
+        import pdu_snmp
+
+        self.requests += 1
+        proto = api.protoModules[int(api.decodeMessageVersion(data))]
+        message, _ = decoder.decode(data, asn1Spec=proto.Message())
+        request = proto.apiMessage.getPDU(message)
+        response = proto.apiMessage.getResponse(message)
+        var_binds = []
+        for oid, _ in proto.apiPDU.getVarBinds(request):
+            if str(oid) == pdu_snmp.DATE_OID:
+                value = proto.OctetString(time.strftime("%m/%d/%Y"))
+            elif str(oid) == pdu_snmp.TIME_OID:
+                value = proto.OctetString(time.strftime("%H:%M:%S"))
+            else:
+                value = proto.Integer(10 * int(str(oid).split(".")[-1]))
+            var_binds.append((oid, value))
+        proto.apiPDU.setVarBinds(proto.apiMessage.getPDU(response), var_binds)
+        self.transport.sendto(encoder.encode(response), address)
+
+
+def start_snmp_agent():
+    """
+    :return: UDP port of an SNMP agent running in a thread
+    """
+    loop = asyncio.new_event_loop()
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(SnmpAgent, local_addr=("127.0.0.1", 0)))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return transport.get_extra_info("sockname")[1]
+
+##############################################################################
+# Cases, each one in its own process
+##############################################################################
+
+
+class CountingCollection:
+    """
+    Mock MongoDB collection counting the written documents
+    """
+    name = "benchmark"
+
+    def __init__(self):
+        self.documents = 0
+
+    def insert_many(self, documents, ordered=True):
+        self.documents += len(documents)
+        return argparse.Namespace(inserted_ids=[None] * len(documents))
+
+    def bulk_write(self, requests, ordered=True):
+        self.documents += len(requests)
+
+    def create_index(self, *_, **__):
+        pass
+
+
+def get_percentiles(latencies):
+    """
+    :param latencies: List of seconds
+    :return: Dict of the p50, p95 and max latency in ms
+    """
+    if not latencies:
+        return {"latency_p50_ms": None, "latency_p95_ms": None, "latency_max_ms": None}
+    latencies = np.asarray(latencies) * 1000
+    return {"latency_p50_ms": round(float(np.percentile(latencies, 50)), 2),
+            "latency_p95_ms": round(float(np.percentile(latencies, 95)), 2),
+            "latency_max_ms": round(float(latencies.max()), 2)}
+
+
+def timed(function, latencies):
+    """
+    :param function: Function to time
+    :param latencies: List where the duration of every call is appended
+    :return: Function calling function
+    """
+    def wrapper(*args, **kwargs):
+        begin = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            latencies.append(time.monotonic() - begin)
+    return wrapper
+
+
+def create_metadata(nodes, kind):
+    """
+    :param nodes: Number of nodes
+    :param kind: wattmetre or pdu
+    :return: In memory NodeMetadata of the stand-in nodes, PORTS by device
+    """
+    from node_metadata import NodeMetadata, get_pdu_host_name
+
+    metadata = NodeMetadata(None)
+    now = time.time()
+    for index, node in enumerate(get_node_names(nodes)):
+        uid = kind + str(index // PORTS + 1)
+        metadata.data["nodes"][node] = {"time": now, "pdu": [{"uid": uid, "port": index % PORTS}]}
+        metadata.data["hosts"][get_pdu_host_name(uid, CITY)] = {"time": now, "ip": "127.0.0.1"}
+    return metadata
+
+
+def run_kwapi(output, nodes, timestamp_start, timestamp_stop, options, latencies):
+    import kwapi
+
+    kwapi.API_URL = "http://127.0.0.1:%d" % options["kwapi_port"]
+    session = kwapi.create_session(("benchmark", "benchmark"), kwapi.DEFAULT_WORKERS)
+    session.mount("http://", session.get_adapter("https://"))
+    session.get = timed(session.get, latencies)
+    kwapi.collect(session, output, CITY, get_node_names(nodes), timestamp_start, timestamp_stop)
+
+
+def run_omegawatt(output, nodes, timestamp_start, timestamp_stop, options, latencies):
+    import wattmetre
+
+    wattmetre.WATTMETRE_URL = "http://127.0.0.1:%d" % options["wattmetre_port"] + "/%s"
+    wattmetre.download_log = timed(wattmetre.download_log, latencies)
+    wattmetre.collect(output, create_metadata(nodes, "wattmetre"), CITY, get_node_names(nodes),
+                      timestamp_start, timestamp_stop)
+
+
+def run_snmp(output, nodes, options, latencies):
+    import pdu_snmp
+    from bulk_writer import QueueWriter
+
+    pdu_snmp.SNMP_PORT = options["snmp_port"]
+    pdus_infos, nodes_outlets = pdu_snmp.get_pdu_outlets(create_metadata(nodes, "pdu"), CITY,
+                                                         get_node_names(nodes))
+    read_watts = pdu_snmp.PduSession.read_watts
+
+    async def timed_read_watts(session, ports):
+        watts, timestamp, latency = await read_watts(session, ports)
+        latencies.append(latency)
+        return watts, timestamp, latency
+
+    pdu_snmp.PduSession.read_watts = timed_read_watts
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    queue = QueueWriter(output)
+    queue.start()
+    poller = pdu_snmp.SnmpPoller(pdus_infos, nodes_outlets, queue)
+    deadline = loop.time() + options["snmp_duration"]
+
+    async def poll():
+        if loop.time() >= deadline:
+            return False
+        return await poller.poll()
+
+    try:
+        loop.run_until_complete(pdu_snmp.run_periodic(options["snmp_period"], poll))
+        loop.run_until_complete(queue.close())
+    finally:
+        poller.close()
+        # Let the engines cancel their timers
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+
+def get_peak_rss():
+    """
+    :return: Peak resident memory of the process, in MB
+    """
+    # VmHWM starts again at exec, ru_maxrss keeps the one of the parent
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_case(backend, nodes, hours, options):
+    """
+    Run the collection of one backend and measure it
+    :param backend: One of BACKENDS
+    :param nodes: Number of nodes
+    :param hours: Hours of the window, ignored by snmp
+    :param options: Dict of the ports of the stand-ins and the script options
+    :return: Dict result
+    """
+    from bulk_writer import create_output, create_writer
+
+    logging.getLogger().setLevel(logging.ERROR)
+    collection = None
+    if options["output"] is None:
+        collection = CountingCollection()
+        output = create_writer(collection, options["layout"])
+    else:
+        output = create_output(options["output"], "benchmark", backend, options["layout"])
+
+    latencies = []
+    begin = time.monotonic()
+    if backend == 'kwapi':
+        run_kwapi(output, nodes, options["timestamp_start"][hours], options["timestamp_stop"],
+                  options, latencies)
+    elif backend == 'omegawatt':
+        run_omegawatt(output, nodes, options["timestamp_start"][hours], options["timestamp_stop"],
+                      options, latencies)
+    if backend != 'snmp':
+        output.close()
+    else:
+        run_snmp(output, nodes, options, latencies)
+    seconds = time.monotonic() - begin
+
+    result = {
+        "backend": backend,
+        "nodes": nodes,
+        "hours": hours if backend != 'snmp' else None,
+        "seconds": round(seconds, 3),
+        "documents": output.written,
+        "documents_per_s": round(output.written / seconds, 1),
+        "requests": len(latencies),
+        "peak_rss_mb": round(get_peak_rss(), 1)
+    }
+    if collection is not None and options["layout"] == 'bucket':
+        result["bucket_writes"] = collection.documents
+    result.update(get_percentiles(latencies))
+    return result
+
+##############################################################################
+# Parser
+##############################################################################
+
+
+def get_int_list(value):
+    """
+    :param value: Comma separated integers
+    :return: List of int
+    """
+    return [int(item) for item in value.split(",") if item]
+
+
+def arg_parser_init():
+    """
+    Initialize argument parser
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the sensors against local stand-ins of G5K.")
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        help="Comma separated backends among " + ", ".join(BACKENDS))
+    parser.add_argument("--nodes", type=get_int_list, default=[1, 8],
+                        help="Comma separated numbers of nodes")
+    parser.add_argument("--hours", type=get_int_list, default=[1],
+                        help="Comma separated numbers of hours, for kwapi and omegawatt")
+    parser.add_argument("--rate", type=float, default=50,
+                        help="Samples by second of the stand-in wattmetres")
+    parser.add_argument("--snmp-duration", type=float, default=10,
+                        help="Seconds of SNMP polling")
+    parser.add_argument("--snmp-period", type=float, default=1.0,
+                        help="Seconds between two SNMP polls")
+    parser.add_argument("--output",
+                        help="Output uri (MongoDB, npy://, parquet://...), a counting mock by default")
+    parser.add_argument("--layout", choices=('document', 'bucket'), default='document',
+                        help="Layout of the output")
+    parser.add_argument("--json", help="Write the results in this JSON file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Slow down from the baseline reported as a regression")
+    return parser
+
+##############################################################################
+# Main
+##############################################################################
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the throughput of the cases found in the baseline
+    :param results: List of Dict result
+    :param baseline: List of Dict result of a previous run
+    :param tolerance: Fraction of the baseline throughput that can be lost
+    :return: List of the regression messages
+    """
+    previous = {(result["backend"], result["nodes"], result["hours"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result["backend"], result["nodes"], result["hours"]))
+        if old is None or old["backend"] == 'snmp':
+            continue
+        if result["documents_per_s"] < old["documents_per_s"] * (1 - tolerance):
+            regressions.append("%s %d nodes %s h: %.1f documents/s, %.1f before" % (
+                result["backend"], result["nodes"], result["hours"],
+                result["documents_per_s"], old["documents_per_s"]))
+    return regressions
+
+
+def main():
+    """
+    Main function of the Benchmark
+    """
+    args = arg_parser_init().parse_args()
+    backends = [backend for backend in args.backends.split(",") if backend]
+    for backend in backends:
+        if backend not in BACKENDS:
+            LOGGER.error("Unknown backend " + backend)
+            sys.exit(-1)
+
+    # Past hours only, so every log is a closed .gz
+    timestamp_stop = int(time.time()) // 3600 * 3600 - 3600
+    options = {
+        "timestamp_stop": timestamp_stop,
+        "timestamp_start": {hours: timestamp_stop - hours * 3600 for hours in args.hours},
+        "output": args.output,
+        "layout": args.layout,
+        "snmp_duration": args.snmp_duration,
+        "snmp_period": args.snmp_period
+    }
+    if 'kwapi' in backends:
+        options["kwapi_port"] = start_http_server(answer_kwapi).server_address[1]
+    if 'omegawatt' in backends:
+        LOGGER.warning("Generating the wattmetre logs...")
+        files = create_wattmetre_files(timestamp_stop - max(args.hours) * 3600, timestamp_stop,
+                                       max(args.nodes), args.rate)
+        options["wattmetre_port"] = start_http_server(get_file_answer(files)).server_address[1]
+    if 'snmp' in backends:
+        options["snmp_port"] = start_snmp_agent()
+
+    # A new process by case, so the peak RSS is the one of the case
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for backend in backends:
+        for nodes in args.nodes:
+            for hours in (args.hours if backend != 'snmp' else [None]):
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_case, (backend, nodes, hours, options))
+                results.append(result)
+                print("%-9s %4d nodes %4s h  %8.2f s  %10d docs  %10.1f docs/s  "
+                      "%5d requests  p50 %s ms  p95 %s ms  RSS %.1f MB" % (
+                          backend, nodes, hours if hours is not None else "-", result["seconds"],
+                          result["documents"], result["documents_per_s"], result["requests"],
+                          result["latency_p50_ms"], result["latency_p95_ms"], result["peak_rss_mb"]))
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            LOGGER.error("Regression: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,698 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Bulk-writer, shared by all the sensors to write their output
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import logging
+import os
+import sys
+import time
+import pymongo
+import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_QUEUE_SIZE = 10000
+# Seconds waited after a failed write, doubled up to MAX_RETRY_DELAY
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+DEFAULT_BUCKET_SIZE = 60
+SERVER_SELECTION_TIMEOUT_MS = 5000
+DUPLICATE_KEY_ERROR = 11000
+
+LAYOUTS = ('document', 'bucket', 'timeseries')
+QUEUE_POLICIES = ('drop-oldest', 'drop-newest', 'block')
+
+# One client, so one connection pool, by MongoDB uri
+_CLIENTS = {}
+
+
+def connect_mongodb(mongodb_uri, mongodb_db, mongodb_collection):
+    """
+    Return the collection to write the output
+    :param mongodb_uri: MongoDB output uri
+    :param mongodb_db: MongoDB output database
+    :param mongodb_collection: MongoDB output collection
+    :return: MongoDB collection
+    """
+    if mongodb_uri not in _CLIENTS:
+        mongo_client = pymongo.MongoClient(mongodb_uri,
+                                           serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS)
+
+        # Check if it work
+        try:
+            mongo_client.admin.command('ismaster')
+        except pymongo.errors.ServerSelectionTimeoutError:
+            LOGGER.error("MongoDB error.")
+            sys.exit(-1)
+        _CLIENTS[mongodb_uri] = mongo_client
+
+    return _CLIENTS[mongodb_uri][mongodb_db][mongodb_collection]
+
+
+def create_data(timestamp, sensor, power, node, **fields):
+    """
+    Create the Dict with data
+    :param timestamp: Timestamp
+    :param sensor: Sensor name
+    :param power: Power value
+    :param node: Node name
+    :param fields: Other fields of the sensor (e.g. latency)
+    :return: Dict data
+    """
+    data = {
+        "timestamp": timestamp,
+        "sensor": sensor,
+        "power": power,
+        "node": node
+    }
+    data.update(fields)
+    return data
+
+
+def flush_rollups(rollups):
+    """
+    Write the pending rollups of a writer, kept pending on error
+    :param rollups: rollup.Rollups or None
+    """
+    if rollups is None:
+        return
+    try:
+        rollups.flush()
+    except pymongo.errors.PyMongoError as error:
+        LOGGER.error("Rollups not written: %s", error)
+
+
+class BulkWriter:
+    """
+    Buffer documents and write them with insert_many(ordered=False)
+
+    The buffer is flushed when it holds batch_size documents, or when
+    flush_interval seconds went by since the last flush. The documents
+    MongoDB rejects for another reason than a duplicate key are counted in
+    rejected, so a caller does not mark them as written in the checkpoints.
+    """
+
+    metric_labels = {"layout": "document"}
+
+    def __init__(self, collection, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, rollups=None):
+        """
+        :param collection: MongoDB collection
+        :param batch_size: Maximum number of documents in one insert_many
+        :param flush_interval: Maximum number of seconds a document is buffered
+        :param rollups: rollup.Rollups given the inserted documents, None for no rollup
+        """
+        self.collection = collection
+        self.rollups = rollups
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.written = 0
+        self.skipped = 0
+        self.rejected = 0
+        self.batches = 0
+        self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def write(self, document):
+        """
+        Buffer one document, flush if needed
+        :param document: Dict data
+        """
+        self._buffer.append(document)
+        if (len(self._buffer) >= self.batch_size or
+                time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def write_many(self, documents):
+        """
+        Buffer an iterable of documents, flush every full batch
+        :param documents: Iterable of Dict data
+        """
+        for document in documents:
+            self._buffer.append(document)
+            if len(self._buffer) >= self.batch_size:
+                self.flush()
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered documents
+        :return: Number of documents written
+        """
+        self._last_flush = time.monotonic()
+        inserted = 0
+        while self._buffer:
+            batch = self._buffer[:self.batch_size]
+            del self._buffer[:self.batch_size]
+            rejected = ()
+            try:
+                with metrics.timer("write_seconds", self.metric_labels):
+                    inserted += len(self.collection.insert_many(batch, ordered=False).inserted_ids)
+            except pymongo.errors.BulkWriteError as error:
+                inserted += error.details['nInserted']
+                rejected = {write_error['index'] for write_error in error.details['writeErrors']}
+                # Documents already written by a previous run hit the unique index
+                duplicates = sum(1 for write_error in error.details['writeErrors']
+                                 if write_error['code'] == DUPLICATE_KEY_ERROR)
+                self.skipped += duplicates
+                metrics.inc("documents_skipped_total", duplicates, self.metric_labels)
+                if duplicates < len(error.details['writeErrors']):
+                    self.rejected += len(error.details['writeErrors']) - duplicates
+                    LOGGER.error("MongoDB rejected %d documents.",
+                                 len(error.details['writeErrors']) - duplicates)
+            except BaseException:
+                # Keep the batch, so a later flush (e.g. on exit) can retry it
+                self._buffer[:0] = batch
+                raise
+            self.batches += 1
+            metrics.observe("write_batch_size", len(batch), self.metric_labels, metrics.SIZE_BUCKETS)
+            if self.rollups is not None:
+                self.rollups.add(document for index, document in enumerate(batch) if index not in rejected)
+        flush_rollups(self.rollups)
+        self.written += inserted
+        metrics.inc("documents_written_total", inserted, self.metric_labels)
+        return inserted
+
+    def close(self):
+        """
+        Flush the remaining documents and report what was written
+        :return: Number of documents written since the creation
+        """
+        self.flush()
+        LOGGER.warning("%d documents written in %d batches, %d already there.",
+                       self.written, self.batches, self.skipped)
+        return self.written
+
+
+class BucketWriter:
+    """
+    Group the samples in one document by (node, sensor, bucket_size seconds)
+
+    A bucket holds the arrays of its timestamps, powers and other fields,
+    with their min, max, sum and count. It is written with an upsert that
+    appends to the arrays, so a bucket flushed in several parts is still
+    one document. The timestamps already in a bucket are not appended
+    again, so a range written twice (e.g. the rest of an interrupted
+    backfill) is only kept once. Same interface as BulkWriter, written and
+    rejected count samples.
+    """
+
+    metric_labels = {"layout": "bucket"}
+
+    def __init__(self, collection, bucket_size=DEFAULT_BUCKET_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, rollups=None):
+        """
+        :param collection: MongoDB collection, with the index of create_bucket_index
+        :param bucket_size: Seconds covered by one document
+        :param batch_size: Maximum number of buffered samples
+        :param flush_interval: Maximum number of seconds a sample is buffered
+        :param rollups: rollup.Rollups given the written samples, None for no rollup
+        """
+        self.collection = collection
+        self.rollups = rollups
+        self.bucket_size = int(bucket_size)
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.written = 0
+        self.skipped = 0
+        self.rejected = 0
+        self.batches = 0
+        self._buckets = collections.OrderedDict()
+        self._samples = 0
+        self._last_flush = time.monotonic()
+
+    def _add(self, document):
+        timestamp = document["timestamp"]
+        start = int(timestamp // self.bucket_size * self.bucket_size)
+        key = (document["node"], document["sensor"], start)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = collections.OrderedDict((("timestamps", []), ("power", [])))
+        bucket["timestamps"].append(timestamp)
+        for field, value in document.items():
+            if field not in ("timestamp", "node", "sensor"):
+                bucket.setdefault(field, []).append(value)
+        self._samples += 1
+
+    def write(self, document):
+        """
+        Buffer one sample, flush if needed
+        :param document: Dict data
+        """
+        self._add(document)
+        if (self._samples >= self.batch_size or
+                time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def write_many(self, documents):
+        """
+        Buffer an iterable of samples, flush every batch_size samples
+        :param documents: Iterable of Dict data
+        """
+        for document in documents:
+            self._add(document)
+            if self._samples >= self.batch_size:
+                self.flush()
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _update(self, key, bucket):
+        node, sensor, start = key
+        powers = bucket["power"]
+        return pymongo.UpdateOne(
+            {"node": node, "sensor": sensor, "start": start},
+            {
+                "$setOnInsert": {"end": start + self.bucket_size},
+                "$push": {field: {"$each": values} for field, values in bucket.items()},
+                "$min": {"min": min(powers)},
+                "$max": {"max": max(powers)},
+                "$inc": {"sum": sum(powers), "count": len(powers)}
+            },
+            upsert=True)
+
+    def _get_new_samples(self, keys):
+        """
+        Remove the samples already written from some buffered buckets
+        :param keys: List of (node, sensor, start) of buffered buckets
+        :return: OrderedDict key -> bucket of the new samples, without the empty buckets
+        """
+        starts = collections.OrderedDict()
+        for node, sensor, start in keys:
+            starts.setdefault((node, sensor), []).append(start)
+        written = {}
+        for bucket in self.collection.find(
+                {"$or": [{"node": node, "sensor": sensor, "start": {"$in": bucket_starts}}
+                         for (node, sensor), bucket_starts in starts.items()]},
+                {"_id": 0, "node": 1, "sensor": 1, "start": 1, "timestamps": 1}):
+            written[(bucket["node"], bucket["sensor"], bucket["start"])] = set(bucket["timestamps"])
+
+        buckets = collections.OrderedDict()
+        for key in keys:
+            bucket = self._buckets[key]
+            seen = written.get(key, set())
+            indexes = []
+            for index, timestamp in enumerate(bucket["timestamps"]):
+                if timestamp not in seen:
+                    seen.add(timestamp)
+                    indexes.append(index)
+            if len(indexes) == len(bucket["timestamps"]):
+                buckets[key] = bucket
+            elif indexes:
+                buckets[key] = collections.OrderedDict((field, [values[index] for index in indexes])
+                                                       for field, values in bucket.items())
+        return buckets
+
+    def flush(self):
+        """
+        Write the buffered buckets
+        :return: Number of samples written
+        """
+        self._last_flush = time.monotonic()
+        inserted = 0
+        while self._buckets:
+            keys = list(self._buckets)[:self.batch_size]
+            # On errors the buckets stay buffered, so a later flush can retry them
+            with metrics.timer("write_seconds", self.metric_labels):
+                buckets = self._get_new_samples(keys)
+                update_keys = list(buckets)
+                try:
+                    if update_keys:
+                        self.collection.bulk_write([self._update(key, buckets[key]) for key in update_keys],
+                                                   ordered=False)
+                except pymongo.errors.BulkWriteError as error:
+                    LOGGER.error("MongoDB rejected %d buckets.", len(error.details['writeErrors']))
+                    rejected = {update_keys[write_error['index']] for write_error in error.details['writeErrors']}
+                    self.rejected += sum(len(buckets[key]["timestamps"]) for key in rejected)
+                    update_keys = [key for key in update_keys if key not in rejected]
+            inserted += sum(len(buckets[key]["timestamps"]) for key in update_keys)
+            if self.rollups is not None:
+                for key in update_keys:
+                    self.rollups.add_samples(key[0], key[1], buckets[key]["timestamps"], buckets[key]["power"])
+            samples = self._samples
+            for key in keys:
+                self._samples -= len(self._buckets.pop(key)["timestamps"])
+            # Samples of a previous run, or repeated in the buffer
+            duplicates = samples - self._samples - sum(len(bucket["timestamps"]) for bucket in buckets.values())
+            self.skipped += duplicates
+            metrics.inc("documents_skipped_total", duplicates, self.metric_labels)
+            self.batches += 1
+            metrics.observe("write_batch_size", samples - self._samples, self.metric_labels,
+                            metrics.SIZE_BUCKETS)
+        flush_rollups(self.rollups)
+        self.written += inserted
+        metrics.inc("documents_written_total", inserted, self.metric_labels)
+        return inserted
+
+    def close(self):
+        """
+        Flush the remaining buckets and report what was written
+        :return: Number of samples written since the creation
+        """
+        self.flush()
+        LOGGER.warning("%d samples written in %d batches, %d already there.",
+                       self.written, self.batches, self.skipped)
+        return self.written
+
+
+def to_timeseries(document):
+    """
+    Convert a document to the measurement of a time-series collection
+    :param document: Dict data
+    :return: Dict with a date timestamp and the node and sensor in meta
+    """
+    measurement = {
+        "timestamp": datetime.datetime.fromtimestamp(document["timestamp"], datetime.timezone.utc),
+        "meta": {"node": document["node"], "sensor": document["sensor"]}
+    }
+    for field, value in document.items():
+        if field not in ("timestamp", "node", "sensor"):
+            measurement[field] = value
+    return measurement
+
+
+def get_millisecond(date):
+    """
+    :param date: Aware datetime, or naive UTC datetime read from MongoDB
+    :return: Milliseconds since the epoch, the resolution of MongoDB dates
+    """
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(round(date.timestamp() * 1000))
+
+
+class TimeSeriesWriter(BulkWriter):
+    """
+    BulkWriter to a MongoDB time-series collection (MongoDB >= 5.0)
+
+    Time-series collections have no unique index: the measurements already
+    in the collection are looked for and removed before every flush.
+    """
+
+    metric_labels = {"layout": "timeseries"}
+
+    def _drop_written(self):
+        if not self._buffer:
+            return
+        dates = [measurement["timestamp"] for measurement in self._buffer]
+        written = set()
+        for measurement in self.collection.find(
+                {"meta.node": {"$in": list({measurement["meta"]["node"] for measurement in self._buffer})},
+                 "meta.sensor": {"$in": list({measurement["meta"]["sensor"] for measurement in self._buffer})},
+                 "timestamp": {"$gte": min(dates), "$lte": max(dates)}},
+                {"_id": 0, "timestamp": 1, "meta": 1}):
+            written.add((measurement["meta"]["node"], measurement["meta"]["sensor"],
+                         get_millisecond(measurement["timestamp"])))
+        buffer = []
+        for measurement in self._buffer:
+            meta = measurement["meta"]
+            key = (meta["node"], meta["sensor"], get_millisecond(measurement["timestamp"]))
+            if key not in written:
+                written.add(key)
+                buffer.append(measurement)
+        duplicates = len(self._buffer) - len(buffer)
+        self._buffer = buffer
+        self.skipped += duplicates
+        metrics.inc("documents_skipped_total", duplicates, self.metric_labels)
+
+    def flush(self):
+        self._drop_written()
+        return super().flush()
+
+    def write(self, document):
+        super().write(to_timeseries(document))
+
+    def write_many(self, documents):
+        super().write_many(to_timeseries(document) for document in documents)
+
+
+def create_timeseries_collection(collection, bucket_size=DEFAULT_BUCKET_SIZE):
+    """
+    Create the collection as a time-series collection, if it does not exist
+    :param collection: MongoDB collection
+    :param bucket_size: Seconds between the samples of a node, for the granularity
+    :return: True if the collection is a time-series collection
+    """
+    database = collection.database
+    existing = list(database.list_collections(filter={"name": collection.name}))
+    if existing:
+        return existing[0].get("type") == "timeseries"
+
+    granularity = "seconds" if bucket_size < 60 else "minutes" if bucket_size < 3600 else "hours"
+    try:
+        database.create_collection(collection.name,
+                                   timeseries={"timeField": "timestamp",
+                                               "metaField": "meta",
+                                               "granularity": granularity})
+    except pymongo.errors.OperationFailure as error:
+        LOGGER.warning("No time-series collection: %s", error)
+        return False
+    return True
+
+
+def create_unique_index(collection):
+    """
+    Create the unique index skipping the documents already written
+    :param collection: MongoDB collection
+    """
+    try:
+        collection.create_index([("node", pymongo.ASCENDING),
+                                 ("sensor", pymongo.ASCENDING),
+                                 ("timestamp", pymongo.ASCENDING)],
+                                unique=True)
+    except pymongo.errors.OperationFailure as error:
+        # e.g. a collection already holding duplicates
+        LOGGER.warning("No unique index on %s: %s", collection.name, error)
+
+
+def create_bucket_index(collection):
+    """
+    Create the index used by the upserts of BucketWriter
+    :param collection: MongoDB collection
+    """
+    collection.create_index([("node", pymongo.ASCENDING),
+                             ("sensor", pymongo.ASCENDING),
+                             ("start", pymongo.ASCENDING)],
+                            unique=True)
+
+
+def create_writer(collection, layout='document', bucket_size=DEFAULT_BUCKET_SIZE,
+                  batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, rollups=False):
+    """
+    Return the writer of a layout, after preparing its collection
+    :param collection: MongoDB collection
+    :param layout: One of LAYOUTS, timeseries falls back to bucket on MongoDB < 5.0
+    :param bucket_size: Seconds covered by one bucket document
+    :param batch_size: Maximum number of documents in one write
+    :param flush_interval: Maximum number of seconds a document is buffered
+    :param rollups: Also keep the rollups of rollup.LEVELS up to date
+    :return: BulkWriter, BucketWriter or TimeSeriesWriter
+    """
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout " + layout)
+    if rollups:
+        from rollup import Rollups
+
+        rollups = Rollups(collection.database, collection.name)
+    else:
+        rollups = None
+    if layout == 'timeseries':
+        if create_timeseries_collection(collection, bucket_size):
+            return TimeSeriesWriter(collection, batch_size, flush_interval, rollups)
+        LOGGER.warning("Use the bucket layout in " + collection.name)
+        layout = 'bucket'
+    if layout == 'bucket':
+        create_bucket_index(collection)
+        return BucketWriter(collection, bucket_size, batch_size, flush_interval, rollups)
+    create_unique_index(collection)
+    return BulkWriter(collection, batch_size, flush_interval, rollups)
+
+
+def create_output(uri, database, collection, layout='document', bucket_size=DEFAULT_BUCKET_SIZE,
+                  batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, rollups=False):
+    """
+    Return the writer of an output uri
+    :param uri: MongoDB uri, or npy://, parquet:// or arrow:// followed by a directory
+    :param database: MongoDB database, or sub-directory of the files
+    :param collection: MongoDB collection, or sub-directory of the files
+    :param layout: One of LAYOUTS, for MongoDB
+    :param bucket_size: Seconds covered by one bucket document, for MongoDB
+    :param batch_size: Maximum number of documents in one write
+    :param flush_interval: Maximum number of seconds a document is buffered
+    :param rollups: Also keep the rollups up to date, for MongoDB
+    :return: Writer with the interface of BulkWriter
+    """
+    scheme, _, path = uri.partition("://")
+    if scheme in ('npy', 'parquet', 'arrow'):
+        import file_sink
+
+        if rollups:
+            LOGGER.warning("Rollups are only written to MongoDB.")
+        return file_sink.create_sink(scheme, os.path.join(path, database, collection),
+                                     batch_size, flush_interval)
+    return create_writer(connect_mongodb(uri, database, collection), layout, bucket_size,
+                         batch_size, flush_interval, rollups)
+
+
+class QueueWriter:
+    """
+    Bounded queue between an asyncio loop and a BulkWriter
+
+    The loop only queues documents. A task drains the queue by batches and
+    runs the BulkWriter in a dedicated thread, so a slow MongoDB never
+    blocks the loop. When the queue is full, the policy drops the oldest
+    document, drops the new one, or makes put wait for room. After a MongoDB
+    error, only the documents of the failed write are retried, after a
+    growing delay, and the queue is not drained until they are written.
+    """
+
+    def __init__(self, writer, max_size=DEFAULT_QUEUE_SIZE, policy='drop-oldest'):
+        """
+        :param writer: BulkWriter or BucketWriter
+        :param max_size: Maximum number of queued documents
+        :param policy: One of QUEUE_POLICIES
+        """
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Unknown queue policy " + policy)
+        self.writer = writer
+        self.policy = policy
+        self.dropped = 0
+        self.max_depth = 0
+        self._queue = asyncio.Queue(max_size)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._task = None
+        # Documents of a batch not taken by the writer when it failed
+        self._documents = iter(())
+        self._failed = False
+        self._retry_delay = RETRY_DELAY
+
+    def start(self):
+        """
+        Start the task draining the queue, on the current loop
+        """
+        self._task = asyncio.ensure_future(self._run())
+
+    def _drop(self):
+        self.dropped += 1
+        metrics.inc("documents_dropped_total")
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            LOGGER.warning("Write queue full, %d documents dropped.", self.dropped)
+
+    async def put(self, document):
+        """
+        Queue one document, following the policy when the queue is full
+        :param document: Dict data
+        """
+        if self._queue.full():
+            if self.policy == 'drop-newest':
+                self._drop()
+                return
+            if self.policy == 'drop-oldest':
+                self._queue.get_nowait()
+                self._drop()
+        await self._queue.put(document)
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        metrics.gauge("write_queue_depth", self._queue.qsize())
+
+    def _write_pending(self):
+        """
+        Write the documents left by a failed write, with the batch kept by the writer
+        """
+        self.writer.write_many(self._documents)
+        self.writer.flush()
+
+    async def _execute(self, function, *args):
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+        except pymongo.errors.PyMongoError as error:
+            self._failed = True
+            metrics.inc("write_errors_total")
+            LOGGER.error("MongoDB write failed, retry in %.0f s: %s", self._retry_delay, error)
+            await asyncio.sleep(self._retry_delay)
+            self._retry_delay = min(2 * self._retry_delay, MAX_RETRY_DELAY)
+        else:
+            self._failed = False
+            self._documents = iter(())
+            self._retry_delay = RETRY_DELAY
+
+    async def _write(self, batch):
+        # An empty batch only flushes on time
+        self._documents = iter(batch)
+        await self._execute(self.writer.write_many, self._documents)
+
+    async def _run(self):
+        while True:
+            if self._failed:
+                # Nothing more is taken from the queue, so its size and policy bound the memory
+                await self._execute(self._write_pending)
+                continue
+            try:
+                document = await asyncio.wait_for(self._queue.get(), self.writer.flush_interval)
+            except asyncio.TimeoutError:
+                await self._write([])
+                continue
+            batch = [document]
+            while not self._queue.empty() and len(batch) < self.writer.batch_size:
+                batch.append(self._queue.get_nowait())
+            metrics.gauge("write_queue_depth", self._queue.qsize())
+            await self._write(batch)
+
+    def stats(self):
+        """
+        :return: Dict of the queue counters
+        """
+        return {
+            "depth": self._queue.qsize(),
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "written": self.writer.written
+        }
+
+    async def close(self):
+        """
+        Write the queued documents, then close the BulkWriter
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception as error:
+                LOGGER.error("Write queue stopped: %s", error)
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        loop = asyncio.get_event_loop()
+        try:
+            # A batch given to the thread is still written before the rest, and
+            # the documents it did not take are chained when this write runs
+            await loop.run_in_executor(self._executor, self.writer.write_many,
+                                       itertools.chain(self._documents, batch))
+            await loop.run_in_executor(self._executor, self.writer.close)
+        finally:
+            self._executor.shutdown()
+            LOGGER.warning("Write queue: %d documents dropped, maximum depth %d.", self.dropped, self.max_depth)
@@ -0,0 +1,230 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Checkpoint, ranges of time already written by the backfills
+
+For every output, sensor and node, the file keeps the merged ranges that
+were collected and flushed. A backfill only fetches the missing parts of
+its window, for the nodes missing them, so running it again over the same
+window or with more nodes transfers only the new data.
+"""
+
+import bisect
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_FILE = os.path.join(os.path.expanduser("~"), ".cache", "g5k-energy", "checkpoints.json")
+# Data more recent than this may still be completed by the sources
+DEFAULT_DELAY = 300
+
+# Jobs of one process save the same file from several threads
+_SAVE_LOCK = threading.Lock()
+
+
+def get_output_id(uri, database, collection):
+    """
+    :param uri: Output uri, its credentials are not kept
+    :param database: Output database
+    :param collection: Output collection
+    :return: Key of the output in the checkpoints
+    """
+    return re.sub(r"://[^@/]*@", "://", uri) + "/" + database + "/" + collection
+
+
+def merge_ranges(ranges):
+    """
+    :param ranges: Iterable of [start, stop)
+    :return: Sorted list of disjoint [start, stop], touching ranges merged
+    """
+    merged = []
+    for start, stop in sorted(ranges):
+        if stop <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def subtract_ranges(timestamp_start, timestamp_stop, covered):
+    """
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param covered: Sorted disjoint ranges from merge_ranges
+    :return: List of the (start, stop) of the window out of the covered ranges
+    """
+    missing = []
+    start = timestamp_start
+    for covered_start, covered_stop in covered:
+        if covered_stop <= start:
+            continue
+        if covered_start >= timestamp_stop:
+            break
+        if covered_start > start:
+            missing.append((start, covered_start))
+        start = max(start, covered_stop)
+    if start < timestamp_stop:
+        missing.append((start, timestamp_stop))
+    return missing
+
+
+def split_ranges(ranges, size):
+    """
+    Split ranges at the multiples of size, so the parts align on hours or days
+    :param ranges: List of (start, stop), or of (start, stop, nodes) from Checkpoints.plan
+    :param size: Seconds
+    :return: List of (start, stop), with the nodes of their range if given
+    """
+    parts = []
+    for start, stop, *nodes in ranges:
+        while start < stop:
+            part_stop = min(stop, (start // size + 1) * size)
+            parts.append((start, part_stop) + tuple(nodes))
+            start = part_stop
+    return parts
+
+
+class Checkpoints:
+    """
+    JSON file holding {output id: {sensor: {node: [[start, stop], ...]}}}
+    """
+
+    def __init__(self, output_id, path=DEFAULT_CHECKPOINT_FILE, delay=DEFAULT_DELAY):
+        """
+        :param output_id: Key of the output, from get_output_id
+        :param path: JSON file of the checkpoints
+        :param delay: Seconds before now that are never marked as written
+        """
+        self.output_id = output_id
+        self.path = path
+        self.delay = delay
+        self.ranges = self._load().get(output_id, {})
+
+    def _load(self):
+        try:
+            with open(self.path) as checkpoints:
+                return json.load(checkpoints)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            LOGGER.warning("Ignore the corrupted checkpoints " + self.path)
+            return {}
+
+    def get_ranges(self, sensor, node):
+        """
+        :param sensor: Sensor name
+        :param node: Node name
+        :return: Sorted list of the written [start, stop]
+        """
+        return self.ranges.get(sensor, {}).get(node, [])
+
+    def get_last(self, sensor, node):
+        """
+        :param sensor: Sensor name
+        :param node: Node name
+        :return: Last written timestamp (excluded), None if nothing was written
+        """
+        ranges = self.get_ranges(sensor, node)
+        return ranges[-1][1] if ranges else None
+
+    def plan(self, sensor, nodes, timestamp_start, timestamp_stop):
+        """
+        Return the parts of a window missing for some nodes, with these nodes
+
+        A node already written on a part is not in its nodes, so fetching the
+        plan never writes again what a node has. The window ends at
+        now - delay at the latest, so everything written from the plan can
+        be marked.
+        :param sensor: Sensor name
+        :param nodes: List of node names
+        :param timestamp_start: Timestamp to begin
+        :param timestamp_stop: Timestamp to stop (excluded)
+        :return: Sorted list of (start, stop, list of the nodes missing the whole range)
+        """
+        timestamp_stop = min(timestamp_stop, int(time.time() - self.delay))
+        missing = {node: subtract_ranges(timestamp_start, timestamp_stop, self.get_ranges(sensor, node))
+                   for node in nodes}
+        bounds = sorted({bound for ranges in missing.values() for missing_range in ranges for bound in missing_range})
+        # Nodes missing each range between two consecutive bounds
+        range_nodes = [[] for _ in bounds]
+        for node in nodes:
+            for start, stop in missing[node]:
+                for index in range(bisect.bisect_left(bounds, start), bisect.bisect_left(bounds, stop)):
+                    range_nodes[index].append(node)
+        plan = []
+        for start, stop, missing_nodes in zip(bounds, bounds[1:], range_nodes):
+            if not missing_nodes:
+                continue
+            if plan and plan[-1][1] == start and plan[-1][2] == missing_nodes:
+                plan[-1] = (plan[-1][0], stop, missing_nodes)
+            else:
+                plan.append((start, stop, missing_nodes))
+        return plan
+
+    def add(self, sensor, nodes, timestamp_start, timestamp_stop):
+        """
+        Mark a range as written for some nodes, and save the file
+        :param sensor: Sensor name
+        :param nodes: List of node names
+        :param timestamp_start: Timestamp to begin
+        :param timestamp_stop: Timestamp to stop (excluded), capped to now - delay
+        """
+        self.add_ranges(sensor, {node: [(timestamp_start, timestamp_stop)] for node in nodes})
+
+    def add_ranges(self, sensor, node_ranges):
+        """
+        Mark ranges as written, node by node, and save the file once
+        :param sensor: Sensor name
+        :param node_ranges: Dict node name -> list of (start, stop (excluded)), capped to now - delay
+        """
+        timestamp_max = int(time.time() - self.delay)
+        changed = False
+        for node, ranges in node_ranges.items():
+            ranges = [[start, min(stop, timestamp_max)] for start, stop in ranges if min(stop, timestamp_max) > start]
+            if ranges:
+                sensor_ranges = self.ranges.setdefault(sensor, {})
+                sensor_ranges[node] = merge_ranges(sensor_ranges.get(node, []) + ranges)
+                changed = True
+        if changed:
+            self.save()
+
+    def save(self):
+        """
+        Write the checkpoints, merged with the ranges written meanwhile
+        """
+        with _SAVE_LOCK:
+            data = self._load()
+            output = data.setdefault(self.output_id, {})
+            for sensor, sensor_ranges in self.ranges.items():
+                for node, ranges in sensor_ranges.items():
+                    output.setdefault(sensor, {})[node] = merge_ranges(output.get(sensor, {}).get(node, []) + ranges)
+            self.ranges = output
+
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(handle, 'w') as checkpoints:
+                json.dump(data, checkpoints, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,351 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Collector, one process running the jobs of all the sensors
+
+The jobs of a JSON config run on one event loop and share the MongoDB
+client, the Kwapi HTTP session and the SNMP engine of each PDU. The module
+of a backend is only imported when a job uses it.
+
+    python collector.py config.json
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import metrics
+from bulk_writer import QueueWriter, create_output, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_QUEUE_SIZE, DEFAULT_BUCKET_SIZE
+from checkpoint import Checkpoints, get_output_id, DEFAULT_CHECKPOINT_FILE
+from node_metadata import NodeMetadata, DEFAULT_CACHE_FILE, DEFAULT_TTL
+
+LOGGER = logging.getLogger()
+LOGGER.addHandler(logging.StreamHandler())
+
+BACKENDS = ('kwapi', 'omegawatt', 'snmp')
+# Threads of the metadata lookups of the SNMP jobs
+METADATA_WORKERS = 2
+
+##############################################################################
+# Useful functions
+##############################################################################
+
+
+def load_config(path):
+    """
+    Read and check the config
+    :param path: JSON file
+    :return: Dict config
+    """
+    with open(path) as config_file:
+        config = json.load(config_file)
+
+    if 'mongodb' not in config:
+        raise ValueError("No mongodb section in " + path)
+    for index, job in enumerate(config.get('jobs', [])):
+        if job.get('backend') not in BACKENDS:
+            raise ValueError("Job %d: unknown backend %s" % (index, job.get('backend')))
+        if not job.get('nodes') or 'city' not in job or 'collection' not in job:
+            raise ValueError("Job %d: city, nodes and collection are required" % index)
+        if job['backend'] != 'snmp' and 'from' not in job and not job.get('follow', False):
+            raise ValueError("Job %d: from is required by %s" % (index, job['backend']))
+        if job['backend'] == 'kwapi' and 'g5k' not in config:
+            raise ValueError("Job %d: no g5k section for kwapi" % index)
+    return config
+
+
+def get_job_name(job):
+    """
+    :param job: Dict job of the config
+    :return: Name of the job for the logs
+    """
+    return job['backend'] + "@" + job['city'] + ":" + ",".join(job['nodes'])
+
+
+class Collector:
+    """
+    Shared state of the jobs
+    """
+
+    def __init__(self, config):
+        """
+        :param config: Dict config from load_config
+        """
+        self.config = config
+        metadata_config = config.get('metadata', {})
+        cache_file = metadata_config.get('cache', DEFAULT_CACHE_FILE)
+        if cache_file is not None:
+            cache_file = os.path.expanduser(cache_file)
+        self.metadata = NodeMetadata(cache_file,
+                                     metadata_config.get('ttl', DEFAULT_TTL))
+        self.stop = threading.Event()
+        # One thread by Kwapi or Omegawatt job, a following job never ends: with
+        # the default executor of the loop, they would wait for each other
+        blocking_jobs = sum(1 for job in config.get('jobs', []) if job['backend'] != 'snmp')
+        self._job_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, blocking_jobs))
+        self._metadata_executor = concurrent.futures.ThreadPoolExecutor(max_workers=METADATA_WORKERS)
+        self._kwapi_session = None
+        self._archive_cache = None
+        self._pdu_sessions = {}
+
+    def get_output(self, job):
+        """
+        :param job: Dict job of the config
+        :return: Writer on the collection of the job, with the shared client
+        """
+        mongodb = self.config['mongodb']
+        return create_output(mongodb['uri'], mongodb['db'], job['collection'],
+                             mongodb.get('layout', 'document'),
+                             mongodb.get('bucket_size', DEFAULT_BUCKET_SIZE),
+                             mongodb.get('batch_size', DEFAULT_BATCH_SIZE),
+                             mongodb.get('flush_interval', DEFAULT_FLUSH_INTERVAL),
+                             mongodb.get('rollups', False))
+
+    def get_checkpoints(self, job):
+        """
+        :param job: Dict job of the config
+        :return: Checkpoints of the output of the job, None if the job sets checkpoints to false
+        """
+        if not job.get('checkpoints', True):
+            return None
+        mongodb = self.config['mongodb']
+        return Checkpoints(get_output_id(mongodb['uri'], mongodb['db'], job['collection']),
+                           os.path.expanduser(self.config.get('checkpoints', DEFAULT_CHECKPOINT_FILE)))
+
+    def get_kwapi_session(self):
+        """
+        :return: HTTP session of Kwapi, shared by all the kwapi jobs
+        """
+        import kwapi
+
+        if self._kwapi_session is None:
+            g5k = self.config['g5k']
+            self._kwapi_session = kwapi.create_session((g5k['login'], g5k['pass']),
+                                                       g5k.get('pool_size', kwapi.DEFAULT_WORKERS))
+        return self._kwapi_session
+
+    def get_archive_cache(self):
+        """
+        :return: ArchiveCache shared by all the omegawatt jobs, None without cache section
+        """
+        if self._archive_cache is None and 'cache' in self.config:
+            from archive_cache import ArchiveCache, DEFAULT_MAX_SIZE
+
+            cache = self.config['cache']
+            self._archive_cache = ArchiveCache(os.path.expanduser(cache['dir']), cache.get('size', DEFAULT_MAX_SIZE))
+        return self._archive_cache
+
+    def run_kwapi(self, job):
+        """
+        Collect the Kwapi series of a job, or follow them, in a thread of its own
+        :param job: Dict job of the config
+        """
+        import kwapi
+
+        session = self.get_kwapi_session()
+        missing = kwapi.get_unavailable_nodes(session, job['city'], job['nodes'])
+        for node_name in missing:
+            LOGGER.error("Kwapi-sensor not available for the node " + node_name)
+        nodes = [node_name for node_name in job['nodes'] if node_name not in missing]
+
+        output = self.get_output(job)
+        try:
+            if job.get('follow', False):
+                kwapi.follow(session, output, job['city'], nodes, job.get('from'),
+                             job.get('period', kwapi.DEFAULT_PERIOD),
+                             job.get('max_period', kwapi.MAX_PERIOD),
+                             job.get('chunk_size', kwapi.DEFAULT_CHUNK_SIZE),
+                             self.stop,
+                             self.get_checkpoints(job),
+                             job.get('stream_json', False))
+            else:
+                kwapi.collect(session, output, job['city'], nodes,
+                              job['from'], job.get('to', time.time()),
+                              job.get('chunk_size', kwapi.DEFAULT_CHUNK_SIZE),
+                              job.get('workers', kwapi.DEFAULT_WORKERS),
+                              self.stop,
+                              self.get_checkpoints(job),
+                              job.get('stream_json', False))
+        finally:
+            output.close()
+
+    def run_omegawatt(self, job):
+        """
+        Collect the wattmetre logs of a job, or follow them, in a thread of its own
+        :param job: Dict job of the config
+        """
+        import wattmetre
+
+        missing = wattmetre.get_unavailable_nodes(job['city'], job['nodes'])
+        for node_name in missing:
+            LOGGER.error("Omegawatt-sensor not available for the node " + node_name)
+        nodes = [node_name for node_name in job['nodes'] if node_name not in missing]
+
+        timestamp_stop = job.get('to', time.time())
+        new_collector = functools.partial(wattmetre.create_collector,
+                                          raw=job.get('raw', False),
+                                          window=job.get('window'),
+                                          aggregator=job.get('aggregator', 'mean'))
+        output = self.get_output(job)
+        try:
+            if job.get('follow', False):
+                wattmetre.follow(output, self.metadata, job['city'], nodes, new_collector,
+                                 job.get('window') or 1,
+                                 job.get('period', wattmetre.DEFAULT_PERIOD),
+                                 self.stop)
+            else:
+                wattmetre.collect(output, self.metadata, job['city'], nodes,
+                                  job['from'], timestamp_stop, new_collector,
+                                  job.get('workers', wattmetre.DEFAULT_WORKERS),
+                                  self.get_archive_cache(),
+                                  job.get('cache_arrays', False),
+                                  self.stop,
+                                  self.get_checkpoints(job))
+        finally:
+            output.close()
+
+    async def run_snmp(self, job):
+        """
+        Poll the PDU of a job until the end of the collector
+        :param job: Dict job of the config
+        """
+        import pdu_snmp
+
+        loop = asyncio.get_event_loop()
+        # The metadata may be fetched from the reference API
+        missing = await loop.run_in_executor(self._metadata_executor, pdu_snmp.get_unavailable_nodes,
+                                             self.metadata, job['nodes'])
+        for node_name in missing:
+            LOGGER.error("SNMP-sensor not available for the node " + node_name)
+        nodes = [node_name for node_name in job['nodes'] if node_name not in missing]
+        pdus_infos, nodes_outlets = await loop.run_in_executor(self._metadata_executor, pdu_snmp.get_pdu_outlets,
+                                                               self.metadata, job['city'], nodes)
+
+        output = QueueWriter(self.get_output(job),
+                             job.get('queue_size', DEFAULT_QUEUE_SIZE),
+                             job.get('queue_policy', 'drop-oldest'))
+        output.start()
+        poller = pdu_snmp.SnmpPoller(pdus_infos, nodes_outlets, output, self._pdu_sessions)
+
+        async def poll():
+            if self.stop.is_set():
+                return False
+            return await poller.poll()
+
+        try:
+            await pdu_snmp.run_periodic(job.get('period', pdu_snmp.DEFAULT_PERIOD), poll)
+        finally:
+            await output.close()
+
+    async def run_job(self, job):
+        """
+        Run a job, logging its failure without stopping the other jobs
+        :param job: Dict job of the config
+        """
+        name = get_job_name(job)
+        LOGGER.warning("Start " + name)
+        try:
+            if job['backend'] == 'snmp':
+                await self.run_snmp(job)
+            else:
+                run = self.run_kwapi if job['backend'] == 'kwapi' else self.run_omegawatt
+                await asyncio.get_event_loop().run_in_executor(self._job_executor, run, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            LOGGER.exception("Job " + name + " failed.")
+        else:
+            LOGGER.warning("End " + name)
+
+    async def run(self):
+        """
+        Run all the jobs of the config, until they end or the collector stops
+        """
+        metrics_config = self.config.get('metrics', {})
+        if 'port' in metrics_config:
+            metrics.start_http_server(metrics_config['port'])
+        try:
+            await asyncio.gather(*[self.run_job(job) for job in self.config.get('jobs', [])])
+        finally:
+            self._job_executor.shutdown(wait=False)
+            self._metadata_executor.shutdown(wait=False)
+            for session in self._pdu_sessions.values():
+                session.close()
+            self._pdu_sessions.clear()
+            self.metadata.save()
+            summary = metrics_config.get('summary')
+            metrics.write_summary(os.path.expanduser(summary) if summary else None)
+
+##############################################################################
+# Parser
+##############################################################################
+
+
+def arg_parser_init():
+    """
+    Initialize argument parser
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the jobs of all the sensors in one process.")
+    parser.add_argument("config", help="JSON config listing the jobs")
+    return parser
+
+##############################################################################
+# Main
+##############################################################################
+
+
+def main():
+    """
+    Main function of the Collector
+    """
+    args = arg_parser_init().parse_args()
+    LOGGER.warning("/!\\ Make sure you are in the G5K network /!\\")
+
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as error:
+        LOGGER.error(str(error))
+        sys.exit(-1)
+
+    collector = Collector(config)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # Signal handling: the running jobs end at their next chunk, hour or poll
+    def term_handler():
+        LOGGER.warning("Ended by user.")
+        collector.stop.set()
+
+    loop.add_signal_handler(signal.SIGTERM, term_handler)
+    loop.add_signal_handler(signal.SIGINT, term_handler)
+
+    try:
+        loop.run_until_complete(collector.run())
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
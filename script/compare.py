@@ -0,0 +1,287 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Compare, align the series of a node from several sensors
+
+The window is read window by window from every sensor. Each sample of the
+reference sensor is joined with the nearest sample of another sensor, if
+closer than a tolerance, and the statistics of the differences (bias,
+RMSE, MAE) are accumulated. Both series are also averaged on a regular
+grid to find the lag maximizing their cross-correlation, and the part of
+the grid each sensor covers. Only one window of each series is in memory.
+
+    python compare.py mongodb_uri mongodb_db node_name timestamp_start timestamp_stop \\
+        collection/sensor collection/sensor [collection/sensor...]
+"""
+
+import argparse
+import json
+import logging
+import sys
+import numpy as np
+from bulk_writer import LAYOUTS
+from series_reader import create_reader
+
+LOGGER = logging.getLogger()
+LOGGER.addHandler(logging.StreamHandler())
+
+DEFAULT_TOLERANCE = 0.5
+DEFAULT_MAX_LAG = 60
+DEFAULT_RESOLUTION = 1.0
+DEFAULT_WINDOW = 24 * 3600
+
+##############################################################################
+# Useful functions
+##############################################################################
+
+
+def match_nearest(timestamps, other_timestamps, tolerance):
+    """
+    Join every timestamp with the nearest other timestamp
+    :param timestamps: Sorted float64 timestamps
+    :param other_timestamps: Sorted float64 timestamps
+    :param tolerance: Maximum distance of a match, in seconds
+    :return: (bool mask of the matched timestamps, index of their match in other_timestamps)
+    """
+    if not len(other_timestamps):
+        return np.zeros(len(timestamps), dtype=bool), np.empty(0, dtype=np.int64)
+    after = np.clip(np.searchsorted(other_timestamps, timestamps), 1, len(other_timestamps) - 1)
+    before = after - 1
+    if len(other_timestamps) == 1:
+        after = before = np.zeros(len(timestamps), dtype=np.int64)
+    closer_after = np.abs(other_timestamps[after] - timestamps) < np.abs(timestamps - other_timestamps[before])
+    nearest = np.where(closer_after, after, before)
+    matched = np.abs(other_timestamps[nearest] - timestamps) <= tolerance
+    return matched, nearest[matched]
+
+
+def get_grid(timestamps, values, timestamp_start, length, resolution):
+    """
+    Average a series on regular bins, a sample going to the nearest bin
+    :param timestamps: float64 timestamps
+    :param values: float64 values
+    :param timestamp_start: Center of the first bin
+    :param length: Number of bins
+    :param resolution: Size of a bin, in seconds
+    :return: float64 means, NaN for the bins without sample
+    """
+    bins = np.round((timestamps - timestamp_start) / resolution).astype(np.int64)
+    mask = (bins >= 0) & (bins < length) & ~np.isnan(values)
+    counts = np.bincount(bins[mask], minlength=length)
+    sums = np.bincount(bins[mask], weights=values[mask], minlength=length)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+class Comparison:
+    """
+    Statistics of a sensor against the reference sensor, accumulated window by window
+    """
+
+    def __init__(self, tolerance=DEFAULT_TOLERANCE, max_lag=DEFAULT_MAX_LAG, resolution=DEFAULT_RESOLUTION):
+        """
+        :param tolerance: Maximum distance between two joined samples, in seconds
+        :param max_lag: Maximum lag looked for, in seconds
+        :param resolution: Size of the bins of the cross-correlation and coverage, in seconds
+        """
+        self.tolerance = float(tolerance)
+        self.resolution = float(resolution)
+        self.max_shift = int(round(max_lag / self.resolution))
+        self.samples = 0
+        self.other_samples = 0
+        self.matched = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.sum_abs = 0.0
+        self.bins = 0
+        self.covered = 0
+        self.other_covered = 0
+        self.both_covered = 0
+        # Cross-correlation products for the shifts -max_shift..max_shift
+        self.products = np.zeros(2 * self.max_shift + 1)
+        self.energy = 0.0
+        self.other_energy = 0.0
+
+    def add(self, timestamp_start, timestamp_stop, timestamps, values, other_timestamps, other_values):
+        """
+        Add a window
+        :param timestamp_start: Timestamp where the window begins
+        :param timestamp_stop: Timestamp where the window ends (excluded)
+        :param timestamps: Sorted float64 timestamps of the reference, in the window
+        :param values: float64 values of the reference
+        :param other_timestamps: Sorted float64 timestamps of the other sensor, in the
+                                 window widened by the tolerance
+        :param other_values: float64 values of the other sensor
+        """
+        in_window = (other_timestamps >= timestamp_start) & (other_timestamps < timestamp_stop)
+        self.samples += len(timestamps)
+        self.other_samples += int(np.count_nonzero(in_window))
+
+        matched, nearest = match_nearest(timestamps, other_timestamps, self.tolerance)
+        differences = other_values[nearest] - values[matched]
+        self.matched += len(differences)
+        self.sum += float(np.sum(differences))
+        self.sum_squares += float(np.dot(differences, differences))
+        self.sum_abs += float(np.sum(np.abs(differences)))
+
+        length = int(np.ceil((timestamp_stop - timestamp_start) / self.resolution))
+        grid = get_grid(timestamps, values, timestamp_start, length, self.resolution)
+        other_grid = get_grid(other_timestamps[in_window], other_values[in_window],
+                              timestamp_start, length, self.resolution)
+        filled, other_filled = ~np.isnan(grid), ~np.isnan(other_grid)
+        self.bins += length
+        self.covered += int(np.count_nonzero(filled))
+        self.other_covered += int(np.count_nonzero(other_filled))
+        self.both_covered += int(np.count_nonzero(filled & other_filled))
+        if np.any(filled) and np.any(other_filled):
+            self._correlate(np.where(filled, grid - np.mean(grid[filled]), 0.0),
+                            np.where(other_filled, other_grid - np.mean(other_grid[other_filled]), 0.0))
+
+    def _correlate(self, centered, other_centered):
+        # products[max_shift + k] = sum over t of centered[t] * other_centered[t + k], by FFT
+        size = 1 << int(np.ceil(np.log2(len(centered) + self.max_shift + 1)))
+        spectrum = np.conj(np.fft.rfft(centered, size)) * np.fft.rfft(other_centered, size)
+        correlation = np.fft.irfft(spectrum, size)
+        self.products += np.concatenate((correlation[size - self.max_shift:], correlation[:self.max_shift + 1]))
+        self.energy += float(np.dot(centered, centered))
+        self.other_energy += float(np.dot(other_centered, other_centered))
+
+    def result(self):
+        """
+        :return: Dict of the statistics, None where there is no data
+        """
+        normalization = np.sqrt(self.energy * self.other_energy)
+        best = int(np.argmax(self.products)) if normalization > 0 else None
+        shift = None
+        if best is not None:
+            shift = float(best - self.max_shift)
+            if 0 < best < len(self.products) - 1:
+                # Vertex of the parabola through the peak and its neighbours
+                left, peak, right = self.products[best - 1:best + 2]
+                curvature = left - 2 * peak + right
+                if curvature < 0:
+                    shift += 0.5 * (left - right) / curvature
+        return {
+            "samples": self.samples,
+            "other_samples": self.other_samples,
+            "matched": self.matched,
+            "matched_ratio": self.matched / self.samples if self.samples else None,
+            # Other sensor minus reference
+            "bias": self.sum / self.matched if self.matched else None,
+            "rmse": float(np.sqrt(self.sum_squares / self.matched)) if self.matched else None,
+            "mae": self.sum_abs / self.matched if self.matched else None,
+            "coverage": self.covered / self.bins if self.bins else None,
+            "other_coverage": self.other_covered / self.bins if self.bins else None,
+            "both_coverage": self.both_covered / self.bins if self.bins else None,
+            # Positive when the other sensor is late: other(t + lag) ~ reference(t)
+            "lag": shift * self.resolution if shift is not None else None,
+            "correlation": float(self.products[best] / normalization) if best is not None else None
+        }
+
+
+def compare(readers, timestamp_start, timestamp_stop, tolerance=DEFAULT_TOLERANCE, max_lag=DEFAULT_MAX_LAG,
+            resolution=DEFAULT_RESOLUTION, window=DEFAULT_WINDOW):
+    """
+    Compare the series of several sensors to the first one
+    :param readers: List of series_reader readers, the reference first
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param tolerance: Maximum distance between two joined samples, in seconds
+    :param max_lag: Maximum lag looked for, in seconds
+    :param resolution: Size of the bins of the cross-correlation and coverage, in seconds
+    :param window: Number of seconds read at once
+    :return: List of Dict statistics, one by reader after the first
+    """
+    comparisons = [Comparison(tolerance, max_lag, resolution) for _ in readers[1:]]
+    timestamp_start, timestamp_stop = int(timestamp_start), int(timestamp_stop)
+    for start in range(timestamp_start, timestamp_stop, window):
+        stop = min(start + window, timestamp_stop)
+        timestamps, values = readers[0].read(start, stop)
+        for reader, comparison in zip(readers[1:], comparisons):
+            # The samples of the reference at the edges can match across the window bounds
+            comparison.add(start, stop, timestamps, values, *reader.read(start - tolerance, stop + tolerance))
+    return [comparison.result() for comparison in comparisons]
+
+##############################################################################
+# Parser
+##############################################################################
+
+
+def arg_parser_init():
+    """
+    Initialize argument parser
+    """
+    parser = argparse.ArgumentParser(
+        description="Compare the series of a node from several sensors.")
+
+    # Input
+    parser.add_argument("mongodb_uri", help="MongoDB uri, or npy://, parquet:// or arrow:// and a directory")
+    parser.add_argument("mongodb_db", help="MongoDB database, or sub-directory")
+    parser.add_argument("--layout", choices=LAYOUTS, default='document',
+                        help="Layout of the MongoDB collections")
+
+    # Series
+    parser.add_argument("node_name", help="Node name to compare")
+    parser.add_argument("timestamp_start", type=int, help="Timestamp where begin the series")
+    parser.add_argument("timestamp_stop", type=int, help="Timestamp where end the series")
+    parser.add_argument("series", nargs="+",
+                        help="collection/sensor of each series (e.g. omegawatt/omegawatt-sensor), "
+                             "the first one is the reference")
+
+    # Comparison
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Maximum distance between two joined samples, in seconds")
+    parser.add_argument("--max-lag", type=float, default=DEFAULT_MAX_LAG,
+                        help="Maximum lag looked for by the cross-correlation, in seconds")
+    parser.add_argument("--resolution", type=float, default=DEFAULT_RESOLUTION,
+                        help="Bins of the cross-correlation and of the coverage, in seconds")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW,
+                        help="Number of seconds read at once")
+
+    return parser
+
+##############################################################################
+# Main
+##############################################################################
+
+
+def main():
+    """
+    Main function of the Compare script
+    """
+    args = arg_parser_init().parse_args()
+    if len(args.series) < 2 or not all("/" in series for series in args.series):
+        LOGGER.error("Give at least two series as collection/sensor.")
+        sys.exit(-1)
+
+    readers = []
+    for series in args.series:
+        collection, sensor = series.split("/", 1)
+        readers.append(create_reader(args.mongodb_uri, args.mongodb_db, collection, args.node_name, sensor,
+                                     args.layout))
+
+    results = compare(readers, args.timestamp_start, args.timestamp_stop,
+                      args.tolerance, args.max_lag, args.resolution, args.window)
+    report = {"node": args.node_name, "from": args.timestamp_start, "to": args.timestamp_stop,
+              "reference": args.series[0], "comparisons": {}}
+    for series, result in zip(args.series[1:], results):
+        report["comparisons"][series] = result
+    print(json.dumps(report, indent=1))
+
+
+if __name__ == "__main__":
+    main()
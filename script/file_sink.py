@@ -0,0 +1,311 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module File-sink, columnar files as output instead of MongoDB
+
+The samples of every (node, sensor) go to their own files, appended by
+batches, with a float64 column by field (timestamp, power, latency...):
+
+- npy: directory/<node>.<sensor>.npy, one structured array grown in place,
+  loaded without copy with load_npy (np.load with mmap_mode)
+- parquet: directory/<node>.<sensor>/<run>.parquet, one row group by batch
+- arrow: directory/<node>.<sensor>/<run>.arrow, Arrow IPC file, one record
+  batch by batch, loaded without copy with load_arrow
+
+pyarrow is only needed by the parquet and arrow formats.
+"""
+
+import abc
+import collections
+import logging
+import os
+import struct
+import time
+import numpy as np
+import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+FORMATS = ('npy', 'parquet', 'arrow')
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# Fixed header size, so the shape can be rewritten in place after an append
+NPY_HEADER_SIZE = 512
+
+
+def get_columns(documents, fields):
+    """
+    Return the columns of some documents
+    :param documents: List of Dict data
+    :param fields: Field names of the columns
+    :return: Dict field -> float64 array, NaN where a document has no value
+    """
+    return {field: np.array([document.get(field, np.nan) for document in documents], dtype=np.float64)
+            for field in fields}
+
+
+class FileSink(abc.ABC):
+    """
+    Buffer the documents by (node, sensor) and append them to files
+
+    Same interface as bulk_writer.BulkWriter. The columns of a (node, sensor)
+    are the fields of its first document, other than node and sensor.
+    """
+
+    def __init__(self, directory, batch_size, flush_interval):
+        """
+        :param directory: Output directory, created if needed
+        :param batch_size: Maximum number of buffered documents
+        :param flush_interval: Maximum number of seconds a document is buffered
+        """
+        self.directory = directory
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.written = 0
+        # A failed append raises, no document is rejected
+        self.rejected = 0
+        self.batches = 0
+        self._buffers = collections.OrderedDict()
+        self._fields = {}
+        self._size = 0
+        self._last_flush = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def _add(self, document):
+        key = (document["node"], document["sensor"])
+        if key not in self._fields:
+            self._fields[key] = [field for field in document if field not in ("node", "sensor")]
+        self._buffers.setdefault(key, []).append(document)
+        self._size += 1
+
+    def write(self, document):
+        """
+        Buffer one document, flush if needed
+        :param document: Dict data
+        """
+        self._add(document)
+        if (self._size >= self.batch_size or
+                time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def write_many(self, documents):
+        """
+        Buffer an iterable of documents, flush every full batch
+        :param documents: Iterable of Dict data
+        """
+        for document in documents:
+            self._add(document)
+            if self._size >= self.batch_size:
+                self.flush()
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Append the buffered documents to their files
+        :return: Number of documents written
+        """
+        self._last_flush = time.monotonic()
+        written = 0
+        while self._buffers:
+            key, documents = next(iter(self._buffers.items()))
+            # On error the documents stay buffered, so a later flush can retry them
+            with metrics.timer("write_seconds", self.metric_labels):
+                self._append(key[0], key[1], get_columns(documents, self._fields[key]))
+            del self._buffers[key]
+            self._size -= len(documents)
+            written += len(documents)
+            self.batches += 1
+            metrics.observe("write_batch_size", len(documents), self.metric_labels, metrics.SIZE_BUCKETS)
+        self.written += written
+        metrics.inc("documents_written_total", written, self.metric_labels)
+        return written
+
+    @abc.abstractmethod
+    def _append(self, node, sensor, columns):
+        """
+        Append columns to the files of a (node, sensor)
+        :param node: Node name
+        :param sensor: Sensor name
+        :param columns: Dict field -> float64 array, from get_columns
+        """
+
+    def _close(self):
+        pass
+
+    def close(self):
+        """
+        Flush the remaining documents, close the files and report what was written
+        :return: Number of documents written since the creation
+        """
+        try:
+            self.flush()
+        finally:
+            self._close()
+        LOGGER.warning("%d documents written in %d batches in %s.", self.written, self.batches, self.directory)
+        return self.written
+
+
+def get_npy_header(dtype, length):
+    """
+    :param dtype: Structured dtype of the records
+    :param length: Number of records
+    :return: NPY format 1.0 header of NPY_HEADER_SIZE bytes
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        np.lib.format.dtype_to_descr(dtype), length)
+    if len(header) >= NPY_HEADER_SIZE - len(NPY_MAGIC) - 2:
+        raise ValueError("Too many columns for the npy header: " + header)
+    header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 2 - 1) + "\n"
+    return NPY_MAGIC + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def append_npy(path, records):
+    """
+    Append records to a npy file written by this function, created if needed
+
+    The records are written before the header, so an interrupted append
+    leaves the previous array readable.
+    :param path: npy file
+    :param records: Structured array
+    """
+    if not os.path.exists(path):
+        with open(path, 'wb') as npy:
+            npy.write(get_npy_header(records.dtype, 0))
+
+    with open(path, 'r+b') as npy:
+        np.lib.format.read_magic(npy)
+        shape, _, dtype = np.lib.format.read_array_header_1_0(npy)
+        if npy.tell() != NPY_HEADER_SIZE:
+            raise ValueError(path + " was not written by file_sink")
+        if dtype != records.dtype:
+            raise ValueError(path + " holds the columns " + str(dtype.names) +
+                             ", not " + str(records.dtype.names))
+        npy.seek(NPY_HEADER_SIZE + shape[0] * dtype.itemsize)
+        npy.write(records.tobytes())
+        npy.truncate()
+        npy.flush()
+        npy.seek(0)
+        npy.write(get_npy_header(dtype, shape[0] + len(records)))
+
+
+def load_npy(directory, node, sensor):
+    """
+    Map the samples of a node without reading them
+    :param directory: Output directory
+    :param node: Node name
+    :param sensor: Sensor name
+    :return: Read-only structured memmap, e.g. load_npy(...)['power']
+    """
+    return np.load(os.path.join(directory, node + "." + sensor + ".npy"), mmap_mode='r')
+
+
+class NpySink(FileSink):
+    """
+    One growing npy file by (node, sensor)
+    """
+
+    metric_labels = {"layout": "npy"}
+
+    def _append(self, node, sensor, columns):
+        records = np.empty(len(next(iter(columns.values()))),
+                           dtype=[(field, np.float64) for field in columns])
+        for field, values in columns.items():
+            records[field] = values
+        append_npy(os.path.join(self.directory, node + "." + sensor + ".npy"), records)
+
+
+class ArrowSink(FileSink):
+    """
+    One Parquet or Arrow IPC file by (node, sensor) and run, appended by batches
+    """
+
+    def __init__(self, directory, batch_size, flush_interval, file_format='parquet'):
+        """
+        :param directory: Output directory, created if needed
+        :param batch_size: Maximum number of buffered documents
+        :param flush_interval: Maximum number of seconds a document is buffered
+        :param file_format: parquet or arrow
+        """
+        import pyarrow
+
+        super().__init__(directory, batch_size, flush_interval)
+        self.pyarrow = pyarrow
+        self.file_format = file_format
+        self.metric_labels = {"layout": file_format}
+        self.run = time.strftime("%Y%m%dT%H%M%S") + "-" + str(os.getpid())
+        self._writers = {}
+
+    def _open(self, node, sensor, schema):
+        directory = os.path.join(self.directory, node + "." + sensor)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.run + "." + self.file_format)
+        index = 0
+        while os.path.exists(path):
+            index += 1
+            path = os.path.join(directory, "%s-%d.%s" % (self.run, index, self.file_format))
+        if self.file_format == 'parquet':
+            import pyarrow.parquet
+
+            return pyarrow.parquet.ParquetWriter(path, schema)
+        return self.pyarrow.ipc.new_file(path, schema)
+
+    def _append(self, node, sensor, columns):
+        batch = self.pyarrow.RecordBatch.from_arrays([self.pyarrow.array(values) for values in columns.values()],
+                                                     names=list(columns))
+        if (node, sensor) not in self._writers:
+            self._writers[(node, sensor)] = self._open(node, sensor, batch.schema)
+        writer = self._writers[(node, sensor)]
+        if self.file_format == 'parquet':
+            writer.write_table(self.pyarrow.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+
+    def _close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+
+def load_arrow(directory, node, sensor):
+    """
+    Map the Arrow IPC files of a node without reading them
+    :param directory: Output directory
+    :param node: Node name
+    :param sensor: Sensor name
+    :return: pyarrow Table of all the runs
+    """
+    import pyarrow
+
+    directory = os.path.join(directory, node + "." + sensor)
+    return pyarrow.concat_tables([pyarrow.ipc.open_file(pyarrow.memory_map(os.path.join(directory, name))).read_all()
+                                  for name in sorted(os.listdir(directory)) if name.endswith(".arrow")])
+
+
+def create_sink(file_format, directory, batch_size, flush_interval):
+    """
+    :param file_format: One of FORMATS
+    :param directory: Output directory
+    :param batch_size: Maximum number of buffered documents
+    :param flush_interval: Maximum number of seconds a document is buffered
+    :return: FileSink
+    """
+    if file_format == 'npy':
+        return NpySink(directory, batch_size, flush_interval)
+    if file_format in ('parquet', 'arrow'):
+        return ArrowSink(directory, batch_size, flush_interval, file_format)
+    raise ValueError("Unknown file format " + file_format)
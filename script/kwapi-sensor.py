@@ -19,10 +19,13 @@ Module Kwapi-sensor
 """
 
 import argparse
-import requests
 import logging
+import signal
 import sys
-import pymongo
+import kwapi
+import metrics
+from bulk_writer import create_output, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_BUCKET_SIZE, LAYOUTS
+from checkpoint import Checkpoints, get_output_id, DEFAULT_CHECKPOINT_FILE
 
 LOGGER = logging.getLogger()
 LOGGER.addHandler(logging.StreamHandler())
@@ -31,79 +34,38 @@ LOGGER.addHandler(logging.StreamHandler())
 # Useful functions
 ##############################################################################
 
-def get_kwapi_url(city_name):
+def get_nodes(args):
     """
-    Return the url to JSON information available on g5k about Kwapi
-    :param city_name: City name
-    :return: URL of the node
-    """
-    return "https://api.grid5000.fr/stable/sites/"+city_name+"/metrics/power/"
-
-
-def get_kwapi_value_url(city_name, node_name, timestamp_start, timestamp_stop):
-    """
-    Return the url to JSON information available on g5k about Kwapi series
-    :param city_name: City name
-    :param node_name: Node name
-    :param timestamp_start: Timestamp to begin
-    :param timestamp_stop: Timestamp to stop
-    :return: URL of the node
+    Return the list of nodes to monitor
+    :param args: Script argument
+    :return: List of node names
     """
-    return "https://api.grid5000.fr/stable/sites/"+city_name+"/metrics/power/timeseries?resolution=1&only="+node_name+"&from="+str(timestamp_start)+"&to="+str(timestamp_stop)
+    return [node for node in args.node_name.split(',') if node]
 
 
-def is_kwapi_available(args):
+def is_kwapi_available(args, session):
     """
-    Allow to know if Kwapi-sensor is available for this node
+    Allow to know if Kwapi-sensor is available for all the nodes
     :param args: Script argument
+    :param session: Session from kwapi.create_session
     :return: True if available, False otherwise
     """
-    url = get_kwapi_url(args.city_name)
-    request = requests.get(url,
-                           auth=(args.g5k_login,
-                                 args.g5k_pass),
-                           verify=False)
-    data = request.json()
-    for node in data['available_on']:
-        if args.node_name in node:
-            return True
-    return False
-
-
-def connect_mongodb(args):
-    """
-    Return the collection to write the output
-    :param args: Script arguments
-    :return: MongoDB collection
-    """
-    mongo_client = pymongo.MongoClient(args.mongodb_uri,
-                                       serverSelectionTimeoutMS=5)
-    collection = mongo_client[args.mongodb_db][args.mongodb_collection]
+    missing = kwapi.get_unavailable_nodes(session, args.city_name, get_nodes(args))
+    for node in missing:
+        LOGGER.error("Kwapi-sensor not available for the node " + node)
+    return not missing
 
-    # Check if it work
-    try:
-        mongo_client.admin.command('ismaster')
-    except pymongo.errors.ServerSelectionTimeoutError:
-        LOGGER.error("MongoDB error.")
-        exit(-1)
-
-    return collection
 
-
-def create_data(timestamp, sensor, power):
+def get_checkpoints(args):
     """
-    Create the Dict with data
-    :param timestamp: Timestamp int
-    :param sensor: Sensor name
-    :param power: Power value
-    :return: Dict data
+    Return the checkpoints of the output
+    :param args: Script arguments
+    :return: Checkpoints, None with --no-checkpoints
     """
-    return {
-        "timestamp": timestamp,
-        "sensor": sensor,
-        "power": power
-    }
-
+    if args.no_checkpoints:
+        return None
+    return Checkpoints(get_output_id(args.mongodb_uri, args.mongodb_db, args.mongodb_collection),
+                       args.checkpoints)
 
 
 ##############################################################################
@@ -123,18 +85,52 @@ def arg_parser_init():
     parser.add_argument("g5k_pass", help="G5K password")
 
     # MongoDB output
-    parser.add_argument("mongodb_uri", help="MongoDB output uri")
-    parser.add_argument("mongodb_db", help="MongoDB output database")
-    parser.add_argument("mongodb_collection", help="MongoDB output collection")
+    parser.add_argument("mongodb_uri", help="MongoDB output uri, or npy://, parquet:// or arrow:// and a directory")
+    parser.add_argument("mongodb_db", help="MongoDB output database, or sub-directory")
+    parser.add_argument("mongodb_collection", help="MongoDB output collection, or sub-directory")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of documents written in one insert_many")
+    parser.add_argument("--flush-interval", type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help="Maximum number of seconds a document stays buffered")
+    parser.add_argument("--layout", choices=LAYOUTS, default='document',
+                        help="One document by sample, by bucket of samples, or a time-series collection")
+    parser.add_argument("--bucket-size", type=int, default=DEFAULT_BUCKET_SIZE,
+                        help="Seconds covered by one bucket document")
+    parser.add_argument("--rollups", action="store_true",
+                        help="Also update the 10 s, 1 min and 1 h rollups of the MongoDB collection")
 
     # Node informations
     parser.add_argument("city_name", help="City name where the cluster is")
     parser.add_argument("cluster_name", help="Cluster name where the node is")
-    parser.add_argument("node_name", help="Node name to monitor")
+    parser.add_argument("node_name", help="Node name to monitor, or comma separated list of nodes")
 
     # Timestamp information
-    parser.add_argument("timestamp_start", help="Timestamp where begin the series")
-    parser.add_argument("timestamp_stop", help="Timestamp where end the series")
+    parser.add_argument("timestamp_start", nargs="?", help="Timestamp where begin the series")
+    parser.add_argument("timestamp_stop", nargs="?", help="Timestamp where end the series")
+    parser.add_argument("--chunk-size", type=int, default=kwapi.DEFAULT_CHUNK_SIZE,
+                        help="Number of seconds fetched by one request")
+    parser.add_argument("--workers", type=int, default=kwapi.DEFAULT_WORKERS,
+                        help="Number of requests run concurrently")
+    parser.add_argument("--stream-json", action="store_true",
+                        help="Decode the answers while they are received, in typed arrays")
+
+    # Follow mode, instead of the window
+    parser.add_argument("--follow", action="store_true",
+                        help="Poll the new samples until SIGTERM, from the checkpoints or timestamp_start")
+    parser.add_argument("--period", type=float, default=kwapi.DEFAULT_PERIOD,
+                        help="First number of seconds between two polls, then adapted, with --follow")
+    parser.add_argument("--max-period", type=float, default=kwapi.MAX_PERIOD,
+                        help="Maximum number of seconds between two polls, with --follow")
+
+    # Checkpoints of the ranges already written
+    parser.add_argument("--checkpoints", default=DEFAULT_CHECKPOINT_FILE,
+                        help="JSON file of the ranges already written, only the missing ones are fetched")
+    parser.add_argument("--no-checkpoints", action="store_true",
+                        help="Fetch the whole window, without reading nor writing the checkpoints")
+
+    # Instrumentation
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="JSON file of the metrics summary written at the end, logged by default")
 
     return parser
 
@@ -147,35 +143,44 @@ def main():
     """
     Main function of the Kwapi-sensor
     """
-    args = arg_parser_init().parse_args()
+    parser = arg_parser_init()
+    args = parser.parse_args()
+    if not args.follow and args.timestamp_stop is None:
+        parser.error("timestamp_start and timestamp_stop are required without --follow")
+    # The polls of --follow are sequential, on one connection
+    session = kwapi.create_session((args.g5k_login, args.g5k_pass), 1 if args.follow else args.workers)
 
     # Test is Kwapi-sensor can monitor this node
-    if not is_kwapi_available(args):
-        LOGGER.error("Kwapi-sensor not available for the node " + args.node_name)
+    if not is_kwapi_available(args, session):
         sys.exit(-1)
 
-    output = connect_mongodb(args)
-    url = get_kwapi_value_url(args.city_name,
-                              args.node_name,
-                              args.timestamp_start,
-                              args.timestamp_stop)
-    data = requests.get(url,
-                        auth=(args.g5k_login,
-                              args.g5k_pass),
-                        verify=False).json()
-
-    # If there is no data, -1 everywhere
-    if len(data['items']) > 0:
-        offset = 0
-        for ts in range(int(args.timestamp_start), int(args.timestamp_stop)):
-            # If offset is outofrange or
-            #    data timestamp is different from the current ts
-            if (offset >= len(data['items'][0]['timestamps']) or
-                    ts != data['items'][0]['timestamps'][offset]):
-                continue
-            new_row = create_data(ts, "kwapi-sensor", data['items'][0]['values'][offset])
-            output.insert_one(new_row)
-            offset += 1
+    # Signal handling
+    def term_handler(_, __):
+        LOGGER.warning("Ended by user.")
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, term_handler)
+    signal.signal(signal.SIGINT, term_handler)
+
+    output = create_output(args.mongodb_uri, args.mongodb_db, args.mongodb_collection,
+                           args.layout,
+                           args.bucket_size,
+                           args.batch_size,
+                           args.flush_interval,
+                           args.rollups)
+    try:
+        if args.follow:
+            kwapi.follow(session, output, args.city_name, get_nodes(args), args.timestamp_start,
+                         args.period, args.max_period, args.chunk_size,
+                         checkpoints=get_checkpoints(args), stream_json=args.stream_json)
+        else:
+            kwapi.collect(session, output, args.city_name, get_nodes(args),
+                          args.timestamp_start, args.timestamp_stop,
+                          args.chunk_size, args.workers, checkpoints=get_checkpoints(args),
+                          stream_json=args.stream_json)
+    finally:
+        output.close()
+        metrics.write_summary(args.metrics)
 
 
 if __name__ == "__main__":
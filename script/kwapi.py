@@ -0,0 +1,595 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Kwapi, access to the power metrics of the G5K API
+"""
+
+import codecs
+import collections
+import concurrent.futures
+import json
+import logging
+import time
+import requests
+import numpy as np
+import metrics
+from bulk_writer import create_data, RETRY_DELAY
+
+LOGGER = logging.getLogger(__name__)
+
+SENSOR_NAME = "kwapi-sensor"
+METRIC_LABELS = {"sensor": SENSOR_NAME}
+# Replaced by a local server in the benchmark
+API_URL = "https://api.grid5000.fr/stable"
+
+DEFAULT_CHUNK_SIZE = 3600
+DEFAULT_WORKERS = 4
+# Bytes of an answer decoded at once by the streaming decoder
+STREAM_BLOCK_SIZE = 1 << 16
+# Item fields decoded in place in float64 arrays by the streaming decoder
+NUMBER_ARRAYS = ('timestamps', 'values')
+# Characters going on a JSON number
+NUMBER_CHARS = '0123456789.eE+-'
+# Follow mode: seconds between two polls, adapted to the arrival of the samples
+DEFAULT_PERIOD = 10
+MIN_PERIOD = 1
+MAX_PERIOD = 300
+# Follow mode: samples older than the newest one by this are not waited for
+FOLLOW_HORIZON = 300
+
+
+def create_session(auth, pool_size=DEFAULT_WORKERS):
+    """
+    Return an authenticated keep-alive session asking for compressed answers
+    :param auth: Tuple (G5K login, G5K password)
+    :param pool_size: Number of connections kept open
+    :return: requests.Session
+    """
+    session = requests.Session()
+    session.auth = auth
+    session.verify = False
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_kwapi_url(city_name):
+    """
+    Return the url to JSON information available on g5k about Kwapi
+    :param city_name: City name
+    :return: URL of the node
+    """
+    return API_URL + "/sites/"+city_name+"/metrics/power/"
+
+
+def get_kwapi_value_url(city_name, nodes, timestamp_start, timestamp_stop):
+    """
+    Return the url to JSON information available on g5k about Kwapi series
+    :param city_name: City name
+    :param nodes: List of node names
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop
+    :return: URL of the nodes
+    """
+    return (API_URL + "/sites/"+city_name+"/metrics/power/timeseries?resolution=1&only=" +
+            ",".join(nodes)+"&from="+str(timestamp_start)+"&to="+str(timestamp_stop))
+
+
+def get_unavailable_nodes(session, city_name, nodes):
+    """
+    Return the nodes that Kwapi can not monitor
+    :param session: Session from create_session
+    :param city_name: City name
+    :param nodes: List of node names
+    :return: List of node names missing from available_on
+    """
+    data = session.get(get_kwapi_url(city_name)).json()
+    # available_on may hold node names or FQDN
+    available = {node.split('.')[0] for node in data['available_on']}
+    return [node for node in nodes if node not in available]
+
+
+def get_item_series(item, timestamp_start, timestamp_stop):
+    """
+    Convert an item of a timeseries answer to arrays
+    :param item: Dict item, with its timestamps and values as lists or arrays
+    :param timestamp_start: First timestamp to keep
+    :param timestamp_stop: Timestamp where the series end (excluded)
+    :return: (node name, int64 timestamps, float64 values)
+    """
+    timestamps = np.asarray(item['timestamps'], dtype=np.float64)
+    values = np.asarray(item['values'], dtype=np.float64)
+    mask = ((timestamps >= int(timestamp_start)) & (timestamps < int(timestamp_stop)) &
+            ~np.isnan(values))
+    return item['uid'], timestamps[mask].astype(np.int64), values[mask]
+
+
+def iter_series(data, timestamp_start, timestamp_stop):
+    """
+    Convert every item of a timeseries answer to arrays
+    :param data: JSON answer of the timeseries url
+    :param timestamp_start: First timestamp to keep
+    :param timestamp_stop: Timestamp where the series end (excluded)
+    :return: Generator of (node name, int64 timestamps, float64 values)
+    """
+    for item in data['items']:
+        yield get_item_series(item, timestamp_start, timestamp_stop)
+
+
+def parse_numbers(text):
+    """
+    :param text: Comma separated JSON numbers or null
+    :return: float64 array, NaN for null
+    """
+    if not text.strip():
+        return np.empty(0)
+    numbers = np.fromstring(text.replace('null', 'nan'), sep=',')
+    # fromstring stops at the first item that is not a number
+    if len(numbers) != text.count(',') + 1:
+        raise ValueError("Not a list of numbers: " + text[:50])
+    return numbers
+
+
+class JsonStream:
+    """
+    Incremental reader of a JSON document given by blocks of bytes
+
+    Objects and arrays are walked without being built, so the caller keeps
+    only what it needs. The arrays of numbers are read block by block.
+    """
+
+    def __init__(self, blocks):
+        """
+        :param blocks: Iterable of bytes
+        """
+        self.blocks = iter(blocks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        """
+        Append the next block to the text, dropping what was read
+        :return: False at the end of the document
+        """
+        if self.eof:
+            return False
+        self.text = self.text[self.pos:]
+        self.pos = 0
+        try:
+            self.text += self.decoder.decode(next(self.blocks))
+        except StopIteration:
+            self.eof = True
+            self.text += self.decoder.decode(b'', True)
+        return True
+
+    def peek(self):
+        """
+        :return: Next character other than a blank
+        """
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.read_more():
+                raise ValueError("Truncated JSON")
+
+    def expect(self, char):
+        """
+        :param char: Next character other than a blank, consumed
+        """
+        if self.peek() != char:
+            raise ValueError("Expected %s at %r" % (char, self.text[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def read_value(self):
+        """
+        :return: Next value, decoded with the json module
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.text, self.pos)
+            except ValueError:
+                if not self.read_more():
+                    raise
+                continue
+            # A number at the end of the text may go on in the next block,
+            # even after a dot, an exponent or its sign
+            if self.eof or (end < len(self.text) and self.text[end] not in NUMBER_CHARS):
+                self.pos = end
+                return value
+            self.read_more()
+
+    def iter_object(self):
+        """
+        Walk an object, the caller reads the value of every key
+        :return: Generator of keys
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key
+            if self.peek() == '}':
+                self.pos += 1
+                return
+            self.expect(',')
+
+    def iter_array(self):
+        """
+        Walk an array, the caller reads every element
+        :return: Generator of indexes
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            if self.peek() == ']':
+                self.pos += 1
+                return
+            self.expect(',')
+
+    def read_numbers(self):
+        """
+        :return: float64 array of the next array of numbers, NaN for null
+        """
+        self.expect('[')
+        parts = []
+        while True:
+            end = self.text.find(']', self.pos)
+            if end >= 0:
+                parts.append(parse_numbers(self.text[self.pos:end]))
+                self.pos = end + 1
+                return np.concatenate(parts)
+            # Only whole numbers, up to the last comma
+            cut = self.text.rfind(',', self.pos)
+            if cut >= 0:
+                parts.append(parse_numbers(self.text[self.pos:cut]))
+                self.pos = cut + 1
+            if not self.read_more():
+                raise ValueError("Truncated JSON")
+
+
+def iter_stream_items(blocks):
+    """
+    Decode the items of a timeseries answer while it is received
+    :param blocks: Iterable of bytes of the answer
+    :return: Generator of Dict items, with float64 arrays of timestamps and values
+    """
+    stream = JsonStream(blocks)
+    for key in stream.iter_object():
+        if key != 'items':
+            stream.read_value()
+            continue
+        for _ in stream.iter_array():
+            item = {}
+            for field in stream.iter_object():
+                if field in NUMBER_ARRAYS and stream.peek() == '[':
+                    item[field] = stream.read_numbers()
+                else:
+                    item[field] = stream.read_value()
+            yield item
+
+
+def iter_chunks(timestamp_start, timestamp_stop, chunk_size):
+    """
+    Split a window in consecutive chunks
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param chunk_size: Number of seconds of a chunk
+    :return: Generator of (chunk start, chunk stop)
+    """
+    timestamp_start, timestamp_stop = int(timestamp_start), int(timestamp_stop)
+    for start in range(timestamp_start, timestamp_stop, chunk_size):
+        yield start, min(start + chunk_size, timestamp_stop)
+
+
+def count_bytes(blocks):
+    """
+    :param blocks: Iterable of bytes
+    :return: Generator of the same bytes, counted in the metrics
+    """
+    for block in blocks:
+        metrics.inc("fetch_bytes_total", len(block), METRIC_LABELS)
+        yield block
+
+
+def fetch_series(session, city_name, nodes, timestamp_start, timestamp_stop, stream_json=False):
+    """
+    Fetch the series of the nodes on a window
+    :param session: Session from create_session
+    :param city_name: City name
+    :param nodes: List of node names
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param stream_json: Decode the answer while it is received, without building
+                        the lists of the whole answer
+    :return: List of (node name, int64 timestamps, float64 values)
+    """
+    with metrics.timer("fetch_seconds", METRIC_LABELS):
+        request = session.get(get_kwapi_value_url(city_name, nodes, timestamp_start, timestamp_stop),
+                              stream=stream_json)
+        request.raise_for_status()
+        if not stream_json:
+            metrics.inc("fetch_bytes_total", len(request.content), METRIC_LABELS)
+    series = []
+    received = 0
+    with metrics.timer("parse_seconds", METRIC_LABELS):
+        if stream_json:
+            # The rest of the download is counted in the parsing
+            with request:
+                items = iter_stream_items(count_bytes(request.iter_content(STREAM_BLOCK_SIZE)))
+                for item in items:
+                    received += len(item['values'])
+                    series.append(get_item_series(item, timestamp_start, timestamp_stop))
+        else:
+            for item in request.json()['items']:
+                received += len(item['values'])
+                series.append(get_item_series(item, timestamp_start, timestamp_stop))
+    # Samples out of the window or without value are rejected
+    accepted = sum(len(timestamps) for _, timestamps, _ in series)
+    metrics.inc("rows_accepted_total", accepted, METRIC_LABELS)
+    metrics.inc("rows_rejected_total", received - accepted, METRIC_LABELS)
+    return series
+
+
+def iter_chunk_series(session, city_name, nodes, chunks, workers=DEFAULT_WORKERS, stream_json=False):
+    """
+    Fetch the series of the nodes chunk by chunk, with several chunks in flight
+
+    Chunks are given back in order. At most `workers` chunks are fetched or
+    waiting at a time, so the memory is bounded by the chunk size.
+    :param session: Session from create_session
+    :param city_name: City name
+    :param nodes: List of node names
+    :param chunks: Iterable of (chunk start, chunk stop), or of (chunk start, chunk stop,
+                   node names) to fetch other nodes on a chunk
+    :param workers: Number of concurrent requests
+    :param stream_json: Decode the answers while they are received
+    :return: Generator of (chunk start, chunk stop,
+             list of (node name, int64 timestamps, float64 values))
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for start, stop, *chunk_nodes in chunks:
+            request_nodes = chunk_nodes[0] if chunk_nodes else nodes
+            pending.append((start, stop, executor.submit(fetch_series, session, city_name, request_nodes,
+                                                         start, stop, stream_json)))
+            if len(pending) >= workers:
+                start, stop, future = pending.popleft()
+                yield start, stop, future.result()
+        while pending:
+            start, stop, future = pending.popleft()
+            yield start, stop, future.result()
+
+
+def iter_range_series(session, city_name, nodes, timestamp_start, timestamp_stop,
+                      chunk_size=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS, stream_json=False):
+    """
+    Fetch the series of the nodes on a window, chunk by chunk in timestamp order
+    :param session: Session from create_session
+    :param city_name: City name
+    :param nodes: List of node names
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param chunk_size: Number of seconds fetched by one request
+    :param workers: Number of concurrent requests
+    :param stream_json: Decode the answers while they are received
+    :return: Generator of (node name, int64 timestamps, float64 values)
+    """
+    for _, _, series in iter_chunk_series(session, city_name, nodes,
+                                          iter_chunks(timestamp_start, timestamp_stop, chunk_size),
+                                          workers, stream_json):
+        yield from series
+
+
+def collect(session, output, city_name, nodes, timestamp_start, timestamp_stop,
+            chunk_size=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS, stop=None, checkpoints=None,
+            stream_json=False):
+    """
+    Fetch the series of the nodes chunk by chunk and write them in the output
+    :param session: Session from create_session
+    :param output: Writer from bulk_writer.create_writer
+    :param city_name: City name
+    :param nodes: List of node names
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param chunk_size: Number of seconds fetched by one request
+    :param workers: Number of concurrent requests
+    :param stop: threading.Event ending the collection early when set
+    :param checkpoints: checkpoint.Checkpoints, to fetch only the missing ranges
+                        and mark every chunk once written without rejected document
+    :param stream_json: Decode the answers while they are received
+    """
+    ranges = [(int(timestamp_start), int(timestamp_stop), nodes)]
+    if checkpoints is not None:
+        # Only the nodes missing a range are fetched on it
+        ranges = checkpoints.plan(SENSOR_NAME, nodes, *ranges[0][:2])
+        LOGGER.warning("Fetch %d node-seconds of %d.",
+                       sum((stop_ts - start_ts) * len(range_nodes) for start_ts, stop_ts, range_nodes in ranges),
+                       (int(timestamp_stop) - int(timestamp_start)) * len(nodes))
+    chunks = [(chunk_start, chunk_stop, range_nodes) for start_ts, stop_ts, range_nodes in ranges
+              for chunk_start, chunk_stop in iter_chunks(start_ts, stop_ts, chunk_size)]
+
+    for (_, _, chunk_nodes), (chunk_start, chunk_stop, series) in zip(
+            chunks, iter_chunk_series(session, city_name, nodes, chunks, workers, stream_json)):
+        if stop is not None and stop.is_set():
+            return
+        rejected = output.rejected
+        # Nodes without data are missing from items
+        for node, timestamps, values in series:
+            output.write_many(create_data(ts, SENSOR_NAME, value, node)
+                              for ts, value in zip(timestamps.tolist(), values.tolist()))
+        if checkpoints is not None:
+            output.flush()
+            if output.rejected == rejected:
+                checkpoints.add(SENSOR_NAME, chunk_nodes, chunk_start, chunk_stop)
+            else:
+                LOGGER.error("Chunk %d-%d not marked, %d documents rejected.",
+                             chunk_start, chunk_stop, output.rejected - rejected)
+
+
+def get_next_period(period, advance, min_period=MIN_PERIOD, max_period=MAX_PERIOD):
+    """
+    Adapt the poll period to the arrival of the samples
+    :param period: Current period, in seconds
+    :param advance: Seconds the newest sample moved forward during the last poll, 0 if it did not
+    :return: Half the advance, so a source publishing its samples every N seconds is
+             polled twice by N seconds, or 1.5 times the period after a poll without new sample
+    """
+    if advance > 0:
+        period = advance / 2.0
+    else:
+        period *= 1.5
+    return min(max(period, min_period), max_period)
+
+
+def follow(session, output, city_name, nodes, timestamp_start=None, period=DEFAULT_PERIOD,
+           max_period=MAX_PERIOD, chunk_size=DEFAULT_CHUNK_SIZE, stop=None, checkpoints=None,
+           stream_json=False):
+    """
+    Poll the new samples of the nodes and write them, until stop is set
+
+    Every node has a high-water mark, its last written timestamp, and a
+    poll asks for the samples after it: the nodes up to date share one
+    request, the late ones another, so a node without sample does not make
+    the others download their samples again. A late node waits for its
+    samples up to FOLLOW_HORIZON seconds behind the others, then skips
+    ahead: the skipped seconds are not marked in the checkpoints, so a
+    backfill can still fetch them. A poll behind now asks for chunk_size
+    seconds at most, and the next poll follows it without waiting; the
+    nodes without sample in these seconds skip them the same way. After a
+    fetch error, the next poll waits a delay doubled up to max_period.
+    :param session: Session from create_session, one connection is enough
+    :param output: Writer from bulk_writer.create_writer
+    :param city_name: City name
+    :param nodes: List of node names
+    :param timestamp_start: Timestamp to begin for the nodes without checkpoint,
+                            FOLLOW_HORIZON seconds ago by default
+    :param period: First number of seconds between two polls
+    :param max_period: Maximum number of seconds between two polls
+    :param chunk_size: Maximum number of seconds fetched by one request
+    :param stop: threading.Event ending the loop when set
+    :param checkpoints: checkpoint.Checkpoints, to begin after the last written timestamp
+                        and mark every chunk_size seconds once written
+    :param stream_json: Decode the answers while they are received
+    """
+    now = int(time.time())
+    marks = {}
+    for node in nodes:
+        last = checkpoints.get_last(SENSOR_NAME, node) if checkpoints is not None else None
+        if last is None:
+            last = int(timestamp_start) if timestamp_start is not None else now - FOLLOW_HORIZON
+        marks[node] = last - 1
+    # Start of the range each node wrote without gap, and its ranges ended by a skip
+    starts = {node: mark + 1 for node, mark in marks.items()}
+    ended = {node: [] for node in nodes}
+    marked = max(marks.values())
+    rejected = output.rejected
+
+    def skip(node, mark):
+        # The skipped seconds are not marked, a backfill can fetch them
+        if marks[node] + 1 > starts[node]:
+            ended[node].append((starts[node], marks[node] + 1))
+        marks[node] = mark
+        starts[node] = mark + 1
+
+    # The period is adapted once the polls are up to date
+    adapt = False
+    retry_delay = RETRY_DELAY
+    while stop is None or not stop.is_set():
+        newest = max(marks.values())
+        now = int(time.time())
+        behind = False
+        failed = False
+        for node in nodes:
+            if marks[node] < newest - FOLLOW_HORIZON:
+                skip(node, newest - FOLLOW_HORIZON)
+        late = [node for node in nodes if marks[node] < newest - period]
+        for group in ([node for node in nodes if node not in late], late):
+            if not group:
+                continue
+            group_start = min(marks[node] for node in group) + 1
+            group_stop = min(group_start + chunk_size, now + 1)
+            try:
+                series = fetch_series(session, city_name, group, group_start, group_stop, stream_json)
+            except requests.RequestException as error:
+                LOGGER.warning("Cannot fetch the Kwapi series, retry in %.0f s: %s", retry_delay, error)
+                metrics.inc("fetch_errors_total", 1, METRIC_LABELS)
+                failed = True
+                continue
+            received = set()
+            for node, timestamps, values in series:
+                mask = timestamps > marks.get(node, group_start - 1)
+                output.write_many(create_data(ts, SENSOR_NAME, value, node)
+                                  for ts, value in zip(timestamps[mask].tolist(), values[mask].tolist()))
+                if node in marks and mask.any():
+                    marks[node] = int(timestamps[mask].max())
+                    received.add(node)
+            if group_stop <= now:
+                behind = True
+                # A gap longer than chunk_size would be asked again and again
+                for node in group:
+                    if node not in received and marks[node] < group_stop - 1:
+                        skip(node, group_stop - 1)
+
+        if checkpoints is not None and max(marks.values()) - marked >= chunk_size:
+            output.flush()
+            marked = max(marks.values())
+            if output.rejected == rejected:
+                # Every node up to its own last sample
+                checkpoints.add_ranges(SENSOR_NAME, {node: ended[node] + [(starts[node], marks[node] + 1)]
+                                                     for node in nodes})
+            else:
+                # The seconds since the previous mark are left to a backfill
+                LOGGER.error("Samples until %d not marked, %d documents rejected.",
+                             marked, output.rejected - rejected)
+                rejected = output.rejected
+                starts = {node: mark + 1 for node, mark in marks.items()}
+            ended = {node: [] for node in nodes}
+
+        if adapt:
+            period = get_next_period(period, max(marks.values()) - newest, MIN_PERIOD, max_period)
+        adapt = not behind
+        metrics.gauge("follow_period_seconds", period, METRIC_LABELS)
+        metrics.gauge("follow_lag_seconds", time.time() - max(marks.values()), METRIC_LABELS)
+        if failed:
+            delay = retry_delay
+            retry_delay = min(2 * retry_delay, max_period)
+        else:
+            retry_delay = RETRY_DELAY
+            if behind:
+                continue
+            delay = period
+        # Also flushes the output once its flush interval is over
+        output.write_many([])
+        if stop is not None:
+            stop.wait(delay)
+        else:
+            time.sleep(delay)
@@ -0,0 +1,273 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Metrics, counters and histograms of every stage of the sensors
+
+The stages record in one registry of the process: inc for the counters,
+gauge for the gauges, observe (or timer) for the histograms. The registry is
+rendered in the Prometheus text format by an HTTP endpoint for the live
+sensors, or summarized in JSON at the end of the batch runs.
+"""
+
+import bisect
+import contextlib
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+
+class Histogram:
+    """
+    Cumulative buckets, sum, count and extremes of observed values
+    """
+
+    def __init__(self, buckets):
+        """
+        :param buckets: Sorted upper bounds, +Inf is added
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, fraction):
+        """
+        :param fraction: e.g. 0.95
+        :return: Upper bound of the bucket holding the quantile, max for the last one
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        """
+        :return: Dict of the count, sum, mean, extremes and quantiles
+        """
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95)
+        }
+
+
+class Registry:
+    """
+    Metrics of the process, by name and labels
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.start = time.time()
+
+    def inc(self, name, value=1, labels=None):
+        """
+        Add to a counter
+        :param name: Metric name, ending with _total
+        :param value: Increment
+        :param labels: Dict of labels
+        """
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def total(self, name):
+        """
+        :param name: Counter name
+        :return: Sum of the counter over all its labels
+        """
+        with self.lock:
+            return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def set(self, name, value, labels=None):
+        """
+        Set a gauge
+        :param name: Metric name
+        :param value: Value
+        :param labels: Dict of labels
+        """
+        with self.lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, labels=None, buckets=TIME_BUCKETS):
+        """
+        Add a value to a histogram
+        :param name: Metric name, e.g. ending with _seconds or _bytes
+        :param value: Observed value
+        :param labels: Dict of labels
+        :param buckets: Upper bounds, used when the histogram is created
+        """
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        """
+        Observe the seconds spent in a with block
+        :param name: Histogram name, ending with _seconds
+        :param labels: Dict of labels
+        """
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - begin, labels)
+
+    def render(self):
+        """
+        :return: Metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    _header(lines, name, kind)
+                    for (metric_name, labels), value in sorted(metrics.items()):
+                        if metric_name == name:
+                            lines.append(name + _render_labels(labels) + " " + repr(float(value)))
+            for name in sorted({name for name, _ in self.histograms}):
+                _header(lines, name, "histogram")
+                for (metric_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        le = bound if bound == "+Inf" else repr(float(bound))
+                        lines.append(name + "_bucket" + _render_labels(labels + (("le", le),)) +
+                                     " " + str(cumulative))
+                    lines.append(name + "_sum" + _render_labels(labels) + " " + repr(histogram.sum))
+                    lines.append(name + "_count" + _render_labels(labels) + " " + str(histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        :return: JSON-able Dict of every metric
+        """
+        with self.lock:
+            return {
+                "seconds": time.time() - self.start,
+                "counters": {name + _render_labels(labels): value
+                             for (name, labels), value in sorted(self.counters.items())},
+                "gauges": {name + _render_labels(labels): value
+                           for (name, labels), value in sorted(self.gauges.items())},
+                "histograms": {name + _render_labels(labels): histogram.summary()
+                               for (name, labels), histogram in sorted(self.histograms.items(),
+                                                                       key=lambda item: item[0])}
+            }
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _render_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+
+def _header(lines, name, kind):
+    lines.append("# TYPE " + name + " " + kind)
+
+
+# Registry of the process
+REGISTRY = Registry()
+inc = REGISTRY.inc
+gauge = REGISTRY.set
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+class _MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, address=""):
+    """
+    Serve the registry on http://address:port/metrics from a thread
+    :param port: TCP port
+    :param address: Listening address, all by default
+    :return: HTTP server
+    """
+    server = _MetricsServer((address, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    LOGGER.warning("Metrics on http://%s:%d/metrics", address or "0.0.0.0", server.server_address[1])
+    return server
+
+
+def write_summary(path=None):
+    """
+    Write the JSON summary of the registry
+    :param path: JSON file, None to log it
+    """
+    summary = json.dumps(REGISTRY.summary(), indent=1, sort_keys=True)
+    if path is None:
+        LOGGER.warning(summary)
+        return
+    with open(path, "w") as summary_file:
+        summary_file.write(summary + "\n")
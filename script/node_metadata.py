@@ -0,0 +1,177 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Node-metadata, cache of the node -> PDU mapping and of the PDU IP
+
+The reference API is slow, so the PDU of the nodes (from execo_g5k
+get_host_attributes) and the IP of the PDU are kept in a JSON file shared
+by all the sensors, and refreshed when older than a TTL.
+
+Refresh the cache of some nodes:
+
+    python node_metadata.py [--cache CACHE] city_name node_name[,node_name...]
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "g5k-energy", "nodes.json")
+DEFAULT_TTL = 7 * 24 * 3600
+
+
+class NodeMetadata:
+    """
+    JSON file holding {"nodes": {node: {"time", "pdu"}}, "hosts": {FQDN: {"time", "ip"}}}
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_FILE, ttl=DEFAULT_TTL):
+        """
+        :param path: JSON file of the cache, None to keep it in memory only
+        :param ttl: Seconds before an entry is fetched again
+        """
+        self.path = path
+        self.ttl = ttl
+        self.data = self._load()
+        self._changed = False
+
+    def _load(self):
+        data = {"nodes": {}, "hosts": {}}
+        if self.path is None:
+            return data
+        try:
+            with open(self.path) as cache:
+                data.update(json.load(cache))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            LOGGER.warning("Ignore the corrupted metadata cache " + self.path)
+        return data
+
+    def _fresh(self, entry):
+        return entry is not None and time.time() - entry.get("time", 0) < self.ttl
+
+    def get_pdus(self, node_name):
+        """
+        Return the PDU of a node, from sensors.power.via.pdu of the reference API
+        :param node_name: Node name
+        :return: List of dict with uid and port, None if the node has no PDU
+        """
+        entry = self.data["nodes"].get(node_name)
+        if not self._fresh(entry):
+            entry = self.refresh_node(node_name)
+        return entry["pdu"]
+
+    def refresh_node(self, node_name):
+        """
+        Fetch the PDU of a node from the reference API
+        :param node_name: Node name
+        :return: Cache entry of the node
+        """
+        from execo_g5k import get_host_attributes
+
+        try:
+            with metrics.timer("metadata_refresh_seconds", {"kind": "node"}):
+                pdus = get_host_attributes(node_name)['sensors']['power']['via']['pdu']
+        except KeyError:
+            pdus = None
+        entry = {"time": time.time(), "pdu": pdus}
+        self.data["nodes"][node_name] = entry
+        self._changed = True
+        return entry
+
+    def get_ip(self, host_name):
+        """
+        Return the IP of a host
+        :param host_name: FQDN
+        :return: IP string
+        """
+        entry = self.data["hosts"].get(host_name)
+        if not self._fresh(entry):
+            entry = self.refresh_host(host_name)
+        return entry["ip"]
+
+    def refresh_host(self, host_name):
+        """
+        Resolve a host
+        :param host_name: FQDN
+        :return: Cache entry of the host
+        """
+        with metrics.timer("metadata_refresh_seconds", {"kind": "host"}):
+            entry = {"time": time.time(), "ip": socket.gethostbyname(host_name)}
+        self.data["hosts"][host_name] = entry
+        self._changed = True
+        return entry
+
+    def save(self):
+        """
+        Write the cache if it changed, merged with the entries written meanwhile
+        """
+        if self.path is None or not self._changed:
+            return
+        data = self._load()
+        for kind in ("nodes", "hosts"):
+            for key, entry in self.data[kind].items():
+                if entry.get("time", 0) >= data[kind].get(key, {}).get("time", 0):
+                    data[kind][key] = entry
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(handle, 'w') as cache:
+            json.dump(data, cache, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self.data = data
+        self._changed = False
+
+
+def get_pdu_host_name(pdu_name, city_name):
+    """
+    :param pdu_name: PDU uid
+    :param city_name: City name
+    :return: FQDN of the PDU
+    """
+    return pdu_name+"."+city_name+".grid5000.fr"
+
+
+def main():
+    """
+    Refresh the cache for some nodes, and the IP of their PDU
+    """
+    parser = argparse.ArgumentParser(description="Refresh the node metadata cache.")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_FILE, help="JSON file of the cache")
+    parser.add_argument("city_name", help="City name where the nodes are")
+    parser.add_argument("node_name", help="Comma separated list of nodes")
+    args = parser.parse_args()
+
+    metadata = NodeMetadata(args.cache, ttl=0)
+    for node_name in args.node_name.split(','):
+        pdus = metadata.refresh_node(node_name)["pdu"] or []
+        for pdu in pdus:
+            metadata.refresh_host(get_pdu_host_name(pdu['uid'], args.city_name))
+        print("%s: %s" % (node_name, pdus))
+    metadata.save()
+
+
+if __name__ == "__main__":
+    main()
@@ -19,15 +19,16 @@ Module Omegawatt-sensor
 """
 
 import argparse
-import requests
-import time
+import functools
 import logging
+import signal
 import sys
-import datetime
-import gzip
-import numpy as np
-import pymongo
-from execo_g5k import get_host_attributes
+import metrics
+import wattmetre
+from archive_cache import ArchiveCache, DEFAULT_MAX_SIZE
+from bulk_writer import create_output, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_BUCKET_SIZE, LAYOUTS
+from checkpoint import Checkpoints, get_output_id, DEFAULT_CHECKPOINT_FILE
+from node_metadata import NodeMetadata, DEFAULT_CACHE_FILE, DEFAULT_TTL
 
 LOGGER = logging.getLogger()
 LOGGER.addHandler(logging.StreamHandler())
@@ -37,68 +38,53 @@ LOGGER.addHandler(logging.StreamHandler())
 ##############################################################################
 
 
-def get_omegawatt_url(city_name):
+def get_nodes(args):
     """
-    Return the url to JSON information available on g5k about omegawatt
-    :param city_name: City name
-    :return: URL of the node
+    Return the list of nodes to monitor
+    :param args: Script argument
+    :return: List of node names
     """
-    return "http://wattmetre."+city_name+".grid5000.fr/GetWatts-json.php"
+    return [node for node in args.node_name.split(',') if node]
 
 
 def is_omegawatt_available(args):
     """
-    Allow to know if Omegawatt-sensor is available for this node
+    Allow to know if Omegawatt-sensor is available for all the nodes
     :param args: Script argument
     :return: True if available, False otherwise
     """
-    # City in ["grenoble", "lyon"]
-    # http://wattmetre.<CITY>.grid5000.fr/GetWatts-json.php
-    # Browse JSON dict and found "NODE_NAME"
-    if args.city_name not in ['grenoble', 'lyon']:
+    if args.city_name not in wattmetre.CITIES:
+        LOGGER.error("Omegawatt-sensor not available in " + args.city_name)
         return False
 
-    url = get_omegawatt_url(args.city_name)
-    data = requests.get(url).json()
-    for node in data.items():
-        if args.node_name in node:
-            return True
-    return False
+    missing = wattmetre.get_unavailable_nodes(args.city_name, get_nodes(args))
+    for node_name in missing:
+        LOGGER.error("Omegawatt-sensor not available for the node " + node_name)
+    return not missing
 
 
-def create_data(timestamp, sensor, power):
+def get_cache(args):
     """
-    Create the Dict with data
-    :param timestamp: Timestamp int
-    :param sensor: Sensor name
-    :param power: Power value
-    :return: Dict data
+    Return the cache of the hourly logs
+    :param args: Script arguments
+    :return: ArchiveCache, None if no cache directory is given
     """
-    return {
-        "timestamp": timestamp,
-        "sensor": sensor,
-        "power": power
-    }
+    if args.cache_dir is None:
+        return None
+    return ArchiveCache(args.cache_dir, args.cache_size * 1024 * 1024)
 
 
-def connect_mongodb(args):
+def get_checkpoints(args):
     """
-    Return the collection to write the output
+    Return the checkpoints of the output
     :param args: Script arguments
-    :return: MongoDB collection
+    :return: Checkpoints, None with --no-checkpoints
     """
-    mongo_client = pymongo.MongoClient(args.mongodb_uri,
-                                       serverSelectionTimeoutMS=5)
-    collection = mongo_client[args.mongodb_db][args.mongodb_collection]
-
-    # Check if it work
-    try:
-        mongo_client.admin.command('ismaster')
-    except pymongo.errors.ServerSelectionTimeoutError:
-        LOGGER.error("MongoDB error.")
-        exit(-1)
+    if args.no_checkpoints:
+        return None
+    return Checkpoints(get_output_id(args.mongodb_uri, args.mongodb_db, args.mongodb_collection),
+                       args.checkpoints)
 
-    return collection
 
 ##############################################################################
 # Parser
@@ -113,18 +99,68 @@ def arg_parser_init():
         description="Start PowerAPI with the specified configuration.")
 
     # MongoDB output
-    parser.add_argument("mongodb_uri", help="MongoDB output uri")
-    parser.add_argument("mongodb_db", help="MongoDB output database")
-    parser.add_argument("mongodb_collection", help="MongoDB output collection")
+    parser.add_argument("mongodb_uri", help="MongoDB output uri, or npy://, parquet:// or arrow:// and a directory")
+    parser.add_argument("mongodb_db", help="MongoDB output database, or sub-directory")
+    parser.add_argument("mongodb_collection", help="MongoDB output collection, or sub-directory")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of documents written in one insert_many")
+    parser.add_argument("--flush-interval", type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help="Maximum number of seconds a document stays buffered")
+    parser.add_argument("--layout", choices=LAYOUTS, default='document',
+                        help="One document by sample, by bucket of samples, or a time-series collection")
+    parser.add_argument("--bucket-size", type=int, default=DEFAULT_BUCKET_SIZE,
+                        help="Seconds covered by one bucket document")
+    parser.add_argument("--rollups", action="store_true",
+                        help="Also update the 10 s, 1 min and 1 h rollups of the MongoDB collection")
 
     # Node informations
     parser.add_argument("city_name", help="City name where the cluster is")
     parser.add_argument("cluster_name", help="Cluster name where the node is")
-    parser.add_argument("node_name", help="Node name to monitor")
+    parser.add_argument("node_name", help="Node name to monitor, or comma separated list of nodes")
 
     # Timestamp information
-    parser.add_argument("timestamp_start", help="Timestamp where begin the series")
-    parser.add_argument("timestamp_stop", help="Timestamp where end the series")
+    parser.add_argument("timestamp_start", nargs="?", help="Timestamp where begin the series")
+    parser.add_argument("timestamp_stop", nargs="?", help="Timestamp where end the series")
+
+    # Live mode, instead of the window
+    parser.add_argument("--follow", action="store_true",
+                        help="Write the samples as they are logged, from the current hour, until SIGTERM")
+    parser.add_argument("--period", type=float, default=wattmetre.DEFAULT_PERIOD,
+                        help="Seconds between two reads of the current logs, with --follow")
+
+    # Cache of the node metadata
+    parser.add_argument("--metadata-cache", default=DEFAULT_CACHE_FILE,
+                        help="JSON file caching the PDU of the nodes")
+    parser.add_argument("--metadata-ttl", type=float, default=DEFAULT_TTL,
+                        help="Seconds before the metadata of a node is fetched again")
+    parser.add_argument("--workers", type=int, default=wattmetre.DEFAULT_WORKERS,
+                        help="Number of hourly logs downloaded concurrently")
+
+    # Resolution, the mean of every second by default
+    resolution = parser.add_mutually_exclusive_group()
+    resolution.add_argument("--raw", action="store_true",
+                            help="Keep every sample with its original timestamp")
+    resolution.add_argument("--window", type=float,
+                            help="Resample on bins of WINDOW seconds (e.g. 0.02, 0.1, 1)")
+    parser.add_argument("--aggregator", choices=wattmetre.AGGREGATORS, default='mean',
+                        help="Aggregation of the samples of a bin, with --window")
+
+    # Cache of the closed hourly logs
+    parser.add_argument("--cache-dir", help="Directory where the closed hourly logs are cached")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help="Maximum size of the cache, in MB")
+    parser.add_argument("--cache-arrays", action="store_true",
+                        help="Also cache the parsed samples of the node")
+
+    # Checkpoints of the ranges already written
+    parser.add_argument("--checkpoints", default=DEFAULT_CHECKPOINT_FILE,
+                        help="JSON file of the ranges already written, only the missing ones are fetched")
+    parser.add_argument("--no-checkpoints", action="store_true",
+                        help="Fetch the whole window, without reading nor writing the checkpoints")
+
+    # Instrumentation
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="JSON file of the metrics summary written at the end, logged by default")
 
     return parser
 
@@ -132,68 +168,49 @@ def arg_parser_init():
 # Main
 ##############################################################################
 
-def parse_omegawatt(args):
-    """
-    source: https://gitlab.inria.fr/delamare/wattmetre-read/raw/master/tools/getwatt.py
-    :param args: Script argument
-    :return: A list of (timestamp, value) tuples.
-    """
-
-    watt = {}
-    node_wattmetre = get_host_attributes(args.node_name)['sensors']['power']['via']['pdu'][0]
-    from_ts = int(args.timestamp_start)
-    to_ts = int(args.timestamp_stop)
-
-    for ts in range(from_ts, to_ts+3600, 3600):
-        suffix = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%dT%H')
-        if suffix != datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%dT%H'):
-            suffix += ".gz"
-        req = requests.get("http://wattmetre."+args.city_name+".grid5000.fr/data/"+node_wattmetre['uid']+"-log/power.csv."+suffix)
-        if req.status_code == 404:
-            return watt
-        data = req.content
-        if suffix.endswith(".gz"):
-            data = gzip.decompress(data)
-        for l in str(data).split('\\n')[1:-1]:
-            l = l.split(',')
-            if l[3] == 'OK' and l[4+node_wattmetre['port']] != '':
-                ts, value = (int(np.round(float(l[2]))), float(l[4+node_wattmetre['port']]))
-                if from_ts <= ts and ts <= to_ts:
-                    if ts not in watt:
-                        watt[ts] = [0, 0]
-                    watt[ts][0] += value
-                    watt[ts][1] += 1
-        if not suffix.endswith(".gz"):
-            break
-
-    for ts, val in watt.items():
-        watt[ts] = watt[ts][0] / watt[ts][1]
-    return watt
-
-
 def main():
     """
     Main function of the Omegawatt-sensor
     """
-    args = arg_parser_init().parse_args()
+    parser = arg_parser_init()
+    args = parser.parse_args()
+    if not args.follow and args.timestamp_stop is None:
+        parser.error("timestamp_start and timestamp_stop are required without --follow")
     LOGGER.warning("/!\ Make sure you are in the G5K network /!\\")
 
     if not is_omegawatt_available(args):
-        LOGGER.error("Omegawatt-sensor not available for the node " + args.node_name)
         sys.exit(-1)
 
-    output = connect_mongodb(args)
-    data = parse_omegawatt(args)
-
-    for ts in range(int(args.timestamp_start), int(args.timestamp_stop)):
-        # If offset is outofrange or
-        #    data timestamp is different from the current ts
-        if ts not in data:
-            continue
-
-        new_row = create_data(ts, "omegawatt-sensor", data[ts])
-        output.insert_one(new_row)
-
+    # Signal handling
+    def term_handler(_, __):
+        LOGGER.warning("Ended by user.")
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, term_handler)
+    signal.signal(signal.SIGINT, term_handler)
+
+    metadata = NodeMetadata(args.metadata_cache, args.metadata_ttl)
+    output = create_output(args.mongodb_uri, args.mongodb_db, args.mongodb_collection,
+                           args.layout,
+                           args.bucket_size,
+                           args.batch_size,
+                           args.flush_interval,
+                           args.rollups)
+    new_collector = functools.partial(wattmetre.create_collector, raw=args.raw, window=args.window,
+                                      aggregator=args.aggregator)
+    try:
+        if args.follow:
+            wattmetre.follow(output, metadata, args.city_name, get_nodes(args), new_collector,
+                             args.window or 1, args.period)
+        else:
+            wattmetre.collect(output, metadata, args.city_name, get_nodes(args),
+                              args.timestamp_start, args.timestamp_stop, new_collector,
+                              args.workers, get_cache(args), args.cache_arrays,
+                              checkpoints=get_checkpoints(args))
+    finally:
+        output.close()
+        metadata.save()
+        metrics.write_summary(args.metrics)
 
 if __name__ == "__main__":
     main()
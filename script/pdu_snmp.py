@@ -0,0 +1,285 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module PDU-SNMP, read the power of the APC PDU outlets
+"""
+
+import asyncio
+import datetime
+import logging
+import math
+import time
+from pyasn1.error import PyAsn1Error
+from pysnmp.hlapi.asyncio import getCmd, SnmpEngine, CommunityData, UdpTransportTarget, ContextData, ObjectIdentity, ObjectType
+import metrics
+from bulk_writer import create_data
+from node_metadata import get_pdu_host_name
+
+LOGGER = logging.getLogger(__name__)
+
+SENSOR_NAME = "snmp-sensor"
+METRIC_LABELS = {"sensor": SENSOR_NAME}
+
+OUTLET_POWER_OID = '1.3.6.1.4.1.318.1.1.26.9.4.3.1.7'
+DATE_OID = '1.3.6.1.4.1.318.2.1.6.1.0'
+TIME_OID = '1.3.6.1.4.1.318.2.1.6.2.0'
+
+DEFAULT_PERIOD = 1.0
+# The poller stops after this number of polls in a row without any PDU answering
+MAX_FAILED_POLLS = 10
+# Replaced by a local agent in the benchmark
+SNMP_PORT = 161
+
+
+def parse_pdu_clock(date, clock):
+    """
+    Return the timestamp of the PDU clock
+    :param date: Value of DATE_OID (e.g. 03/26/2019)
+    :param clock: Value of TIME_OID (e.g. 10:24:17)
+    :return: Timestamp int
+    """
+    timestamp_str = str(date) + " " + str(clock)
+    return int(time.mktime(datetime.datetime.strptime(timestamp_str, "%m/%d/%Y %H:%M:%S").timetuple()))
+
+
+def get_unavailable_nodes(metadata, nodes):
+    """
+    Return the nodes without PDU
+    :param metadata: NodeMetadata
+    :param nodes: List of node names
+    :return: List of node names
+    """
+    return [node_name for node_name in nodes if not metadata.get_pdus(node_name)]
+
+
+def get_pdu_outlets(metadata, city_name, nodes):
+    """
+    Return the PDU to read, and the outlets of every node
+    :param metadata: NodeMetadata
+    :param city_name: City name
+    :param nodes: List of node names
+    :return: Dict PDU name -> (IP, sorted list of ports to read),
+             Dict node name -> list of (PDU name, port)
+    """
+    pdus_infos = {}
+    nodes_outlets = {}
+    for node_name in nodes:
+        nodes_outlets[node_name] = []
+        for pdu_info in metadata.get_pdus(node_name):
+            pdu_name, port = pdu_info['uid'], pdu_info['port']
+            if pdu_name not in pdus_infos:
+                ip = metadata.get_ip(get_pdu_host_name(pdu_name, city_name))
+                pdus_infos[pdu_name] = (ip, set())
+            pdus_infos[pdu_name][1].add(port)
+            nodes_outlets[node_name].append((pdu_name, port))
+
+    pdus_infos = {pdu_name: (ip, sorted(ports)) for pdu_name, (ip, ports) in pdus_infos.items()}
+    return pdus_infos, nodes_outlets
+
+
+class PduSession:
+    """
+    Long-lived SNMP engine and transport to one PDU, reused by every poll
+    """
+
+    def __init__(self, pdu_name, pdu_ip, community='public'):
+        """
+        :param pdu_name: PDU uid
+        :param pdu_ip: PDU IP
+        :param community: SNMP community
+        """
+        self.pdu_name = pdu_name
+        self.engine = SnmpEngine()
+        self.auth = CommunityData(community, mpModel=1)
+        self.target = UdpTransportTarget((pdu_ip, SNMP_PORT))
+        self.context = ContextData()
+        # Outlets without power value in the last answer, logged once
+        self.failed_ports = set()
+
+    async def get(self, *oids):
+        """
+        GET some OIDs
+        :param oids: OID strings
+        :return: List of values, None if the request failed
+        """
+        errorIndication, errorStatus, errorIndex, varBinds = await getCmd(
+            self.engine,
+            self.auth,
+            self.target,
+            self.context,
+            *[ObjectType(ObjectIdentity(oid)) for oid in oids]
+        )
+
+        if errorIndication:
+            LOGGER.error("%s: %s", self.pdu_name, errorIndication)
+            return None
+        if errorStatus:
+            LOGGER.error('%s: %s at %s' % (
+                self.pdu_name,
+                errorStatus.prettyPrint(),
+                errorIndex and varBinds[int(errorIndex) - 1][0] or '?'
+            ))
+            return None
+        return [value for _, value in varBinds]
+
+    async def read_watts(self, ports):
+        """
+        Read the power of several outlets and the PDU clock with one GET
+        :param ports: Outlets of the PDU
+        :return: (dict port -> watt, timestamp, latency in seconds), watts and
+                 timestamp are None if the request failed, the outlets without
+                 power value (e.g. noSuchInstance) are missing from watts
+        """
+        labels = {"pdu": self.pdu_name}
+        begin = time.monotonic()
+        values = await self.get(*([OUTLET_POWER_OID + '.' + str(port) for port in ports] + [DATE_OID, TIME_OID]))
+        latency = time.monotonic() - begin
+        metrics.observe("snmp_poll_seconds", latency, labels)
+        if values is None:
+            metrics.inc("snmp_poll_errors_total", 1, labels)
+            return None, None, latency
+        watts = {}
+        for port, value in zip(ports, values):
+            try:
+                watts[port] = int(value)
+            except (PyAsn1Error, TypeError, ValueError):
+                metrics.inc("snmp_outlet_errors_total", 1, labels)
+                if port not in self.failed_ports:
+                    self.failed_ports.add(port)
+                    LOGGER.error("%s: no power for the outlet %d: %s", self.pdu_name, port, value.prettyPrint())
+                continue
+            if port in self.failed_ports:
+                self.failed_ports.discard(port)
+                LOGGER.warning("%s: power of the outlet %d read again.", self.pdu_name, port)
+        timestamp = parse_pdu_clock(values[-2], values[-1])
+        # The PDU clock has a one second resolution, compared to the middle of the request
+        metrics.gauge("snmp_clock_skew_seconds", timestamp - (time.time() - latency / 2), labels)
+        return watts, timestamp, latency
+
+    def close(self):
+        """
+        Close the transport of the engine
+        """
+        self.engine.transportDispatcher.closeDispatcher()
+
+
+async def run_periodic(period, poll):
+    """
+    Call poll every period seconds, without drift
+
+    The deadlines are start + k * period whatever the poll duration. When a
+    poll lasts more than a period, the missed deadlines are skipped.
+    :param period: Seconds between two polls
+    :param poll: Coroutine function, stops the loop when it returns False
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time()
+    while True:
+        if await poll() is False:
+            return
+        deadline += period
+        delay = deadline - loop.time()
+        if delay < 0:
+            LOGGER.warning("Poll lasted %.3f s more than the period.", -delay)
+            metrics.inc("poll_overruns_total", 1, METRIC_LABELS)
+            deadline += period * math.ceil(-delay / period)
+            delay = deadline - loop.time()
+        await asyncio.sleep(delay)
+
+
+class SnmpPoller:
+    """
+    Read the PDU of some nodes and queue one document by node and PDU timestamp
+    """
+
+    def __init__(self, pdus_infos, nodes_outlets, output, sessions=None):
+        """
+        :param pdus_infos: Dict PDU name -> (IP, sorted list of ports to read)
+        :param nodes_outlets: Dict node name -> list of (PDU name, port)
+        :param output: QueueWriter
+        :param sessions: Dict PDU name -> PduSession, shared with other pollers
+        """
+        self.pdus_infos = pdus_infos
+        self.nodes_outlets = nodes_outlets
+        self.output = output
+        self.sessions = sessions if sessions is not None else {}
+        for pdu_name, (pdu_ip, _) in pdus_infos.items():
+            if pdu_name not in self.sessions:
+                self.sessions[pdu_name] = PduSession(pdu_name, pdu_ip)
+        self.next_ts = {node_name: 0 for node_name in nodes_outlets}
+        # Polls in a row a PDU did not answer
+        self.failures = {pdu_name: 0 for pdu_name in pdus_infos}
+
+    async def poll(self):
+        """
+        Read each PDU once, whatever the number of nodes on it
+
+        The nodes of a PDU which did not answer, or of an outlet without
+        power value, are skipped for this poll.
+        :return: False once no PDU answered MAX_FAILED_POLLS polls in a row, True otherwise
+        """
+        pdu_names = list(self.pdus_infos)
+        results = await asyncio.gather(*[self.sessions[pdu_name].read_watts(self.pdus_infos[pdu_name][1])
+                                         for pdu_name in pdu_names])
+
+        pdus_values = {}
+        for pdu_name, (watts, timestamp, latency) in zip(pdu_names, results):
+            if watts is None and timestamp is None:
+                self.failures[pdu_name] += 1
+                if self.failures[pdu_name] == 1:
+                    LOGGER.warning("Loose connection with the PDU %s, its nodes are skipped.", pdu_name)
+                continue
+            if self.failures[pdu_name]:
+                LOGGER.warning("PDU %s answers again after %d failed polls.", pdu_name, self.failures[pdu_name])
+                self.failures[pdu_name] = 0
+            pdus_values[pdu_name] = (watts, timestamp, latency)
+        if self.failures and min(self.failures.values()) >= MAX_FAILED_POLLS:
+            LOGGER.error("No PDU answered the last %d polls.", MAX_FAILED_POLLS)
+            return False
+
+        for node_name, outlets in self.nodes_outlets.items():
+            if any(pdu_name not in pdus_values or port not in pdus_values[pdu_name][0]
+                   for pdu_name, port in outlets):
+                continue
+            ts = 0
+            value = 0
+            latency = 0
+            for pdu_name, port in outlets:
+                watts, timestamp, pdu_latency = pdus_values[pdu_name]
+                ts = timestamp
+                value += watts[port]
+                latency = max(latency, pdu_latency)
+
+            new_data = create_data(ts, SENSOR_NAME, value, node_name, latency=latency)
+            if self.next_ts[node_name] < new_data["timestamp"]:
+                LOGGER.info(new_data)
+                await self.output.put(new_data)
+                self.next_ts[node_name] = new_data["timestamp"]
+                metrics.inc("rows_accepted_total", 1, METRIC_LABELS)
+            else:
+                # Same PDU second as the previous poll
+                metrics.inc("rows_rejected_total", 1, METRIC_LABELS)
+        return True
+
+    def close(self):
+        """
+        Close the sessions of the PDU of this poller
+        """
+        for pdu_name in self.pdus_infos:
+            session = self.sessions.pop(pdu_name, None)
+            if session is not None:
+                session.close()
@@ -0,0 +1,337 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Rollup, aggregates of the samples kept up to date at ingest time
+
+Next to a collection, one collection by level (<collection>_10s,
+<collection>_1m, <collection>_1h) holds a document by node, sensor and
+level interval: {node, sensor, start, end, count, sum, min, max, energy}.
+The MongoDB writers give the samples they inserted, so the samples already
+written by a previous run are not counted twice. The energy, in joules, is
+the trapezoidal integral of the power between consecutive samples closer
+than MAX_GAP seconds. At ingest time the interval ending at a sample is
+only integrated from the last sample this process added for the node: the
+first sample of a batch older than it, or of every backfill slice or
+process, gets no energy. rebuild integrates the samples of its window in
+order, from the sample before it, so it gives the energy of the raw series.
+
+query reads the coarsest level fitting a resolution. To build the rollups
+of samples written without them:
+
+    python rollup.py [--layout LAYOUT] mongodb_uri mongodb_db mongodb_collection \\
+        node_name sensor timestamp_start timestamp_stop
+"""
+
+import argparse
+import logging
+import numpy as np
+import pymongo
+import metrics
+from bulk_writer import connect_mongodb, create_bucket_index, LAYOUTS
+
+LOGGER = logging.getLogger(__name__)
+
+LEVELS = (10, 60, 3600)
+LEVEL_NAMES = {10: "10s", 60: "1m", 3600: "1h"}
+# Samples further apart are not integrated in the energy
+MAX_GAP = 5
+# Maximum number of points returned by query, the level is coarsened beyond
+DEFAULT_MAX_POINTS = 5000
+# Seconds read at once when building the rollups of existing samples
+REBUILD_CHUNK_SIZE = 24 * 3600
+
+METRIC_LABELS = {"layout": "rollup"}
+
+
+def get_rollup_name(collection_name, level):
+    """
+    :param collection_name: Name of the collection of the samples
+    :param level: Seconds of the level, one of LEVELS
+    :return: Name of the collection of the level
+    """
+    return collection_name + "_" + LEVEL_NAMES.get(level, str(level) + "s")
+
+
+def get_sample(document):
+    """
+    :param document: Dict data, or measurement of a time-series collection
+    :return: (node, sensor, timestamp, power)
+    """
+    if "meta" in document:
+        return (document["meta"]["node"], document["meta"]["sensor"],
+                document["timestamp"].timestamp(), document["power"])
+    return document["node"], document["sensor"], document["timestamp"], document["power"]
+
+
+class Rollups:
+    """
+    Aggregates of the samples by level, merged in memory and upserted at flush
+    """
+
+    def __init__(self, database, collection_name, levels=LEVELS, max_gap=MAX_GAP):
+        """
+        :param database: MongoDB database
+        :param collection_name: Name of the collection of the samples
+        :param levels: Seconds of the levels
+        :param max_gap: Maximum number of seconds between two samples integrated in the energy
+        """
+        self.levels = sorted(levels)
+        self.max_gap = float(max_gap)
+        self.collections = {level: database[get_rollup_name(collection_name, level)] for level in self.levels}
+        for collection in self.collections.values():
+            create_bucket_index(collection)
+        # level -> {(node, sensor, start): [count, sum, min, max, energy]}
+        self._pending = {level: {} for level in self.levels}
+        # (node, sensor) -> (timestamp, power) of the last sample, for the energy
+        self._last = {}
+
+    def add(self, documents):
+        """
+        Add written documents
+        :param documents: Iterable of Dict data
+        """
+        groups = {}
+        for document in documents:
+            node, sensor, timestamp, power = get_sample(document)
+            samples = groups.setdefault((node, sensor), ([], []))
+            samples[0].append(timestamp)
+            samples[1].append(power)
+        for (node, sensor), (timestamps, powers) in groups.items():
+            self.add_samples(node, sensor, timestamps, powers)
+
+    def add_samples(self, node, sensor, timestamps, powers):
+        """
+        Add written samples of a node
+        :param node: Node name
+        :param sensor: Sensor name
+        :param timestamps: Sequence of timestamps
+        :param powers: Sequence of powers
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        powers = np.asarray(powers, dtype=np.float64)
+        mask = ~np.isnan(powers)
+        timestamps, powers = timestamps[mask], powers[mask]
+        if not len(timestamps):
+            return
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, powers = timestamps[order], powers[order]
+
+        # Energy of the interval ending at each sample
+        last_timestamp, last_power = self._last.get((node, sensor), (np.nan, np.nan))
+        previous_timestamps = np.concatenate(([last_timestamp], timestamps[:-1]))
+        previous_powers = np.concatenate(([last_power], powers[:-1]))
+        gaps = timestamps - previous_timestamps
+        with np.errstate(invalid='ignore'):
+            integrated = (gaps > 0) & (gaps <= self.max_gap)
+        energies = np.where(integrated, gaps * (powers + previous_powers) / 2, 0.0)
+        if np.isnan(last_timestamp) or timestamps[-1] >= last_timestamp:
+            self._last[(node, sensor)] = (timestamps[-1], powers[-1])
+
+        for level in self.levels:
+            starts = np.floor(timestamps / level).astype(np.int64) * level
+            firsts = np.concatenate(([0], np.flatnonzero(np.diff(starts)) + 1))
+            counts = np.diff(np.append(firsts, len(timestamps)))
+            pending = self._pending[level]
+            for start, count, total, low, high, energy in zip(starts[firsts].tolist(),
+                                                              counts.tolist(),
+                                                              np.add.reduceat(powers, firsts).tolist(),
+                                                              np.minimum.reduceat(powers, firsts).tolist(),
+                                                              np.maximum.reduceat(powers, firsts).tolist(),
+                                                              np.add.reduceat(energies, firsts).tolist()):
+                entry = pending.get((node, sensor, start))
+                if entry is None:
+                    pending[(node, sensor, start)] = [count, total, low, high, energy]
+                else:
+                    entry[0] += count
+                    entry[1] += total
+                    entry[2] = min(entry[2], low)
+                    entry[3] = max(entry[3], high)
+                    entry[4] += energy
+
+    def set_last(self, node, sensor, timestamp, power):
+        """
+        Give the sample before the next added ones, for the energy of their first interval
+        :param node: Node name
+        :param sensor: Sensor name
+        :param timestamp: Timestamp of the sample
+        :param power: Power of the sample
+        """
+        self._last[(node, sensor)] = (float(timestamp), float(power))
+
+    def flush(self):
+        """
+        Upsert the pending aggregates, on error they stay pending
+        """
+        for level in self.levels:
+            pending = self._pending[level]
+            if not pending:
+                continue
+            with metrics.timer("write_seconds", METRIC_LABELS):
+                self.collections[level].bulk_write([
+                    pymongo.UpdateOne(
+                        {"node": node, "sensor": sensor, "start": start},
+                        {
+                            "$setOnInsert": {"end": start + level},
+                            "$inc": {"count": count, "sum": total, "energy": energy},
+                            "$min": {"min": low},
+                            "$max": {"max": high}
+                        },
+                        upsert=True)
+                    for (node, sensor, start), (count, total, low, high, energy) in pending.items()],
+                    ordered=False)
+            metrics.inc("documents_written_total", len(pending), METRIC_LABELS)
+            pending.clear()
+
+    def delete(self, node, sensor, timestamp_start, timestamp_stop):
+        """
+        Remove the aggregates of a node starting in a range
+        :param node: Node name
+        :param sensor: Sensor name
+        :param timestamp_start: Timestamp to begin
+        :param timestamp_stop: Timestamp to stop (excluded)
+        """
+        for collection in self.collections.values():
+            collection.delete_many({"node": node, "sensor": sensor,
+                                    "start": {"$gte": timestamp_start, "$lt": timestamp_stop}})
+        self._last.pop((node, sensor), None)
+
+
+def choose_level(timestamp_start, timestamp_stop, resolution, max_points=DEFAULT_MAX_POINTS, levels=LEVELS):
+    """
+    Return the coarsest level fitting a resolution, coarser if it gives too many points
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param resolution: Wanted seconds between two points
+    :param max_points: Maximum number of points
+    :param levels: Seconds of the levels
+    :return: Level in seconds, None for the samples
+    """
+    levels = sorted(levels)
+    fitting = [level for level in levels if level <= resolution]
+    level = fitting[-1] if fitting else None
+    for coarser in levels:
+        if (level is None or coarser > level) and (timestamp_stop - timestamp_start) / (level or 1) > max_points:
+            level = coarser
+    return level
+
+
+def query(database, collection_name, node, sensor, timestamp_start, timestamp_stop, resolution,
+          max_points=DEFAULT_MAX_POINTS, levels=LEVELS, layout='document'):
+    """
+    Read the aggregates of a node on bins of the resolution, from the coarsest fitting level
+    :param database: MongoDB database
+    :param collection_name: Name of the collection of the samples
+    :param node: Node name
+    :param sensor: Sensor name
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param resolution: Wanted seconds between two points
+    :param max_points: Maximum number of points, the level is coarsened beyond
+    :param levels: Seconds of the levels
+    :param layout: Layout of the samples, read when no level fits
+    :return: Dict of arrays start, count, mean, min, max, energy (NaN without samples),
+             and the level read (None for the samples)
+    """
+    level = choose_level(timestamp_start, timestamp_stop, resolution, max_points, levels)
+    if level is None:
+        from series_reader import MongoReader
+
+        timestamps, powers = MongoReader(database[collection_name], node, sensor, layout).read(
+            timestamp_start, timestamp_stop)
+        starts, counts = timestamps, np.ones(len(timestamps))
+        totals, lows, highs, energies = powers, powers, powers, np.full(len(timestamps), np.nan)
+    else:
+        documents = list(database[get_rollup_name(collection_name, level)].find(
+            {"node": node, "sensor": sensor, "start": {"$gte": timestamp_start - level, "$lt": timestamp_stop}},
+            {"_id": 0, "start": 1, "count": 1, "sum": 1, "min": 1, "max": 1, "energy": 1}).sort("start", 1))
+        documents = [document for document in documents if document["start"] + level > timestamp_start]
+        columns = {field: np.array([document[field] for document in documents], dtype=np.float64)
+                   for field in ("start", "count", "sum", "min", "max", "energy")}
+        starts, counts, totals = columns["start"], columns["count"], columns["sum"]
+        lows, highs, energies = columns["min"], columns["max"], columns["energy"]
+
+    # Merge the points in the bins of the resolution, when the level is finer
+    size = max(resolution, level or 0)
+    bins = np.floor((np.maximum(starts, timestamp_start) - timestamp_start) / size).astype(np.int64)
+    length = int(np.ceil((timestamp_stop - timestamp_start) / size))
+    count = np.bincount(bins, weights=counts, minlength=length)
+    low, high = np.full(length, np.inf), np.full(length, -np.inf)
+    np.minimum.at(low, bins, lows)
+    np.maximum.at(high, bins, highs)
+    filled = count > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {
+            "level": level,
+            "start": timestamp_start + np.arange(length) * size,
+            "count": count,
+            "mean": np.bincount(bins, weights=totals, minlength=length) / count,
+            "min": np.where(filled, low, np.nan),
+            "max": np.where(filled, high, np.nan),
+            "energy": np.where(filled, np.bincount(bins, weights=energies, minlength=length), np.nan)
+        }
+
+
+def rebuild(reader, rollups, node, sensor, timestamp_start, timestamp_stop):
+    """
+    Compute again the aggregates of a node from its samples
+    :param reader: series_reader reader of the samples
+    :param rollups: Rollups
+    :param node: Node name
+    :param sensor: Sensor name
+    :param timestamp_start: Timestamp to begin, rounded down to the coarsest level
+    :param timestamp_stop: Timestamp to stop, rounded up to the coarsest level
+    """
+    coarsest = rollups.levels[-1]
+    timestamp_start = int(timestamp_start) // coarsest * coarsest
+    timestamp_stop = -(-int(timestamp_stop) // coarsest) * coarsest
+    rollups.delete(node, sensor, timestamp_start, timestamp_stop)
+    # The interval ending at the first sample begins before the window
+    timestamps, powers = reader.read(timestamp_start - rollups.max_gap, timestamp_start)
+    mask = ~np.isnan(powers)
+    if mask.any():
+        rollups.set_last(node, sensor, timestamps[mask][-1], powers[mask][-1])
+    for start in range(timestamp_start, timestamp_stop, REBUILD_CHUNK_SIZE):
+        timestamps, powers = reader.read(start, min(start + REBUILD_CHUNK_SIZE, timestamp_stop))
+        rollups.add_samples(node, sensor, timestamps, powers)
+        rollups.flush()
+
+
+def main():
+    """
+    Build the rollups of the samples of a node already written
+    """
+    from series_reader import MongoReader
+
+    parser = argparse.ArgumentParser(description="Build the rollups of the samples of a node already written.")
+    parser.add_argument("--layout", choices=LAYOUTS, default='document', help="Layout of the samples")
+    parser.add_argument("mongodb_uri", help="MongoDB uri")
+    parser.add_argument("mongodb_db", help="MongoDB database")
+    parser.add_argument("mongodb_collection", help="MongoDB collection of the samples")
+    parser.add_argument("node_name", help="Node name")
+    parser.add_argument("sensor", help="Sensor name (e.g. kwapi-sensor)")
+    parser.add_argument("timestamp_start", type=int, help="Timestamp where begin the rollups")
+    parser.add_argument("timestamp_stop", type=int, help="Timestamp where end the rollups")
+    args = parser.parse_args()
+
+    collection = connect_mongodb(args.mongodb_uri, args.mongodb_db, args.mongodb_collection)
+    rebuild(MongoReader(collection, args.node_name, args.sensor, args.layout),
+            Rollups(collection.database, collection.name),
+            args.node_name, args.sensor, args.timestamp_start, args.timestamp_stop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Series-reader, read back the series written by the sensors
+
+A reader gives the samples of one node and sensor on a time range, as
+sorted float64 arrays, whatever the output: MongoDB with any layout of
+bulk_writer, or the files of file_sink. Long windows are read range by
+range, so only one range is in memory at a time.
+"""
+
+import datetime
+import os
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 24 * 3600
+# Number of records checked at once when looking whether an npy file is sorted
+SCAN_SIZE = 1 << 20
+
+
+def drop_repeated(timestamps, values):
+    """
+    Keep the first sample of a timestamp: the file outputs are only appended,
+    and may hold twice the part of a backfill written before an error
+    :param timestamps: Sorted float64 timestamps
+    :param values: float64 values
+    :return: (timestamps, values) without repeated timestamp
+    """
+    if len(timestamps) > 1:
+        repeated = np.diff(timestamps) == 0
+        if np.any(repeated):
+            mask = np.concatenate(([True], ~repeated))
+            return timestamps[mask], values[mask]
+    return timestamps, values
+
+
+def sort_series(timestamps, values):
+    """
+    :param timestamps: float64 timestamps
+    :param values: float64 values
+    :return: (timestamps, values) sorted by timestamp, without repeated timestamp
+    """
+    if len(timestamps) > 1 and np.any(np.diff(timestamps) < 0):
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, values = timestamps[order], values[order]
+    return drop_repeated(timestamps, values)
+
+
+class MongoReader:
+    """
+    Samples of a node from a MongoDB collection written by bulk_writer
+    """
+
+    def __init__(self, collection, node, sensor, layout='document'):
+        """
+        :param collection: MongoDB collection
+        :param node: Node name
+        :param sensor: Sensor name
+        :param layout: One of bulk_writer.LAYOUTS
+        """
+        self.collection = collection
+        self.node = node
+        self.sensor = sensor
+        self.layout = layout
+
+    def read(self, timestamp_start, timestamp_stop):
+        """
+        :param timestamp_start: Timestamp to begin
+        :param timestamp_stop: Timestamp to stop (excluded)
+        :return: Sorted float64 timestamps, float64 powers
+        """
+        if self.layout == 'bucket':
+            return self._read_buckets(timestamp_start, timestamp_stop)
+        if self.layout == 'timeseries':
+            return self._read_timeseries(timestamp_start, timestamp_stop)
+        # Sorted by the unique index of create_unique_index
+        documents = list(self.collection.find(
+            {"node": self.node, "sensor": self.sensor,
+             "timestamp": {"$gte": timestamp_start, "$lt": timestamp_stop}},
+            {"_id": 0, "timestamp": 1, "power": 1}).sort("timestamp", 1))
+        return (np.array([document["timestamp"] for document in documents], dtype=np.float64),
+                np.array([document["power"] for document in documents], dtype=np.float64))
+
+    def _read_buckets(self, timestamp_start, timestamp_stop):
+        timestamps, values = [], []
+        for bucket in self.collection.find(
+                {"node": self.node, "sensor": self.sensor,
+                 "start": {"$lt": timestamp_stop}, "end": {"$gt": timestamp_start}},
+                {"_id": 0, "timestamps": 1, "power": 1}).sort("start", 1):
+            timestamps.append(np.asarray(bucket["timestamps"], dtype=np.float64))
+            values.append(np.asarray(bucket["power"], dtype=np.float64))
+        if not timestamps:
+            return np.empty(0), np.empty(0)
+        timestamps, values = np.concatenate(timestamps), np.concatenate(values)
+        mask = (timestamps >= timestamp_start) & (timestamps < timestamp_stop)
+        return sort_series(timestamps[mask], values[mask])
+
+    def _read_timeseries(self, timestamp_start, timestamp_stop):
+        documents = list(self.collection.find(
+            {"meta.node": self.node, "meta.sensor": self.sensor,
+             "timestamp": {"$gte": datetime.datetime.fromtimestamp(timestamp_start, datetime.timezone.utc),
+                           "$lt": datetime.datetime.fromtimestamp(timestamp_stop, datetime.timezone.utc)}},
+            {"_id": 0, "timestamp": 1, "power": 1}).sort("timestamp", 1))
+        # Dates are naive UTC, with a millisecond resolution
+        dates = np.array([document["timestamp"] for document in documents], dtype='datetime64[ms]')
+        return (dates.astype(np.int64) / 1000.0,
+                np.array([document["power"] for document in documents], dtype=np.float64))
+
+
+class NpyReader:
+    """
+    Samples of a node from the npy file of file_sink, mapped without copy
+    """
+
+    def __init__(self, directory, node, sensor):
+        """
+        :param directory: Output directory
+        :param node: Node name
+        :param sensor: Sensor name
+        """
+        import file_sink
+
+        self.records = file_sink.load_npy(directory, node, sensor)
+        self.timestamps = self.records['timestamp']
+        self._order = None
+        # Files are appended in write order, a resumed backfill may go back in time
+        for start in range(0, len(self.timestamps), SCAN_SIZE):
+            if np.any(np.diff(self.timestamps[max(0, start - 1):start + SCAN_SIZE]) < 0):
+                self._order = np.argsort(self.timestamps, kind='stable')
+                self.timestamps = self.timestamps[self._order]
+                break
+
+    def read(self, timestamp_start, timestamp_stop):
+        """
+        :param timestamp_start: Timestamp to begin
+        :param timestamp_stop: Timestamp to stop (excluded)
+        :return: Sorted float64 timestamps, float64 powers
+        """
+        low, high = np.searchsorted(self.timestamps, [timestamp_start, timestamp_stop])
+        powers = self.records['power']
+        if self._order is None:
+            return drop_repeated(np.array(self.timestamps[low:high]), np.array(powers[low:high]))
+        return drop_repeated(self.timestamps[low:high], powers[self._order[low:high]])
+
+
+class ArrowReader:
+    """
+    Samples of a node from the Parquet or Arrow IPC files of file_sink
+    """
+
+    def __init__(self, directory, node, sensor, file_format='parquet'):
+        """
+        :param directory: Output directory
+        :param node: Node name
+        :param sensor: Sensor name
+        :param file_format: parquet or arrow
+        """
+        import pyarrow.dataset
+
+        self.field = pyarrow.dataset.field
+        self.dataset = pyarrow.dataset.dataset(os.path.join(directory, node + "." + sensor),
+                                               format='parquet' if file_format == 'parquet' else 'ipc')
+
+    def read(self, timestamp_start, timestamp_stop):
+        """
+        :param timestamp_start: Timestamp to begin
+        :param timestamp_stop: Timestamp to stop (excluded)
+        :return: Sorted float64 timestamps, float64 powers
+        """
+        # Only the row groups or batches overlapping the range are read
+        table = self.dataset.to_table(columns=['timestamp', 'power'],
+                                      filter=((self.field('timestamp') >= timestamp_start) &
+                                              (self.field('timestamp') < timestamp_stop)))
+        return sort_series(table.column('timestamp').to_numpy().astype(np.float64),
+                           table.column('power').to_numpy().astype(np.float64))
+
+
+def create_reader(uri, database, collection, node, sensor, layout='document'):
+    """
+    Return the reader of a node in an output, see bulk_writer.create_output
+    :param uri: MongoDB uri, or npy://, parquet:// or arrow:// followed by a directory
+    :param database: MongoDB database, or sub-directory of the files
+    :param collection: MongoDB collection, or sub-directory of the files
+    :param node: Node name
+    :param sensor: Sensor name
+    :param layout: One of bulk_writer.LAYOUTS, for MongoDB
+    :return: MongoReader, NpyReader or ArrowReader
+    """
+    scheme, _, path = uri.partition("://")
+    if scheme == 'npy':
+        return NpyReader(os.path.join(path, database, collection), node, sensor)
+    if scheme in ('parquet', 'arrow'):
+        return ArrowReader(os.path.join(path, database, collection), node, sensor, scheme)
+    from bulk_writer import connect_mongodb
+
+    return MongoReader(connect_mongodb(uri, database, collection), node, sensor, layout)
+
+
+def iter_series(reader, timestamp_start, timestamp_stop, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read a window range by range
+    :param reader: Reader from create_reader
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param chunk_size: Number of seconds read at once
+    :return: Generator of (sorted float64 timestamps, float64 powers)
+    """
+    for start in range(int(timestamp_start), int(timestamp_stop), chunk_size):
+        yield reader.read(start, min(start + chunk_size, int(timestamp_stop)))
@@ -20,15 +20,13 @@ Module SNMP-sensor
 
 import argparse
 import signal
-import time
 import logging
 import sys
-import datetime
 import asyncio
-import pymongo
-import socket
-from execo_g5k import get_host_attributes
-from pysnmp.hlapi.asyncio import getCmd, SnmpEngine, CommunityData, UdpTransportTarget, ContextData, ObjectIdentity, ObjectType
+import metrics
+from bulk_writer import QueueWriter, create_output, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_BUCKET_SIZE, LAYOUTS, DEFAULT_QUEUE_SIZE, QUEUE_POLICIES
+from node_metadata import NodeMetadata, DEFAULT_CACHE_FILE, DEFAULT_TTL
+from pdu_snmp import SnmpPoller, get_pdu_outlets, get_unavailable_nodes, run_periodic, DEFAULT_PERIOD
 
 LOGGER = logging.getLogger()
 LOGGER.addHandler(logging.StreamHandler())
@@ -38,111 +36,26 @@ LOGGER.addHandler(logging.StreamHandler())
 ##############################################################################
 
 
-def is_snmp_available(args):
+def get_nodes(args):
     """
-    Allow to know if SNMP-sensor is available for this node
+    Return the list of nodes to monitor
     :param args: Script argument
-    :return: True if available, False otherwise
+    :return: List of node names
     """
-    try:
-        data = get_host_attributes(args.node_name)
-        data['sensors']['power']['via']['pdu']
-    except KeyError:
-        return False
-    return True
+    return [node for node in args.node_name.split(',') if node]
 
 
-def get_pdu_ip_and_port(args):
+def is_snmp_available(args, metadata):
     """
-    Return the PDU IP String, and the port associate to the current Node
+    Allow to know if SNMP-sensor is available for all the nodes
     :param args: Script argument
-    :return: List of PDU with IP/port
-    """
-    data = get_host_attributes(args.node_name)
-
-    # Get PDU name
-    pdus_name = [pdu['uid'] for pdu in data['sensors']['power']['via']['pdu']]
-
-    # Get PDU IP/port
-    pdus_infos = []
-    for pdu_name in pdus_name:
-        port = None
-        for pdu_info in data['sensors']['power']['via']['pdu']:
-            if pdu_info['uid'] == pdu_name:
-                port = pdu_info['port']
-                break
-        ip = socket.gethostbyname(pdu_name+"."+args.city_name+".grid5000.fr")
-        pdus_infos.append((pdu_name, ip, port))
-
-    return pdus_infos
-
-
-@asyncio.coroutine
-def run_watt(pdu_ip, pdu_node_port):
-    snmpEngine = SnmpEngine()
-    errorIndication, errorStatus, errorIndex, varBinds = yield from getCmd(
-        snmpEngine,
-        CommunityData('public', mpModel=1),
-        UdpTransportTarget((pdu_ip, 161)),
-        ContextData(),
-        ObjectType(ObjectIdentity('1.3.6.1.4.1.318.1.1.26.9.4.3.1.7.'+str(pdu_node_port))),
-        ObjectType(ObjectIdentity('1.3.6.1.4.1.318.2.1.6.1.0')),
-        ObjectType(ObjectIdentity('1.3.6.1.4.1.318.2.1.6.2.0'))
-    )
-
-    watt = None
-    timestamp = None
-
-    if errorIndication:
-        LOGGER.error(errorIndication)
-    elif errorStatus:
-        LOGGER.error('%s at %s' % (
-            errorStatus.prettyPrint(),
-            errorIndex and varBinds[int(errorIndex) - 1][0] or '?'
-        ))
-    else:
-        watt = int(varBinds[0][1])
-        timestamp_str = str(varBinds[1][1]) + " "+ str(varBinds[2][1])
-        timestamp = int(time.mktime(datetime.datetime.strptime(timestamp_str, "%m/%d/%Y %H:%M:%S").timetuple()))
-
-    snmpEngine.transportDispatcher.closeDispatcher()
-
-    return watt, timestamp
-
-
-def connect_mongodb(args):
-    """
-    Return the collection to write the output
-    :param args: Script arguments
-    :return: MongoDB collection
-    """
-    mongo_client = pymongo.MongoClient(args.mongodb_uri,
-                                       serverSelectionTimeoutMS=5)
-    collection = mongo_client[args.mongodb_db][args.mongodb_collection]
-
-    # Check if it work
-    try:
-        mongo_client.admin.command('ismaster')
-    except pymongo.errors.ServerSelectionTimeoutError:
-        LOGGER.error("MongoDB error.")
-        exit(-1)
-
-    return collection
-
-
-def create_data(timestamp, sensor, power):
-    """
-    Create the Dict with data
-    :param timestamp: Timestamp int
-    :param sensor: Sensor name
-    :param power: Power value
-    :return: Dict data
+    :param metadata: NodeMetadata
+    :return: True if available, False otherwise
     """
-    return {
-        "timestamp": timestamp,
-        "sensor": sensor,
-        "power": power
-    }
+    missing = get_unavailable_nodes(metadata, get_nodes(args))
+    for node_name in missing:
+        LOGGER.error("SNMP-sensor not available for the node " + node_name)
+    return not missing
 
 ##############################################################################
 # Parser
@@ -157,14 +70,42 @@ def arg_parser_init():
         description="Start PowerAPI with the specified configuration.")
 
     # MongoDB output
-    parser.add_argument("mongodb_uri", help="MongoDB output uri")
-    parser.add_argument("mongodb_db", help="MongoDB output database")
-    parser.add_argument("mongodb_collection", help="MongoDB output collection")
+    parser.add_argument("mongodb_uri", help="MongoDB output uri, or npy://, parquet:// or arrow:// and a directory")
+    parser.add_argument("mongodb_db", help="MongoDB output database, or sub-directory")
+    parser.add_argument("mongodb_collection", help="MongoDB output collection, or sub-directory")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of documents written in one insert_many")
+    parser.add_argument("--flush-interval", type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help="Maximum number of seconds a document stays buffered")
+    parser.add_argument("--layout", choices=LAYOUTS, default='document',
+                        help="One document by sample, by bucket of samples, or a time-series collection")
+    parser.add_argument("--bucket-size", type=int, default=DEFAULT_BUCKET_SIZE,
+                        help="Seconds covered by one bucket document")
+    parser.add_argument("--rollups", action="store_true",
+                        help="Also update the 10 s, 1 min and 1 h rollups of the MongoDB collection")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="Maximum number of documents waiting to be written")
+    parser.add_argument("--queue-policy", choices=QUEUE_POLICIES, default='drop-oldest',
+                        help="What to do with a new document when the queue is full")
 
     # Node informations
     parser.add_argument("city_name", help="City name where the cluster is")
     parser.add_argument("cluster_name", help="Cluster name where the node is")
-    parser.add_argument("node_name", help="Node name to monitor")
+    parser.add_argument("node_name", help="Node name to monitor, or comma separated list of nodes")
+
+    # Polling
+    parser.add_argument("--period", type=float, default=DEFAULT_PERIOD,
+                        help="Seconds between two polls")
+
+    # Cache of the node metadata
+    parser.add_argument("--metadata-cache", default=DEFAULT_CACHE_FILE,
+                        help="JSON file caching the PDU of the nodes")
+    parser.add_argument("--metadata-ttl", type=float, default=DEFAULT_TTL,
+                        help="Seconds before the metadata of a node is fetched again")
+
+    # Instrumentation
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve the metrics on http://0.0.0.0:PORT/metrics, for Prometheus")
 
     return parser
 
@@ -180,11 +121,11 @@ def main():
     args = arg_parser_init().parse_args()
 
     LOGGER.warning("/!\ Make sure you are in the G5K network /!\\")
-    LOGGER.warning("/!\ This script is not compatible with python 3.7 /!\\")
 
     # Test is SNMP-sensor can monitor this node
-    if not is_snmp_available(args):
-        LOGGER.error("SNMP-sensor not available for the node " + args.node_name)
+    metadata = NodeMetadata(args.metadata_cache, args.metadata_ttl)
+    if not is_snmp_available(args, metadata):
+        metadata.save()
         sys.exit(-1)
 
     # Signal handling
@@ -195,41 +136,40 @@ def main():
     signal.signal(signal.SIGTERM, term_handler)
     signal.signal(signal.SIGINT, term_handler)
 
-    # Get the MongoDB
-    output = connect_mongodb(args)
+    # Get the PDU to read, and the outlets of each node
+    pdus_infos, nodes_outlets = get_pdu_outlets(metadata, args.city_name, get_nodes(args))
+    metadata.save()
 
-    # Get the tuple IP/port of each necessary PDU
-    pdus_infos = get_pdu_ip_and_port(args)
+    if args.metrics_port is not None:
+        metrics.start_http_server(args.metrics_port)
 
-    # Run loop
-    loop = asyncio.get_event_loop()
-    next_ts = 0
-    while True:
-        tasks = []
-
-        for pdu_info in pdus_infos:
-            tasks.append(asyncio.async(run_watt(pdu_info[1], pdu_info[2])))
-
-        loop.run_until_complete(asyncio.wait(tasks))
-
-        ts = 0
-        value = 0
-        for t in tasks:
-            res = t.result()
-            if res[0] is None and res[1] is None:
-                LOGGER.warning("Loose connection with SNMP node.")
-                exit(-1)
-            ts = res[1]
-            value += res[0]
-
-        new_data = create_data(ts, "snmp-sensor", value)
-        if next_ts < new_data["timestamp"]:
-            LOGGER.info(new_data)
-            output.insert_one(new_data)
-            next_ts = new_data["timestamp"]
-
-    loop.close()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
 
+    # Get the MongoDB, written by its own thread
+    output = QueueWriter(create_output(args.mongodb_uri, args.mongodb_db, args.mongodb_collection,
+                                       args.layout,
+                                       args.bucket_size,
+                                       args.batch_size,
+                                       args.flush_interval,
+                                       args.rollups),
+                         args.queue_size,
+                         args.queue_policy)
+    output.start()
+
+    # One session by PDU, kept for every poll
+    poller = SnmpPoller(pdus_infos, nodes_outlets, output)
+
+    # Run loop
+    polling = loop.create_task(run_periodic(args.period, poller.poll))
+    try:
+        loop.run_until_complete(polling)
+        sys.exit(-1)
+    finally:
+        polling.cancel()
+        loop.run_until_complete(output.close())
+        poller.close()
+        loop.close()
 
 if __name__ == "__main__":
     main()
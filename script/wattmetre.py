@@ -0,0 +1,816 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Module Wattmetre, download and parse the Omegawatt logs of Lyon/Grenoble
+
+A log line is: date, date, timestamp, status, then one column per port.
+The log of the current hour is plain text and grows, the log of an hour
+over is compressed in a .gz file. follow reads the new lines of the
+current log with HTTP Range requests.
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import gzip
+import io
+import logging
+import time
+import requests
+import numpy as np
+import metrics
+from bulk_writer import create_data
+from checkpoint import split_ranges
+
+LOGGER = logging.getLogger(__name__)
+
+SENSOR_NAME = "omegawatt-sensor"
+METRIC_LABELS = {"sensor": SENSOR_NAME}
+CITIES = ['grenoble', 'lyon']
+
+BLOCK_SIZE = 1 << 20
+DEFAULT_WORKERS = 4
+# A backfill with checkpoints is parsed and marked day by day
+CHECKPOINT_SIZE = 24 * 3600
+# Seconds between two reads of the current logs, when following them
+DEFAULT_PERIOD = 1
+# Seconds the log of an hour over is waited for, as plain text or .gz
+CLOSE_DELAY = 600
+
+# Server of a site, replaced by a local server in the benchmark
+WATTMETRE_URL = "http://wattmetre.%s.grid5000.fr"
+
+TIMESTAMP_COLUMN = 2
+STATUS_COLUMN = 3
+FIRST_PORT_COLUMN = 4
+
+
+def get_omegawatt_url(city_name):
+    """
+    Return the url to JSON information available on g5k about omegawatt
+    :param city_name: City name
+    :return: URL of the node
+    """
+    return WATTMETRE_URL % city_name + "/GetWatts-json.php"
+
+
+def get_unavailable_nodes(city_name, nodes):
+    """
+    Return the nodes that no wattmetre monitors
+    :param city_name: City name
+    :param nodes: List of node names
+    :return: List of node names
+    """
+    # City in ["grenoble", "lyon"]
+    # http://wattmetre.<CITY>.grid5000.fr/GetWatts-json.php
+    # Browse JSON dict and found "NODE_NAME"
+    if city_name not in CITIES:
+        return list(nodes)
+
+    data = requests.get(get_omegawatt_url(city_name)).json()
+    return [node_name for node_name in nodes
+            if not any(node_name in node for node in data.items())]
+
+
+def get_wattmetres(metadata, nodes):
+    """
+    Group the nodes by wattmetre
+    :param metadata: NodeMetadata
+    :param nodes: List of node names
+    :return: Dict wattmetre uid -> list of (node name, port)
+    """
+    wattmetres = {}
+    for node_name in nodes:
+        node_wattmetre = metadata.get_pdus(node_name)[0]
+        wattmetres.setdefault(node_wattmetre['uid'], []).append((node_name, node_wattmetre['port']))
+    return wattmetres
+
+
+def get_hour(timestamp):
+    """
+    :param timestamp: Timestamp
+    :return: Hour of the log file holding the timestamp (e.g. 2019-03-26T10)
+    """
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%dT%H')
+
+
+def get_hour_suffix(timestamp):
+    """
+    Return the suffix of the log file holding a timestamp
+    :param timestamp: Timestamp int
+    :return: Suffix, ending with .gz if the hour is over
+    """
+    suffix = get_hour(timestamp)
+    if suffix != get_hour(time.time()):
+        suffix += ".gz"
+    return suffix
+
+
+def get_wattmetre_url(city_name, wattmetre_uid, suffix):
+    """
+    Return the url of an hourly log file
+    :param city_name: City name
+    :param wattmetre_uid: Wattmetre uid (e.g. wattmetre1)
+    :param suffix: Suffix from get_hour_suffix
+    :return: URL of the log file
+    """
+    return WATTMETRE_URL % city_name + "/data/"+wattmetre_uid+"-log/power.csv."+suffix
+
+
+def get_hour_suffixes(timestamp_start, timestamp_stop):
+    """
+    Return the suffixes of the log files covering a window
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop
+    :return: List of suffixes, the current hour being the last one if present
+    """
+    suffixes = []
+    for ts in range(int(timestamp_start), int(timestamp_stop)+3600, 3600):
+        suffixes.append(get_hour_suffix(ts))
+        if not suffixes[-1].endswith(".gz"):
+            break
+    return suffixes
+
+
+def download_log(city_name, wattmetre_uid, suffix, session=None):
+    """
+    Download a log file, still compressed if it is a .gz
+    :param city_name: City name
+    :param wattmetre_uid: Wattmetre uid
+    :param suffix: Suffix from get_hour_suffix
+    :param session: requests.Session, None for a new connection
+    :return: Bytes, None if the file does not exist
+    """
+    with metrics.timer("fetch_seconds", METRIC_LABELS):
+        req = (session or requests).get(get_wattmetre_url(city_name, wattmetre_uid, suffix))
+        if req.status_code == 404:
+            return None
+        req.raise_for_status()
+        content = req.content
+    metrics.inc("fetch_bytes_total", len(content), METRIC_LABELS)
+    return content
+
+
+def fetch_log(city_name, wattmetre_uid, suffix, cache=None):
+    """
+    Return a log file from the cache, or download it and cache it
+    :param city_name: City name
+    :param wattmetre_uid: Wattmetre uid
+    :param suffix: Suffix from get_hour_suffix
+    :param cache: ArchiveCache, None to always download
+    :return: Bytes, None if the file does not exist
+    """
+    content = cache.get(city_name, wattmetre_uid, suffix) if cache is not None else None
+    if cache is not None:
+        metrics.inc("cache_hits_total" if content is not None else "cache_misses_total", 1, METRIC_LABELS)
+    if content is None:
+        content = download_log(city_name, wattmetre_uid, suffix)
+        if content is not None and cache is not None:
+            cache.put(city_name, wattmetre_uid, suffix, content)
+    return content
+
+
+def iter_logs(city_name, wattmetre_uid, suffixes, workers=DEFAULT_WORKERS, cache=None):
+    """
+    Download log files concurrently, and give them back in order
+
+    At most `workers` files are downloaded or waiting to be read at a time,
+    so the caller parses a file while the next ones are downloaded.
+    :param city_name: City name
+    :param wattmetre_uid: Wattmetre uid
+    :param suffixes: Suffixes from get_hour_suffixes
+    :param workers: Number of concurrent downloads
+    :param cache: ArchiveCache, None to always download
+    :return: Generator of (suffix, bytes or None if the file does not exist)
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for suffix in suffixes:
+            pending.append((suffix, executor.submit(fetch_log, city_name, wattmetre_uid, suffix, cache)))
+            if len(pending) >= workers:
+                suffix, future = pending.popleft()
+                yield suffix, future.result()
+        while pending:
+            suffix, future = pending.popleft()
+            yield suffix, future.result()
+
+
+def open_log(suffix, content):
+    """
+    Open a downloaded log file as a stream of decompressed bytes
+    :param suffix: Suffix from get_hour_suffix
+    :param content: Bytes from download_log
+    :return: File object
+    """
+    if suffix.endswith(".gz"):
+        return gzip.GzipFile(fileobj=io.BytesIO(content))
+    return io.BytesIO(content)
+
+
+def iter_blocks(stream, block_size=BLOCK_SIZE):
+    """
+    Read a log by blocks of whole lines, without the header
+    The last line is dropped if it does not end with a new line.
+    :param stream: File object
+    :param block_size: Number of bytes read at once
+    :return: Generator of bytes
+    """
+    rest = b''
+    header = True
+    while True:
+        with metrics.timer("decompress_seconds", METRIC_LABELS):
+            data = stream.read(block_size)
+        if not data:
+            return
+        data = rest + data
+        end = data.rfind(b'\n')
+        if end < 0:
+            rest = data
+            continue
+        block, rest = data[:end], data[end+1:]
+        if header:
+            header = False
+            start = block.find(b'\n')
+            if start < 0:
+                continue
+            block = block[start+1:]
+        if block:
+            yield block
+
+
+def parse_block(block, ports):
+    """
+    Parse a block of lines in arrays, keeping the lines with an OK status
+    :param block: Bytes from iter_blocks
+    :param ports: List of wattmetre ports to extract
+    :return: (float64 timestamps, float64 values with one column per port,
+              NaN where the port is empty), number of rejected lines
+    """
+    lines = block.split(b'\n')
+    count = len(lines)
+    # Number of commas of every line, the most common one gives the width of the log
+    raw = np.frombuffer(block, dtype=np.uint8)
+    commas = np.flatnonzero(raw == ord(','))
+    line_commas = np.diff(np.concatenate(([0], np.searchsorted(commas, np.flatnonzero(raw == ord('\n'))),
+                                          [len(commas)])))
+    width = int(np.bincount(line_commas).argmax()) + 1
+    if width <= FIRST_PORT_COLUMN:
+        return np.empty(0), np.empty((0, len(ports))), count
+    for port in ports:
+        if FIRST_PORT_COLUMN + port >= width:
+            raise ValueError("Port %d not in the log, which has %d ports" % (port, width - FIRST_PORT_COLUMN))
+
+    well_formed = line_commas == width - 1
+    if well_formed.all():
+        fields = block.replace(b'\n', b',').split(b',')
+    else:
+        # Some lines are truncated, keep the well formed ones
+        lines = [line for line, kept in zip(lines, well_formed.tolist()) if kept]
+        fields = b','.join(lines).split(b',') if lines else []
+    table = np.array(fields, dtype=np.bytes_).reshape(-1, width)
+
+    table = table[table[:, STATUS_COLUMN] == b'OK']
+    timestamps = table[:, TIMESTAMP_COLUMN].astype(np.float64)
+    values = np.full((len(table), len(ports)), np.nan)
+    for index, port in enumerate(ports):
+        column = table[:, FIRST_PORT_COLUMN + port]
+        filled = column != b''
+        values[filled, index] = column[filled].astype(np.float64)
+    return timestamps, values, count - len(table)
+
+
+class SecondMean:
+    """
+    Mean of the values of every second of a window
+    """
+
+    def __init__(self, timestamp_start, timestamp_stop):
+        """
+        :param timestamp_start: First second of the window
+        :param timestamp_stop: Last second of the window (included)
+        """
+        self.timestamp_start = int(timestamp_start)
+        self.length = int(timestamp_stop) - self.timestamp_start + 1
+        self.sums = np.zeros(self.length)
+        self.counts = np.zeros(self.length, dtype=np.int64)
+
+    def add(self, timestamps, values):
+        """
+        Add samples, NaN values are ignored
+        :param timestamps: float64 timestamps
+        :param values: float64 values
+        """
+        seconds = np.round(timestamps).astype(np.int64) - self.timestamp_start
+        mask = (seconds >= 0) & (seconds < self.length) & ~np.isnan(values)
+        seconds, values = seconds[mask], values[mask]
+        if not len(seconds):
+            return
+        low = seconds.min()
+        seconds -= low
+        high = low + seconds.max() + 1
+        self.sums[low:high] += np.bincount(seconds, weights=values)
+        self.counts[low:high] += np.bincount(seconds)
+
+    def result(self):
+        """
+        :return: int64 timestamps of the seconds with samples, float64 means
+        """
+        seen = self.counts > 0
+        return (np.flatnonzero(seen) + self.timestamp_start,
+                self.sums[seen] / self.counts[seen])
+
+
+class RawSamples:
+    """
+    Every sample of a window, in growing typed arrays
+    """
+
+    def __init__(self, timestamp_start, timestamp_stop):
+        """
+        :param timestamp_start: Timestamp to begin
+        :param timestamp_stop: Timestamp to stop (excluded)
+        """
+        self.timestamp_start = float(timestamp_start)
+        self.timestamp_stop = float(timestamp_stop)
+        self.timestamps = np.empty(0, dtype=np.float64)
+        self.values = np.empty(0, dtype=np.float32)
+        self.length = 0
+
+    def add(self, timestamps, values):
+        """
+        Add samples, NaN values are ignored
+        :param timestamps: float64 timestamps
+        :param values: float64 values
+        """
+        mask = ((timestamps >= self.timestamp_start) & (timestamps < self.timestamp_stop) &
+                ~np.isnan(values))
+        self._append(timestamps[mask], values[mask])
+
+    def _append(self, timestamps, values):
+        count = len(timestamps)
+        if self.length + count > len(self.timestamps):
+            # Double the capacity, so adding a block is amortized O(block)
+            capacity = max(2 * len(self.timestamps), self.length + count)
+            self.timestamps = np.resize(self.timestamps, capacity)
+            self.values = np.resize(self.values, capacity)
+        self.timestamps[self.length:self.length+count] = timestamps
+        self.values[self.length:self.length+count] = values
+        self.length += count
+
+    def result(self):
+        """
+        :return: float64 timestamps, float32 values
+        """
+        return self.timestamps[:self.length], self.values[:self.length]
+
+
+AGGREGATORS = ('mean', 'max', 'min', 'last')
+
+
+class Resampler(RawSamples):
+    """
+    Aggregate the samples of a window on fixed size bins
+
+    Samples must be added in time order. A bin is labelled by its start,
+    and only the samples of the last, maybe incomplete, bin are kept
+    between two blocks.
+    """
+
+    def __init__(self, timestamp_start, timestamp_stop, window, aggregator='mean'):
+        """
+        :param timestamp_start: Timestamp to begin
+        :param timestamp_stop: Timestamp to stop (excluded)
+        :param window: Size of a bin, in seconds
+        :param aggregator: One of AGGREGATORS
+        """
+        if aggregator not in AGGREGATORS:
+            raise ValueError("Unknown aggregator " + aggregator)
+        super().__init__(timestamp_start, timestamp_stop)
+        self.window = float(window)
+        self.aggregator = aggregator
+        self._pending = (np.empty(0), np.empty(0))
+
+    def _aggregate(self, timestamps, values):
+        bins = np.floor(timestamps / self.window).astype(np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+        if self.aggregator == 'mean':
+            aggregated = np.add.reduceat(values, starts) / np.diff(np.append(starts, len(values)))
+        elif self.aggregator == 'max':
+            aggregated = np.maximum.reduceat(values, starts)
+        elif self.aggregator == 'min':
+            aggregated = np.minimum.reduceat(values, starts)
+        else:
+            aggregated = values[np.append(starts[1:], len(values)) - 1]
+        return bins[starts] * self.window, aggregated
+
+    def add(self, timestamps, values):
+        """
+        Add samples, NaN values are ignored
+        :param timestamps: float64 timestamps
+        :param values: float64 values
+        """
+        mask = ((timestamps >= self.timestamp_start) & (timestamps < self.timestamp_stop) &
+                ~np.isnan(values))
+        timestamps = np.concatenate((self._pending[0], timestamps[mask]))
+        values = np.concatenate((self._pending[1], values[mask]))
+        if not len(timestamps):
+            return
+        if np.any(np.diff(timestamps) < 0):
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, values = timestamps[order], values[order]
+
+        # The last bin may go on in the next block
+        bins = np.floor(timestamps / self.window)
+        last = np.searchsorted(bins, bins[-1])
+        self._pending = (timestamps[last:], values[last:])
+        if last:
+            self._append(*self._aggregate(timestamps[:last], values[:last]))
+
+    def result(self):
+        """
+        :return: float64 bin starts, float32 aggregated values
+        """
+        if len(self._pending[0]):
+            self._append(*self._aggregate(*self._pending))
+            self._pending = (np.empty(0), np.empty(0))
+        return super().result()
+
+
+def create_collector(timestamp_start, timestamp_stop, raw=False, window=None, aggregator='mean'):
+    """
+    Return the object aggregating the samples of a node
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop
+    :param raw: Keep every sample
+    :param window: Size of the resampling bins in seconds, None for the mean of every second
+    :param aggregator: Aggregator of the resampling bins
+    :return: SecondMean, RawSamples or Resampler
+    """
+    if raw:
+        return RawSamples(timestamp_start, timestamp_stop)
+    if window is not None:
+        return Resampler(timestamp_start, timestamp_stop, window, aggregator)
+    return SecondMean(timestamp_start, timestamp_stop)
+
+
+def parse_wattmetre(city_name, wattmetre_uid, ports, timestamp_start, timestamp_stop, new_collector,
+                    workers=DEFAULT_WORKERS, cache=None, cache_arrays=False, stop=None):
+    """
+    Parse the hourly logs of a wattmetre once for all its monitored ports
+    :param city_name: City name
+    :param wattmetre_uid: Wattmetre uid
+    :param ports: List of ports to extract
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop
+    :param new_collector: Function without argument returning a collector
+    :param workers: Number of concurrent downloads
+    :param cache: ArchiveCache or None
+    :param cache_arrays: Also cache the parsed samples of the ports
+    :param stop: threading.Event ending the parsing early when set
+    :return: List of collectors, one by port
+    """
+    watts = [new_collector() for _ in ports]
+    use_arrays = cache is not None and cache_arrays
+
+    # Hours already parsed for every port do not need to be downloaded
+    suffixes = get_hour_suffixes(timestamp_start, timestamp_stop)
+    parsed = {suffix for suffix in suffixes
+              if use_arrays and all(cache.has_arrays(city_name, wattmetre_uid, suffix, port)
+                                    for port in ports)}
+    logs = iter_logs(city_name,
+                     wattmetre_uid,
+                     [suffix for suffix in suffixes if suffix not in parsed],
+                     workers,
+                     cache)
+
+    # Hours are added in time order, as the resampler needs it
+    missing = []
+    for suffix in suffixes:
+        if stop is not None and stop.is_set():
+            break
+        if suffix in parsed:
+            arrays = [cache.get_arrays(city_name, wattmetre_uid, suffix, port) for port in ports]
+            if all(port_arrays is not None for port_arrays in arrays):
+                for watt, port_arrays in zip(watts, arrays):
+                    watt.add(*port_arrays)
+                continue
+            # Evicted in the meantime
+            content = fetch_log(city_name, wattmetre_uid, suffix, cache)
+        else:
+            _, content = next(logs)
+
+        if content is None:
+            missing.append(suffix)
+            continue
+        hour = []
+        with open_log(suffix, content) as stream:
+            for block in iter_blocks(stream):
+                with metrics.timer("parse_seconds", METRIC_LABELS):
+                    timestamps, values, rejected = parse_block(block, ports)
+                metrics.inc("rows_accepted_total", len(timestamps), METRIC_LABELS)
+                metrics.inc("rows_rejected_total", rejected, METRIC_LABELS)
+                for index, watt in enumerate(watts):
+                    watt.add(timestamps, values[:, index])
+                if use_arrays:
+                    hour.append((timestamps, values))
+        if hour:
+            timestamps = np.concatenate([timestamps for timestamps, _ in hour])
+            values = np.concatenate([values for _, values in hour])
+            for index, port in enumerate(ports):
+                filled = ~np.isnan(values[:, index])
+                cache.put_arrays(city_name, wattmetre_uid, suffix, port,
+                                 timestamps[filled], values[filled, index])
+    logs.close()
+
+    if missing:
+        LOGGER.warning("No " + wattmetre_uid + " log for the hours: " + ", ".join(missing))
+    return watts
+
+
+def collect(output, metadata, city_name, nodes, timestamp_start, timestamp_stop, new_collector=create_collector,
+            workers=DEFAULT_WORKERS, cache=None, cache_arrays=False, stop=None, checkpoints=None):
+    """
+    source: https://gitlab.inria.fr/delamare/wattmetre-read/raw/master/tools/getwatt.py
+    The hourly logs are downloaded concurrently and parsed by blocks of lines,
+    once by wattmetre whatever the number of nodes on it, then written in the output.
+    :param output: Writer from bulk_writer.create_writer
+    :param metadata: NodeMetadata
+    :param city_name: City name
+    :param nodes: List of node names
+    :param timestamp_start: Timestamp to begin
+    :param timestamp_stop: Timestamp to stop (excluded)
+    :param new_collector: Function of (timestamp start, timestamp stop) returning a collector,
+                          the mean of every second by default
+    :param workers: Number of concurrent downloads
+    :param cache: ArchiveCache or None
+    :param cache_arrays: Also cache the parsed samples of the ports
+    :param stop: threading.Event ending the collection early when set
+    :param checkpoints: checkpoint.Checkpoints, to parse only the missing ranges
+                        and mark every day once written without rejected document
+    """
+    for wattmetre_uid, wattmetre_nodes in get_wattmetres(metadata, nodes).items():
+        node_ports = dict(wattmetre_nodes)
+        node_names = list(node_ports)
+        ranges = [(int(timestamp_start), int(timestamp_stop), node_names)]
+        if checkpoints is not None:
+            # Only the ports of the nodes missing a range are parsed on it
+            ranges = split_ranges(checkpoints.plan(SENSOR_NAME, node_names, *ranges[0][:2]), CHECKPOINT_SIZE)
+
+        for range_start, range_stop, range_nodes in ranges:
+            ports = [node_ports[node_name] for node_name in range_nodes]
+            watts = parse_wattmetre(city_name, wattmetre_uid, ports, range_start, range_stop,
+                                    lambda: new_collector(range_start, range_stop),
+                                    workers, cache, cache_arrays, stop)
+            if stop is not None and stop.is_set():
+                return
+            rejected = output.rejected
+            for node_name, watt in zip(range_nodes, watts):
+                timestamps, values = watt.result()
+                mask = timestamps < range_stop
+                output.write_many(create_data(ts, SENSOR_NAME, value, node_name)
+                                  for ts, value in zip(timestamps[mask].tolist(), values[mask].tolist()))
+            if checkpoints is not None:
+                output.flush()
+                if output.rejected == rejected:
+                    checkpoints.add(SENSOR_NAME, range_nodes, range_start, range_stop)
+                else:
+                    LOGGER.error("Range %d-%d of %s not marked, %d documents rejected.",
+                                 range_start, range_stop, wattmetre_uid, output.rejected - rejected)
+
+
+class LogTail:
+    """
+    Lines appended to the hourly log of a wattmetre since the previous read
+
+    The plain text log is read from the byte offset already received with a
+    Range request. Once the hour is over and the plain text log is gone,
+    the rest of its lines are read from its .gz file, and the tail is closed.
+    """
+
+    def __init__(self, session, city_name, wattmetre_uid, timestamp):
+        """
+        :param session: requests.Session
+        :param city_name: City name
+        :param wattmetre_uid: Wattmetre uid
+        :param timestamp: Timestamp in the hour of the log
+        """
+        self.session = session
+        self.city_name = city_name
+        self.wattmetre_uid = wattmetre_uid
+        self.hour = get_hour(timestamp)
+        start = datetime.datetime.fromtimestamp(timestamp).replace(minute=0, second=0, microsecond=0)
+        self.timestamp_stop = start.timestamp() + 3600
+        self.offset = 0
+        # A sample of the next hour was read, so the lines of this hour are complete
+        self.ended = False
+        self.last_timestamp = None
+        self.closed = False
+        self._rest = b''
+        self._header = True
+
+    def read(self, now):
+        """
+        Download the new bytes of the log
+        :param now: Current timestamp
+        :return: Bytes of the new whole lines, without the header
+        """
+        with metrics.timer("fetch_seconds", METRIC_LABELS):
+            req = self.session.get(get_wattmetre_url(self.city_name, self.wattmetre_uid, self.hour),
+                                   headers={"Range": "bytes=%d-" % self.offset})
+        if req.status_code == 206:
+            data = req.content
+        elif req.status_code == 200:
+            # The server ignores Range
+            data = req.content[self.offset:]
+        elif req.status_code == 416:
+            data = b''
+        elif req.status_code == 404 and now >= self.timestamp_stop:
+            data = self._read_compressed()
+        elif req.status_code == 404:
+            # Not created yet
+            data = b''
+        else:
+            req.raise_for_status()
+            data = b''
+        metrics.inc("fetch_bytes_total", len(req.content), METRIC_LABELS)
+        return self._split(data)
+
+    def _read_compressed(self):
+        content = download_log(self.city_name, self.wattmetre_uid, self.hour + ".gz", self.session)
+        if content is None:
+            return b''
+        with metrics.timer("decompress_seconds", METRIC_LABELS):
+            data = gzip.decompress(content)[self.offset:]
+        self.closed = True
+        return data
+
+    def _split(self, data):
+        self.offset += len(data)
+        data = self._rest + data
+        end = data.rfind(b'\n')
+        if end < 0:
+            # The last line of a closed log may not end with a new line
+            self._rest = data if not self.closed else b''
+            return b''
+        block, self._rest = data[:end], data[end+1:] if not self.closed else b''
+        if self._header:
+            self._header = False
+            block = block[block.find(b'\n')+1:] if b'\n' in block else b''
+        return block
+
+
+class LiveWattmetre:
+    """
+    Samples of the ports of a wattmetre, from the tails of its current logs
+
+    Samples are given back by intervals of whole steps ending one second
+    before the last sample read from every log, until a log holds a sample
+    of the next hour or is closed, so the bins of the interval are complete.
+    """
+
+    def __init__(self, session, city_name, wattmetre_uid, ports, step=1):
+        """
+        :param session: requests.Session
+        :param city_name: City name
+        :param wattmetre_uid: Wattmetre uid
+        :param ports: List of ports to extract
+        :param step: Seconds of the bins of the collectors, the intervals are aligned on them
+        """
+        self.session = session
+        self.city_name = city_name
+        self.wattmetre_uid = wattmetre_uid
+        self.ports = ports
+        self.step = float(step)
+        self.tails = []
+        self.timestamp_start = None
+        self._timestamps = np.empty(0)
+        self._values = np.empty((0, len(ports)))
+
+    def read(self, now):
+        """
+        Read the new lines of the logs, the previous hour until it is closed
+        :param now: Current timestamp
+        """
+        if not self.tails or now >= self.tails[-1].timestamp_stop:
+            self.tails.append(LogTail(self.session, self.city_name, self.wattmetre_uid, now))
+        for tail in self.tails:
+            block = tail.read(now)
+            if block:
+                with metrics.timer("parse_seconds", METRIC_LABELS):
+                    timestamps, values, rejected = parse_block(block, self.ports)
+                metrics.inc("rows_accepted_total", len(timestamps), METRIC_LABELS)
+                metrics.inc("rows_rejected_total", rejected, METRIC_LABELS)
+                self._timestamps = np.concatenate((self._timestamps, timestamps))
+                self._values = np.concatenate((self._values, values))
+                if len(timestamps):
+                    tail.last_timestamp = max(tail.last_timestamp or 0, timestamps.max())
+                    tail.ended = tail.last_timestamp >= tail.timestamp_stop
+            if not tail.closed and now >= tail.timestamp_stop + CLOSE_DELAY:
+                if not tail.offset:
+                    LOGGER.warning("No " + self.wattmetre_uid + " log for the hour " + tail.hour)
+                tail.closed = True
+        # A closed tail has given all its lines
+        self.tails = [tail for tail in self.tails if not tail.closed]
+
+    def collect(self, new_collector):
+        """
+        Aggregate the samples of the complete bins read since the previous call
+        :param new_collector: Function of (timestamp start, timestamp stop) returning a collector
+        :return: List of (timestamps, values) by port, None if no bin is complete
+        """
+        if not len(self._timestamps):
+            return None
+        if self.timestamp_start is None:
+            self.timestamp_start = np.floor(self._timestamps.min() / self.step) * self.step
+        timestamp_stop = np.floor((self._timestamps.max() - 1) / self.step) * self.step
+        for tail in self.tails:
+            if not tail.ended:
+                # The lines of a log come in order, but the last lines of the previous
+                # hour may come after the first ones of this hour
+                if tail.last_timestamp is None:
+                    tail_stop = np.floor((tail.timestamp_stop - 3600) / self.step) * self.step
+                else:
+                    tail_stop = np.floor((tail.last_timestamp - 1) / self.step) * self.step
+                timestamp_stop = min(timestamp_stop, tail_stop)
+        if timestamp_stop <= self.timestamp_start:
+            return None
+
+        results = []
+        for index in range(len(self.ports)):
+            watt = new_collector(self.timestamp_start, timestamp_stop)
+            watt.add(self._timestamps, self._values[:, index])
+            timestamps, values = watt.result()
+            mask = (timestamps >= self.timestamp_start) & (timestamps < timestamp_stop)
+            results.append((timestamps[mask], values[mask]))
+
+        # The samples rounded to the next second are kept with it
+        kept = self._timestamps >= timestamp_stop - 1
+        self._timestamps, self._values = self._timestamps[kept], self._values[kept]
+        self.timestamp_start = timestamp_stop
+        return results
+
+
+def follow(output, metadata, city_name, nodes, new_collector=create_collector, step=1,
+           period=DEFAULT_PERIOD, stop=None):
+    """
+    Write the samples of the nodes as the wattmetres log them, until stop is set
+
+    The log of the current hour is read from its beginning, then every
+    period seconds only its new lines are downloaded. A sample is written
+    about period + step + 1 seconds after it is logged, plus the flush
+    interval of the output.
+    :param output: Writer from bulk_writer.create_writer
+    :param metadata: NodeMetadata
+    :param city_name: City name
+    :param nodes: List of node names
+    :param new_collector: Function of (timestamp start, timestamp stop) returning a collector,
+                          the mean of every second by default
+    :param step: Seconds of the bins of the collector (the resampling window, 1 otherwise)
+    :param period: Seconds between two reads of the logs
+    :param stop: threading.Event ending the loop when set
+    """
+    session = requests.Session()
+    wattmetres = [(LiveWattmetre(session, city_name, wattmetre_uid, [port for _, port in wattmetre_nodes], step),
+                   [node_name for node_name, _ in wattmetre_nodes])
+                  for wattmetre_uid, wattmetre_nodes in get_wattmetres(metadata, nodes).items()]
+    deadline = time.monotonic()
+    try:
+        while stop is None or not stop.is_set():
+            for live, node_names in wattmetres:
+                try:
+                    live.read(time.time())
+                except requests.RequestException as error:
+                    LOGGER.warning("Cannot read the log of " + live.wattmetre_uid + ": " + str(error))
+                    metrics.inc("fetch_errors_total", 1, METRIC_LABELS)
+                results = live.collect(new_collector) or [(np.empty(0), np.empty(0))] * len(node_names)
+                for node_name, (timestamps, values) in zip(node_names, results):
+                    # Also flushes the output once its flush interval is over
+                    output.write_many(create_data(ts, SENSOR_NAME, value, node_name)
+                                      for ts, value in zip(timestamps.tolist(), values.tolist()))
+
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                metrics.inc("poll_overruns_total", 1, METRIC_LABELS)
+                deadline += period * np.ceil(-delay / period)
+                delay = deadline - time.monotonic()
+            if stop is not None:
+                stop.wait(delay)
+            else:
+                time.sleep(delay)
+    finally:
+        session.close()
@@ -0,0 +1,210 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Tests of the follow mode of Kwapi
+
+A fake session answers from the samples published before a fake clock,
+which only moves forward when the loop waits, so a loop polling without
+waiting is seen as too many requests.
+"""
+
+import json
+import os
+import sys
+import urllib.parse
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "script"))
+
+import kwapi  # noqa: E402
+from checkpoint import Checkpoints  # noqa: E402
+
+START = 1553595600
+MAX_REQUESTS = 5000
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class Stop:
+    """
+    threading.Event moving the clock on wait, set at the end time or after MAX_REQUESTS requests
+    """
+
+    def __init__(self, clock, session, end):
+        self.clock = clock
+        self.session = session
+        self.end = end
+        self.waits = []
+
+    def is_set(self):
+        return self.clock.now >= self.end or len(self.session.requests) >= MAX_REQUESTS
+
+    def wait(self, delay):
+        self.waits.append(delay)
+        self.clock.now += delay
+
+
+class Response:
+    def __init__(self, data):
+        self.content = json.dumps(data).encode()
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class Session:
+    """
+    requests.Session answering the timeseries url from a function of the samples of each node
+    """
+
+    def __init__(self, clock, has_sample, down_until=None):
+        """
+        :param has_sample: Function (node, timestamp) -> True if Kwapi has the sample
+        :param down_until: Fake time until which the requests fail
+        """
+        self.clock = clock
+        self.has_sample = has_sample
+        self.down_until = down_until
+        self.requests = []
+        self.errors = 0
+
+    def get(self, url, stream=False):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        nodes = query['only'][0].split(',')
+        start, stop = int(query['from'][0]), int(query['to'][0])
+        self.requests.append((self.clock.now, nodes, start, stop))
+        if self.down_until is not None and self.clock.now < self.down_until:
+            self.errors += 1
+            raise requests.ConnectionError("API down")
+        # Only the samples before now are published
+        timestamps = range(start, min(stop, int(self.clock.now)))
+        items = []
+        for node in nodes:
+            node_timestamps = [ts for ts in timestamps if self.has_sample(node, ts)]
+            if node_timestamps:
+                items.append({"uid": node, "timestamps": node_timestamps,
+                              "values": [float(ts % 100) for ts in node_timestamps]})
+        return Response({"items": items})
+
+
+class Output:
+    def __init__(self):
+        self.documents = []
+        self.rejected = 0
+
+    def write_many(self, documents):
+        self.documents.extend(documents)
+
+    def flush(self):
+        pass
+
+
+def get_timestamps(output, node):
+    return [document['timestamp'] for document in output.documents if document['node'] == node]
+
+
+def covers(checkpoints, node, timestamp):
+    return any(start <= timestamp < stop for start, stop in checkpoints.get_ranges(kwapi.SENSOR_NAME, node))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(START)
+    monkeypatch.setattr(kwapi.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def checkpoints(tmp_path):
+    return Checkpoints("test", str(tmp_path / "checkpoints.json"), delay=0)
+
+
+def test_gap_longer_than_chunk_size(clock, checkpoints):
+    # Samples until START + 100, then none for 10000 seconds
+    def has_sample(node, timestamp):
+        return timestamp < START + 100 or timestamp >= START + 10100
+
+    clock.now = START + 20000
+    session = Session(clock, has_sample)
+    output = Output()
+    stop = Stop(clock, session, START + 20100)
+    kwapi.follow(session, output, "lyon", ["nova-1"], START, chunk_size=1000,
+                 stop=stop, checkpoints=checkpoints)
+
+    # One request by chunk to catch up, then the polls of the last 100 seconds
+    assert len([request for request in session.requests if request[0] == START + 20000]) <= 21
+    assert len(session.requests) < 200
+    timestamps = get_timestamps(output, "nova-1")
+    assert timestamps == sorted(set(timestamps))
+    assert timestamps == [ts for ts in range(START, int(clock.now)) if has_sample("nova-1", ts)][:len(timestamps)]
+    assert timestamps[-1] >= START + 20000
+    # The seconds of the gap are left to a backfill
+    assert covers(checkpoints, "nova-1", START + 50)
+    assert not covers(checkpoints, "nova-1", START + 5000)
+    assert covers(checkpoints, "nova-1", START + 15000)
+
+
+def test_fetch_error_while_behind(clock):
+    clock.now = START + 5000
+    session = Session(clock, lambda node, timestamp: True, down_until=START + 5500)
+    output = Output()
+    stop = Stop(clock, session, START + 6000)
+    kwapi.follow(session, output, "lyon", ["nova-1"], START, chunk_size=1000, stop=stop)
+
+    # 1 + 2 + 4 + ... seconds between the failed requests, instead of a request loop
+    assert session.errors < 12
+    assert stop.waits[:4] == [1, 2, 4, 8]
+    assert max(stop.waits) <= kwapi.MAX_PERIOD
+    timestamps = get_timestamps(output, "nova-1")
+    assert timestamps == list(range(START, START + len(timestamps)))
+    assert timestamps[-1] >= START + 5500
+
+
+def test_horizon_skip(clock, checkpoints):
+    # nova-2 publishes nothing between START + 100 and START + 1000
+    def has_sample(node, timestamp):
+        return node == "nova-1" or not START + 100 <= timestamp < START + 1000
+
+    session = Session(clock, has_sample)
+    output = Output()
+    stop = Stop(clock, session, START + 2000)
+    kwapi.follow(session, output, "lyon", ["nova-1", "nova-2"], START, chunk_size=500,
+                 stop=stop, checkpoints=checkpoints)
+
+    assert len(session.requests) < MAX_REQUESTS
+    nova_1 = get_timestamps(output, "nova-1")
+    assert nova_1 == list(range(START, START + len(nova_1)))
+    nova_2 = get_timestamps(output, "nova-2")
+    assert nova_2 == sorted(set(nova_2))
+    assert [ts for ts in nova_2 if ts < START + 1000] == list(range(START, START + 100))
+    assert START + 1000 in nova_2
+    # nova-1 was not kept waiting for nova-2
+    assert nova_1[-1] >= START + 1900
+    # The seconds skipped by nova-2 are left to a backfill
+    assert covers(checkpoints, "nova-2", START + 50)
+    assert not covers(checkpoints, "nova-2", START + 200)
+    assert covers(checkpoints, "nova-1", START + 200)
@@ -0,0 +1,188 @@
+# Copyright (C) 2018  University of Lille
+# Copyright (C) 2018  INRIA
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Tests of the incremental JSON reader of the Kwapi answers
+
+Every document is decoded from blocks of random sizes and compared with
+json.loads, so the numbers, strings and characters split between two
+blocks are checked.
+"""
+
+import json
+import os
+import random
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "script"))
+
+import kwapi  # noqa: E402
+
+SEEDS = range(50)
+BLOCK_SIZES = (1, 2, 3, 7, 64, 4096)
+
+
+def split_blocks(data, rng, size=None):
+    """
+    :param data: Bytes
+    :param rng: random.Random
+    :param size: Size of the blocks, random between 1 and 40 bytes by default
+    :return: List of bytes
+    """
+    blocks = []
+    position = 0
+    while position < len(data):
+        step = size or rng.randint(1, 40)
+        blocks.append(data[position:position + step])
+        position += step
+    return blocks
+
+
+def random_number(rng):
+    kind = rng.randrange(6)
+    if kind == 0:
+        return None
+    if kind == 1:
+        return rng.randint(-10 ** 12, 10 ** 12)
+    if kind == 2:
+        return rng.uniform(-1, 1) * 10 ** rng.randint(-30, 30)
+    if kind == 3:
+        return 1553595857 + rng.random()
+    if kind == 4:
+        return -0.0
+    return round(rng.uniform(0, 500), rng.randint(0, 3))
+
+
+def random_string(rng):
+    # Brackets, quotes, escapes and characters of several UTF-8 bytes
+    return "".join(rng.choice(['a', ']', '[', '"', '\\', ',', ' ', 'é', '€', '\U0001f50c', '\n', ':', '}'])
+                   for _ in range(rng.randint(0, 12)))
+
+
+def random_answer(rng):
+    """
+    :return: Dict of a timeseries answer, with other keys around and in the items
+    """
+    items = []
+    for index in range(rng.randint(0, 4)):
+        length = rng.choice((0, 1, 2, rng.randint(3, 300)))
+        item = {
+            "uid": "nova-%d" % index,
+            "metric_uid": random_string(rng),
+            "timestamps": [1553595857 + second + rng.choice((0, 0.5)) for second in range(length)],
+            "values": [random_number(rng) for _ in range(length)],
+            "labels": {"text]": random_string(rng), "list": [random_string(rng), [1, [2, ']']]]}
+        }
+        if rng.random() < 0.3:
+            item["values"] = [None] * length
+        keys = list(item)
+        rng.shuffle(keys)
+        items.append({key: item[key] for key in keys})
+    answer = {
+        "total": len(items),
+        "links": [{"rel": "self]", "href": "/sites/lyon/metrics/power/timeseries?only=a,b]"}],
+        "items": items,
+        "offset": random_number(rng)
+    }
+    keys = list(answer)
+    rng.shuffle(keys)
+    return {key: answer[key] for key in keys}
+
+
+def dump(answer, rng):
+    """
+    :return: UTF-8 bytes of the answer, compact or with blanks
+    """
+    if rng.random() < 0.5:
+        text = json.dumps(answer, separators=(',', ':'), ensure_ascii=False)
+    else:
+        text = json.dumps(answer, indent=rng.choice((None, 1, 4)), ensure_ascii=rng.random() < 0.5)
+    return text.encode('utf-8')
+
+
+def to_array(numbers):
+    return np.array([np.nan if number is None else number for number in numbers], dtype=np.float64)
+
+
+def check_items(items, answer):
+    assert len(items) == len(answer["items"])
+    for item, expected in zip(items, answer["items"]):
+        assert list(item) == list(expected)
+        for field, value in expected.items():
+            if field in kwapi.NUMBER_ARRAYS:
+                assert item[field].dtype == np.float64
+                np.testing.assert_array_equal(item[field], to_array(value))
+            else:
+                assert item[field] == value
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_items_random_blocks(seed):
+    rng = random.Random(seed)
+    answer = random_answer(rng)
+    data = dump(answer, rng)
+    check_items(list(kwapi.iter_stream_items(split_blocks(data, rng))), answer)
+
+
+@pytest.mark.parametrize("size", BLOCK_SIZES)
+def test_items_fixed_blocks(size):
+    rng = random.Random(size)
+    for _ in range(10):
+        answer = random_answer(rng)
+        data = dump(answer, rng)
+        check_items(list(kwapi.iter_stream_items(split_blocks(data, rng, size))), answer)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_read_value_random_blocks(seed):
+    rng = random.Random(seed)
+    values = [random_answer(rng), random_string(rng), random_number(rng), [random_number(rng)], {}, []]
+    data = b" ,\n ".join(dump(value, rng) for value in values)
+    stream = kwapi.JsonStream(split_blocks(data, rng))
+    for index, value in enumerate(values):
+        if index:
+            stream.expect(',')
+        assert stream.read_value() == value
+
+
+def test_numbers_split_in_every_place():
+    data = b'[1553595857.25, null ,-1.5e-07,2E+3 , 0,-0.0,\n1e300, null]'
+    expected = to_array(json.loads(data))
+    for cut in range(1, len(data)):
+        stream = kwapi.JsonStream([data[:cut], data[cut:]])
+        np.testing.assert_array_equal(stream.read_numbers(), expected)
+
+
+def test_empty_arrays():
+    for data in (b'[]', b'[ ]', b'[\n]'):
+        stream = kwapi.JsonStream([data[:1], data[1:]])
+        assert len(stream.read_numbers()) == 0
+
+
+def test_parse_numbers():
+    np.testing.assert_array_equal(kwapi.parse_numbers(" 1, null,2.5e1 "), [1, np.nan, 25])
+    assert len(kwapi.parse_numbers(" \n")) == 0
+    with pytest.raises(ValueError):
+        kwapi.parse_numbers('1,"a",2')
+
+
+def test_truncated():
+    data = dump({"items": [{"uid": "a", "values": [1, 2, 3]}]}, random.Random(0))
+    for cut in (5, len(data) // 2, len(data) - 1):
+        with pytest.raises(ValueError):
+            list(kwapi.iter_stream_items(split_blocks(data[:cut], random.Random(cut))))